@@ -9,7 +9,7 @@ Created on Mon Sep 10 14:43:26 2012
 
 import numpy as np
 from netCDF4 import Dataset
-from scipy import spatial, interpolate
+from scipy import spatial, interpolate, ndimage
 import matplotlib.pyplot as plt
 import time
 import shutil
@@ -27,6 +27,13 @@ class DEM(object):
     
     W = 1.0 # Weight
     maxdist = 250.0
+
+    # Only load the part of a netcdf DEM inside [xmin, xmax, ymin, ymax]
+    bbox = None
+
+    # netcdf output chunk (tile) size in pixels and whether to add overviews
+    chunksize = 256
+    overviews = True
     
     def __init__(self,infile,**kwargs):
         self.infile=infile
@@ -57,20 +64,21 @@ class DEM(object):
         """ Load the DEM data from a netcdf file"""        
         nc = Dataset(self.infile, 'r')
         #print nc.variables.keys()
-        try:
-            X = nc.variables['X'][:]
-            Y = nc.variables['Y'][:]
-            Z = nc.variables['topo'][:]
-        except:
-            try:
-                X = nc.variables['x'][:]
-                Y = nc.variables['x'][:]
-                Z = nc.variables['z'][:]
-            except:
-                X = nc.variables['lon'][:]
-                Y = nc.variables['lat'][:]
-                Z = nc.variables['topo'][:]
-                
+        X, Y = _ncgrid(nc)
+        if nc.variables.has_key('topo'):
+            zvar = nc.variables['topo']
+        else:
+            zvar = nc.variables['z']
+
+        if self.bbox is None:
+            Z = zvar[:]
+        else:
+            # Only read the window (plus one point) covering the bbox
+            ii = _window(X, self.bbox[0], self.bbox[1])
+            jj = _window(Y, self.bbox[2], self.bbox[3])
+            X = X[ii]
+            Y = Y[jj]
+            Z = zvar[jj,ii]
                 
         nc.close()
         return X,Y,Z
@@ -202,53 +210,9 @@ class DEM(object):
     def calcWeight(self):
         
         """ Calculate the weight at each point """
-        MAXPOINTS=20e6
-        weight = np.zeros((self.ny,self.nx))
-        
-        # Calculate the distance from each point to a nan point
-        xy = self.nonnanxy()
-        xynan = self.nanxy()
-        
-        # If there are no nan's return W
-        if xynan.shape[0] == 0:
-            weight[:] = self.W
-            return weight
+        Z = np.ma.filled(self.Z, np.nan)
 
-        # Compute the spatial tree
-        kd = spatial.cKDTree(xynan)
-        
-        nxy = len(xy)
-        
-        if nxy <= MAXPOINTS:
-            # Perform query on all of the points in the grid
-            dist,ind=kd.query(xy)
-            
-            # Compute the actual weight
-            w = dist/self.maxdist
-            #w = (dist-self.maxdist)/self.maxdist # Linear
-            w[dist>self.maxdist]=1.0
-            w=self.W*w
-            
-            # Map onto the grid
-            J,I=self.returnij(xy[:,0],xy[:,1])
-            weight[J,I]=w
-        else:
-            print 'Dataset too large - calculating weights for chunks...'
-            nchunks = np.ceil(len(xy)/MAXPOINTS)
-            pt1,pt2=tile_vector(len(xy),int(nchunks))
-            for p1,p2 in zip(pt1,pt2):
-                print 'Calculating points %d to %d of %d...'%(p1,p2,nxy)
-                dist,ind=kd.query(xy[p1:p2,:])
-                # Compute the actual weight
-                w = dist/self.maxdist
-                w[dist>self.maxdist]=1.0
-                w=self.W*w
-                
-                # Map onto the grid
-                J,I=self.returnij(xy[p1:p2,0],xy[p1:p2,1])
-                weight[J,I]=w
-        
-        return weight   
+        return distance_weight(Z, self.dx, self.dy, W=self.W, maxdist=self.maxdist)
         
     def contourf(self,vv=range(-10,0),**kwargs):
         #fig= plt.figure(figsize=(9,8))
@@ -304,13 +268,18 @@ class DEM(object):
         tmpvary.setncattr('long_name','Northing')
         tmpvary.setncattr('units','metres')
         
-        # Write the topo data
-        tmpvarz=nc.createVariable('topo','f8',(dimnamey,dimnamex),zlib=True,least_significant_digit=1)
+        # Write the topo data in compressed tiles
+        chunks = (min(self.chunksize,self.ny), min(self.chunksize,self.nx))
+        tmpvarz=nc.createVariable('topo','f8',(dimnamey,dimnamex),zlib=True,\
+            least_significant_digit=1,chunksizes=chunks)
         tmpvarz[:] = self.Z
         tmpvarz.setncattr('long_name','Topographic elevation')
         tmpvarz.setncattr('units','metres')
         tmpvarz.setncattr('coordinates','X, Y')
         tmpvarz.setncattr('positive','up')
+
+        if self.overviews:
+            write_overviews(nc, chunksize=self.chunksize)
         
         nc.close()
         
@@ -331,59 +300,105 @@ def tile_vector(count,chunks):
         pt2 = range(dx,count,dx)  
     return pt1,pt2
     
-def blendDEMs(ncfile,outfile,W,maxdist):
+def distance_weight(Z, dx, dy, W=1.0, maxdist=250.0):
+    """
+    Blending weight of each pixel of a regular grid
+
+    The weight is W times the distance to the nearest NaN pixel divided by
+    maxdist (capped at one), and zero on the NaN pixels. The distances come
+    from a Euclidean distance transform of the NaN mask.
+
+    Inputs:
+        Z - gridded data [ny, nx]
+        dx, dy - grid spacing
+    *Optional*
+        W - maximum weight
+        maxdist - distance over which the weight ramps up from zero to W
+
+    Returns:
+        weight [ny, nx]
+    """
+    valid = ~np.isnan(Z)
+
+    # If there are no nan's return W
+    if valid.all():
+        return W*np.ones(Z.shape)
+
+    dist = ndimage.distance_transform_edt(valid, sampling=(abs(dy),abs(dx)))
+
+    return W*np.minimum(dist/maxdist, 1.0)
+
+def blendDEMs(ncfile,outfile,W,maxdist,tilesize=2000):
+    """
+    Blend DEMs on the same grid, weighting each by its distance_weight
+
+    The blend is computed in tiles of tilesize x tilesize pixels. Each file
+    is read over the tile plus a halo of its maxdist, so only one tile per
+    file is held in memory.
+
+    Inputs:
+        ncfile - list of DEM netcdf files (with a 'topo' variable)
+        outfile - output netcdf file (a copy of the last input file, with
+            its overviews recomputed from the blend)
+        W - list of weights of each file
+        maxdist - list of weighting distances of each file
+    *Optional*
+        tilesize - tile size in pixels
+    """
     ### Combine multiple files ###   
-    
-    #Calculate the weights for each file
     nfiles = len(ncfile)
-    ii=-1
-    for nc in ncfile:
-        ii+=1
-        d = DEM(infile=nc,W=W[ii],maxdist=maxdist[ii])
-        print 'Calculating weights for %s...'%nc
-        print 'Weight = %6.3f, maxdist = %f'%(W[ii],maxdist[ii])
-        w=d.calcWeight()
-        ny = d.ny
-        nx = d.nx
-        
-#        if ii == 1:
-#            f=d.contourf(w,vv=np.linspace(0,W[ii],10))
-#            f.savefig('%s_Weights.pdf'%outfile[:-2])
-#            del f
-        del d
-        if ii == 0:
-            Wall = np.zeros((ny,nx,nfiles))
-        Wall[:,:,ii]=w
-        del w
-        
-    # Normalise the weights
-    print 'Normalising the weights...'
-    Wsum = np.sum(Wall,axis=2)
+    ncin = [Dataset(infile, 'r') for infile in ncfile]
+    ny, nx = ncin[0].variables['topo'].shape
+    x, y = _ncgrid(ncin[0])
+    dx = abs(x[1]-x[0])
+    dy = abs(y[1]-y[0])
+
+    # Halo of each file in pixels
+    halo = []
     for ii in range(0,nfiles):
-        Wall[:,:,ii] = np.squeeze(Wall[:,:,ii]) / Wsum
-        
-        
-        
-        
-    # Re-load in the depths from each file and sum
-    print 'Writing to an output file...'
-    Zout = np.zeros((ny,nx))
-    filestr = ''
-    ii=-1
-    for infile in ncfile:
-        ii+=1
-        nc = Dataset(infile, 'r')
-        Zin = nc.variables['topo'][:]
-        nc.close()
-        
-        Zin[np.isnan(Zin)]=0.0
-        Zout +=  np.squeeze(Wall[:,:,ii]) * Zin 
-        filestr +='%s, '%infile
-    
+        print 'Weight = %6.3f, maxdist = %f for %s'%(W[ii],maxdist[ii],ncfile[ii])
+        halo.append((int(np.ceil(maxdist[ii]/dy)), int(np.ceil(maxdist[ii]/dx))))
+
     # Copy the data to a new netcdf file
     shutil.copyfile(ncfile[-1],outfile)
     nc = Dataset(outfile, 'r+')
-    nc.variables['topo'][:]=Zout
+
+    print 'Blending and writing to an output file...'
+    for j0 in range(0,ny,tilesize):
+        j1 = min(j0+tilesize,ny)
+        print 'Blending rows %d to %d of %d...'%(j0,j1,ny)
+        for i0 in range(0,nx,tilesize):
+            i1 = min(i0+tilesize,nx)
+            Zsum = np.zeros((j1-j0,i1-i0))
+            Wsum = np.zeros((j1-j0,i1-i0))
+            for ii in range(0,nfiles):
+                hy, hx = halo[ii]
+                ja, jb = max(j0-hy,0), min(j1+hy,ny)
+                ia, ib = max(i0-hx,0), min(i1+hx,nx)
+                Zin = np.ma.filled(ncin[ii].variables['topo'][ja:jb,ia:ib], np.nan)
+
+                w = distance_weight(Zin, dx, dy, W=W[ii], maxdist=maxdist[ii])
+                w = w[j0-ja:j1-ja,i0-ia:i1-ia]
+                Zin = Zin[j0-ja:j1-ja,i0-ia:i1-ia]
+                Zin[np.isnan(Zin)]=0.0
+
+                Zsum += w*Zin
+                Wsum += w
+
+            with np.errstate(invalid='ignore', divide='ignore'):
+                nc.variables['topo'][j0:j1,i0:i1] = Zsum/Wsum
+
+    # The copied overviews are of the last input file
+    if 'overviews' in nc.ncattrs():
+        print 'Updating the overviews...'
+        xvar, yvar = _ncgridnames(nc)
+        write_overviews(nc, chunksize=max(nc.variables['topo'].chunking()),\
+            xvar=xvar, yvar=yvar)
+
+    filestr = ''
+    for infile, ncf in zip(ncfile, ncin):
+        ncf.close()
+        filestr +='%s, '%infile
     
     globalatts = {'title':'DEM model',\
         'history':'Created on '+time.ctime(),\
@@ -396,6 +411,233 @@ def blendDEMs(ncfile,outfile,W,maxdist):
     
     print 'Completed write to %s.'%outfile
 
+def _ncgrid(nc):
+    """
+    Returns the x and y coordinate vectors of a DEM netcdf file
+    """
+    xvar, yvar = _ncgridnames(nc)
+
+    return nc.variables[xvar][:], nc.variables[yvar][:]
+
+def _ncgridnames(nc):
+    """
+    Returns the names of the x and y coordinate variables of a DEM netcdf file
+    """
+    for xvar, yvar in [('X','Y'),('x','y'),('lon','lat')]:
+        if nc.variables.has_key(xvar):
+            return xvar, yvar
+
+    raise Exception, 'no x/y coordinates found in %s'%nc.filepath()
+
+def _window(x, x0, x1):
+    """
+    Slice of the coordinate vector x covering [x0, x1] plus one point
+    either side
+    """
+    ind = np.flatnonzero((x>=x0) & (x<=x1))
+    if ind.size == 0:
+        # The range falls between two points
+        ind = np.array([np.argmin(np.abs(x-0.5*(x0+x1)))])
+
+    return slice(max(ind[0]-1,0), min(ind[-1]+2,x.shape[0]))
+
+def write_overviews(nc, varname='topo', chunksize=256, xvar='X', yvar='Y'):
+    """
+    Add reduced resolution copies (overviews) of a gridded variable to an
+    open netcdf file
+
+    Each overview halves the resolution of the previous one, taking the
+    mean of the non-NaN values in 2x2 blocks, until it fits in one chunk.
+    The overview with factor f is stored in 'varname_f' with coordinates
+    'xvar_f', 'yvar_f'. The factors are listed in the global attribute
+    'overviews'. All the overviews are read and written one tile at a time.
+    Overviews that already exist (e.g. in a copied file) are recomputed.
+    """
+    src = nc.variables[varname]
+    x = nc.variables[xvar][:]
+    y = nc.variables[yvar][:]
+    ydim, xdim = src.dimensions
+
+    factor = 1
+    factors = []
+    while max(src.shape) > chunksize:
+        factor *= 2
+        # New coordinates are the mid-points of each pair
+        dx = x[1]-x[0] if x.shape[0] > 1 else 0.
+        dy = y[1]-y[0] if y.shape[0] > 1 else 0.
+        x = x[0::2] + 0.5*dx
+        y = y[0::2] + 0.5*dy
+        ny, nx = y.shape[0], x.shape[0]
+
+        if nc.variables.has_key('%s_%d'%(varname,factor)):
+            dst = nc.variables['%s_%d'%(varname,factor)]
+        else:
+            nc.createDimension('%s_%d'%(xdim,factor), nx)
+            nc.createDimension('%s_%d'%(ydim,factor), ny)
+            dims = ('%s_%d'%(ydim,factor), '%s_%d'%(xdim,factor))
+            nc.createVariable('%s_%d'%(xvar,factor),'f8',dims[1:])[:] = x
+            nc.createVariable('%s_%d'%(yvar,factor),'f8',dims[0:1])[:] = y
+            dst = nc.createVariable('%s_%d'%(varname,factor),'f8',dims,zlib=True,\
+                least_significant_digit=1,chunksizes=(min(chunksize,ny),min(chunksize,nx)))
+            dst.setncattr('overview_factor', factor)
+
+        for j0 in range(0,ny,chunksize):
+            for i0 in range(0,nx,chunksize):
+                Z = np.ma.filled(src[2*j0:2*(j0+chunksize),2*i0:2*(i0+chunksize)], np.nan)
+                dst[j0:j0+chunksize,i0:i0+chunksize] = _coarsen(Z)
+
+        factors.append(factor)
+        src = dst
+
+    if len(factors) > 0:
+        nc.setncattr('overviews', np.array(factors, dtype=np.int32))
+
+def _coarsen(Z):
+    """
+    Mean of the non-NaN values in each 2x2 block of Z (padding odd sizes)
+    """
+    ny, nx = Z.shape
+    Zp = np.nan*np.ones((ny+ny%2, nx+nx%2))
+    Zp[:ny,:nx] = Z
+    Zp = Zp.reshape((Zp.shape[0]//2, 2, Zp.shape[1]//2, 2))
+
+    valid = ~np.isnan(Zp)
+    N = valid.sum(axis=(1,3))
+    Zsum = np.where(valid, Zp, 0.).sum(axis=(1,3))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(N > 0, Zsum/N, np.nan)
+
+class TiledDEM(object):
+    """
+    Reader for (large) DEM netcdf files that only touches the tiles and the
+    resolution needed for each query
+
+    Files written by DEM.savenc or demBuilder.save are stored in compressed
+    tiles with overviews (see write_overviews). Any other DEM netcdf file
+    works too, with only the full resolution level.
+
+    Example:
+        D = TiledDEM('DEM.nc', res=100.)
+        z = D.interp(x, y)
+        x, y, Z = D.subset([xmin, xmax, ymin, ymax])
+    """
+    varname = 'topo'
+    res = None # Resolution to sample at (None for full resolution)
+
+    def __init__(self, infile, **kwargs):
+        self.infile = infile
+        self.__dict__.update(kwargs)
+
+        # Only the coordinates are loaded up front
+        nc = Dataset(self.infile, 'r')
+        self.xvar, self.yvar = _ncgridnames(nc)
+        x, y = _ncgrid(nc)
+        if not nc.variables.has_key(self.varname):
+            self.varname = 'z'
+        self.factors = [1]
+        if 'overviews' in nc.ncattrs():
+            self.factors += list(np.atleast_1d(nc.getncattr('overviews')))
+
+        self.x = [np.asarray(x)]
+        self.y = [np.asarray(y)]
+        for ff in self.factors[1:]:
+            self.x.append(nc.variables['%s_%d'%(self.xvar,ff)][:])
+            self.y.append(nc.variables['%s_%d'%(self.yvar,ff)][:])
+        self.chunks = nc.variables[self.varname].chunking()
+        if self.chunks == 'contiguous':
+            self.chunks = [256, 256]
+        nc.close()
+
+    def level(self, res=None):
+        """
+        Index of the coarsest level with a grid spacing no larger than res
+        """
+        if res is None:
+            res = self.res
+        if res is None:
+            return 0
+
+        dx = np.array([abs(xx[1]-xx[0]) if xx.shape[0] > 1 else np.inf for xx in self.x])
+        ind = np.flatnonzero(dx <= res)
+        if ind.size == 0:
+            return 0
+
+        return ind[-1]
+
+    def _var(self, nc, lev):
+        if lev == 0:
+            return nc.variables[self.varname]
+        else:
+            return nc.variables['%s_%d'%(self.varname,self.factors[lev])]
+
+    def subset(self, bbox, res=None):
+        """
+        Read the DEM inside bbox [xmin, xmax, ymin, ymax]
+
+        Returns:
+            x [nx], y [ny], Z [ny, nx]
+        """
+        lev = self.level(res)
+        ii = _window(self.x[lev], bbox[0], bbox[1])
+        jj = _window(self.y[lev], bbox[2], bbox[3])
+
+        nc = Dataset(self.infile, 'r')
+        Z = np.ma.filled(self._var(nc, lev)[jj,ii], np.nan)
+        nc.close()
+
+        return self.x[lev][ii], self.y[lev][jj], Z
+
+    def interp(self, x, y, res=None):
+        """
+        Bilinear interpolation onto scattered points
+
+        The points are grouped by tile and each tile (plus a one pixel
+        margin) is read on its own. Points outside of the DEM take the value
+        at the nearest edge (as DEM.interp does).
+        """
+        x = np.asarray(x, dtype=np.float64)
+        y = np.asarray(y, dtype=np.float64)
+        lev = self.level(res)
+        xg, yg = self.x[lev], self.y[lev]
+        ny, nx = yg.shape[0], xg.shape[0]
+
+        # Fractional grid indices (the grid is regular)
+        fi = (x - xg[0])/(xg[1]-xg[0])
+        fj = (y - yg[0])/(yg[1]-yg[0])
+        out = np.isnan(fi) | np.isnan(fj)
+        fi[out] = 0.
+        fj[out] = 0.
+        fi = np.clip(fi, 0, nx-1)
+        fj = np.clip(fj, 0, ny-1)
+        i = np.minimum(np.floor(fi).astype(np.int64), nx-2)
+        j = np.minimum(np.floor(fj).astype(np.int64), ny-2)
+        wi = fi - i
+        wj = fj - j
+
+        # Group the points by tile
+        cj, ci = self.chunks
+        tile = (j//cj)*(nx//ci+1) + i//ci
+        order = np.argsort(tile, kind='mergesort')
+        bounds = np.flatnonzero(np.diff(tile[order])) + 1
+
+        Z = np.nan*np.ones(x.shape)
+        nc = Dataset(self.infile, 'r')
+        var = self._var(nc, lev)
+        for gg in np.split(order, bounds):
+            gg = gg[~out[gg]]
+            if gg.size == 0:
+                continue
+            i0, i1 = i[gg].min(), i[gg].max()+2
+            j0, j1 = j[gg].min(), j[gg].max()+2
+            Zt = np.ma.filled(var[j0:j1,i0:i1], np.nan)
+            ii = i[gg]-i0
+            jj = j[gg]-j0
+            Z[gg] = (1-wj[gg])*((1-wi[gg])*Zt[jj,ii] + wi[gg]*Zt[jj,ii+1]) +\
+                wj[gg]*((1-wi[gg])*Zt[jj+1,ii] + wi[gg]*Zt[jj+1,ii+1])
+        nc.close()
+
+        return Z
+
 
 #ncfile = [\
 #'C:/Projects/GOMGalveston/DATA/Bathymetry/DEMs/USACELIDAR_dx25_blockavg.nc',\
@@ -5,6 +5,9 @@
 
 from netCDF4 import Dataset
 import gzip
+import os
+import shutil
+import tempfile
 from scipy import spatial
 import numpy as np
 from scipy.sparse import coo_matrix
@@ -15,7 +18,11 @@ import pandas as pd
 
 from soda.utils.maptools import ll2utm, readShpBathy, readDEM
 from soda.utils.kriging import kriging
-from soda.utils.interpXYZ import CurvMin
+from soda.utils.interpXYZ import CurvMin, read_xyz, read_xyz_gz, xyz_chunks, xyz_cache
+from soda.utils.tiledinterp import build_point_index, PointIndex, TiledInterp
+from soda.utils.parallel import parallel_map
+from soda.dataio.conversion.dem import write_overviews
+from soda.utils.binning import bin_stats
 
 
 # testing stuff
@@ -41,7 +48,8 @@ class demBuilder(object):
     bbox = [-95.45,-94.44,28.8,29.8]
     
     # Interpolation options
-    interptype = 'nn' # One of 'nn', 'blockavg', 'idw'
+    interptype = 'nn' # One of 'nn', 'blockavg', 'idw', 'kriging', 'griddata', 'curvmin'
+    blockstat = 'mean' # Statistic used by 'blockavg': 'mean', 'min', 'max', 'median' or 'count'
     maxdist=200
     NNear = 3 # Number of points to include in interpolation (only applicable to idw and kriging)
     p = 1.0 # power for inverse distance weighting
@@ -55,6 +63,22 @@ class demBuilder(object):
     scale = 1.0
 
     h5groups = None
+
+    # Convert text files to a binary cache the first time they are read
+    cache = False
+
+    # Tiled build options. Setting tilesize (in coordinate units) streams the
+    # input points into a binned index on disk (kept in indexdir if it is
+    # set) and builds the DEM tile by tile with numprocs workers. The DEM is
+    # written to outfile (a memory-mapped .npy file) if it is set.
+    tilesize = None
+    numprocs = 1
+    indexdir = None
+    outfile = None
+
+    # netcdf output chunk (tile) size in pixels and whether to add overviews
+    chunksize = 256
+    overviews = True
     
     def __init__(self,**kwargs):
         
@@ -63,16 +87,21 @@ class demBuilder(object):
         # Check if the input file is not a list
         T = type(self.infile)
         
-        if T!=list:
+        if self.tilesize is not None:
+            self.multifile = T==list
+            self.index = self.pointIndex()
+            self.npt = self.index.npts
+            if self.bbox is None:
+                self.bbox = list(self.index.bbox)
+            databox = self.index.bbox
+
+        elif T!=list:
             self.multifile=False
 
             # Parse the data file into two vectors
             print 'Reading data from: %s...'%self.infile
-            if self.infile[-3:]=='.gz':
-                LL,self.Zin = read_xyz_gz(self.infile)
-
-            elif self.infile[-3:]=='txt':
-                LL,self.Zin = read_xyz(self.infile)
+            if self.infile[-3:] in ['.gz','txt','xyz']:
+                LL,self.Zin = read_xyz(self.infile, cache=self.cache)
 
             elif self.infile[-3:]=='shp':
                 LL,self.Zin = readShpBathy(self.infile)
@@ -110,17 +139,22 @@ class demBuilder(object):
             else:
                 self.XY=LL
 
+            databox = [self.XY[:,0].min(), self.XY[:,0].max(),\
+                self.XY[:,1].min(), self.XY[:,1].max()]
+
         else: # Multiple files
             self.multifile=True
+            databox = None
         
         # Print out some details before processing
         print 72*'#'
         print 'Grid bounds: ' 
         print '\tX: ', self.bbox[0:2]
         print '\tY: ', self.bbox[2:4]
-        print 'Data bounds:'
-        print 'X min = %f, X max = %f'%(self.XY[:,0].min(), self.XY[:,0].max())
-        print 'Y min = %f, Y max = %f'%(self.XY[:,1].min(), self.XY[:,1].max())
+        if databox is not None:
+            print 'Data bounds:'
+            print 'X min = %f, X max = %f'%(databox[0], databox[1])
+            print 'Y min = %f, Y max = %f'%(databox[2], databox[3])
         print 72*'#'
 
 
@@ -137,7 +171,10 @@ class demBuilder(object):
     def build(self):
         
         tic=time.clock()
-        if self.multifile==False:
+        if self.tilesize is not None:
+            self.buildTiled()
+
+        elif self.multifile==False:
             if self.interptype=='nn':
                 print 'Building DEM with Nearest Neighbour interpolation...'
                 self.nearestNeighbour()
@@ -173,10 +210,8 @@ class demBuilder(object):
                 ctr+=1
                 # Read in the array
                 print 'Reading data file (%d of %d): %s...'%(ctr,len(self.infile),f)
-                if f[-3:]=='.gz':
-                    LL,self.Zin = read_xyz_gz(f)
-                if f[-3:]=='txt':
-                    LL,self.Zin = read_xyz(f)
+                if f[-3:] in ['.gz','txt','xyz']:
+                    LL,self.Zin = read_xyz(f, cache=self.cache)
                 elif f[-3:]=='shp':
                     LL,self.Zin = readShpBathy(f)
                 elif f[-3:]=='dem':
@@ -266,18 +301,9 @@ class demBuilder(object):
         # Get the grid indices
         J,I = self.grd.returnij(self.XY[:,0],self.XY[:,1])
         
-        # Average onto the grid
-        Z = np.zeros((self.grd.ny,self.grd.nx))
-        N = np.zeros((self.grd.ny,self.grd.nx))
-        ctr=-1
-        for jj,ii in zip(J,I):
-            ctr+=1
-            if jj != -1 and ii != -1:
-                Z[jj,ii] += self.Zin[ctr]
-                N[jj,ii] += 1.0
-            
-        self.Z = np.divide(Z,N)
-        self.N = N
+        # Average (or min, max, ...) onto the grid
+        self.Z, self.N = bin_points(J, I, self.Zin, (self.grd.ny,self.grd.nx),\
+            stat=self.blockstat)
     
     def blockAvgMulti(self):
         
@@ -286,22 +312,10 @@ class demBuilder(object):
         # Get the grid indices
         J,I = self.grd.returnij(self.XY[:,0],self.XY[:,1])
         
-        # Zero out of bound points
-        sumpts = np.ones((self.npt,))
-        ind = I==-1
-        self.Zin[ind]=0.0
-        I[ind]=0
-        sumpts[ind]=0
-        ind = J==-1
-        self.Zin[ind]=0.0
-        J[ind]=0
-        sumpts[ind]=0
-        
-        #  Use the sparse matrix library for accumulation
-        self.Z += coo_matrix((np.ravel(self.Zin),(J,I)),\
-            shape=(self.grd.ny,self.grd.nx)).todense()   
-        self.N += coo_matrix((sumpts,(J,I)),\
-            shape=(self.grd.ny,self.grd.nx)).todense()   
+        # Accumulate the sums and counts of each cell
+        Zsum, N = bin_points(J, I, self.Zin, (self.grd.ny,self.grd.nx), stat='sum')
+        self.Z += Zsum
+        self.N += N
 
 ##        # Average onto the grid
 ##        ctr=-1
@@ -354,6 +368,122 @@ class demBuilder(object):
     def curvmin(self):
         self.Finterp = CurvMin(self.XY, self.grd.ravel())
         self.Z = self.Finterp(self.Zin).reshape((self.grd.ny,self.grd.nx))
+
+    def pointIndex(self):
+        """
+        Returns the PointIndex of the (projected) input points
+
+        An existing index in indexdir is reused. Otherwise the input files
+        are streamed block by block into a new index so that the points
+        never have to fit in memory.
+        """
+        self._tmpindex = False
+        if self.indexdir is None:
+            self.indexdir = tempfile.mkdtemp(suffix='_demindex')
+            self._tmpindex = True
+        elif os.path.exists(os.path.join(self.indexdir, 'meta.npz')):
+            print 'Using the point index in: %s'%self.indexdir
+            return PointIndex(self.indexdir)
+
+        print 'Building the point index in: %s...'%self.indexdir
+        return build_point_index(self.indexdir, self._pointChunks(),\
+            binsize=self.tilesize/4.)
+
+    def _pointChunks(self):
+        """
+        Iterator over blocks of projected points (XY, Z) from the input files
+        """
+        if self.multifile:
+            files = self.infile
+        else:
+            files = [self.infile]
+
+        for f in files:
+            print 'Reading data from: %s...'%f
+            if f[-3:] in ['.gz','txt','xyz'] or os.path.isdir(f):
+                if self.cache and not os.path.isdir(f):
+                    f = xyz_cache(f)
+                chunks = xyz_chunks(f)
+            elif f[-3:]=='shp':
+                chunks = [readShpBathy(f)]
+            elif f[-3:]=='dem':
+                chunks = [readDEM(f,True)]
+            else:
+                raise Exception, 'tiled builds only read xyz, shp and dem files: %s'%f
+
+            for LL, Z in chunks:
+                if self.convert2utm:
+                    XY = ll2utm(LL,self.utmzone,self.CS,self.isnorth)
+                else:
+                    XY = LL
+                yield XY, self.scale*np.ravel(Z)
+
+    def buildTiled(self):
+        """
+        Builds the DEM tile by tile from the point index
+        """
+        x = self.grd.xgrd
+        y = self.grd.ygrd
+        methods = {'nn':'nn', 'idw':'idw', 'kriging':'kriging', 'griddata':'linear'}
+
+        if self.interptype=='blockavg':
+            print 'Building DEM with tiled Block Averaging (%s)...'%self.blockstat
+            if self.outfile is None:
+                self.Z = np.zeros((self.grd.ny,self.grd.nx))
+            else:
+                self.Z = np.lib.format.open_memmap(self.outfile, mode='w+',\
+                    dtype=np.float64, shape=(self.grd.ny,self.grd.nx))
+
+            ntile = max(int(self.tilesize/self.dx), 1)
+            blocks = []
+            for j0 in range(0, self.grd.ny, ntile):
+                for i0 in range(0, self.grd.nx, ntile):
+                    blocks.append((slice(j0, min(j0+ntile,self.grd.ny)),\
+                        slice(i0, min(i0+ntile,self.grd.nx))))
+
+            args = [(jj, ii) for jj, ii in blocks]
+            for bb, zz in zip(blocks, parallel_map(self, '_blockTile', args, self.numprocs)):
+                self.Z[bb] = zz
+            if isinstance(self.Z, np.memmap):
+                self.Z.flush()
+
+        elif methods.has_key(self.interptype):
+            print 'Building DEM with tiled %s interpolation...'%self.interptype
+            self.Finterp = TiledInterp(self.index, method=methods[self.interptype],\
+                maxdist=self.maxdist, NNear=self.NNear, p=self.p,\
+                varmodel=self.varmodel, nugget=self.nugget, sill=self.sill,\
+                vrange=self.vrange, tilesize=self.tilesize, numprocs=self.numprocs)
+            self.Z = self.Finterp.grid(x, y, outfile=self.outfile)
+
+        else:
+            raise Exception, 'interptype %s is not supported by tiled builds'%self.interptype
+
+        if self._tmpindex:
+            shutil.rmtree(self.indexdir)
+            self.indexdir = None
+
+    def _blockTile(self, jj, ii):
+        """
+        Bins the points of one tile of the grid (see Grid.returnij for the
+        cell extents)
+        """
+        grd = self.grd
+        bbox = [grd.x0+(ii.start-1)*grd.dx, grd.x0+(ii.stop-1)*grd.dx,\
+            grd.y0+(jj.start-1)*grd.dy, grd.y0+(jj.stop-1)*grd.dy]
+        XY, Z = self.index.query(bbox)
+        shape = (jj.stop-jj.start, ii.stop-ii.start)
+        if Z.shape[0] == 0:
+            # Tile outside of the data (or in a gap)
+            return np.nan*np.ones(shape)
+
+        J, I = grd.returnij(XY[:,0], XY[:,1])
+        J = J - jj.start
+        I = I - ii.start
+        outside = (J<0) | (J>=shape[0]) | (I<0) | (I>=shape[1])
+        J[outside] = -1
+        I[outside] = -1
+
+        return bin_points(J, I, Z, shape, stat=self.blockstat)[0]
     
     def loadnc(self,fv=1):
         """ Load the DEM data from a netcdf file"""        
@@ -439,8 +569,8 @@ class demBuilder(object):
         # Create the lat lon variables
         tmpvarx=nc.createVariable('X','f8',(dimnamex,))
         tmpvary=nc.createVariable('Y','f8',(dimnamey,))
-        tmpvarx[:] = self.grd.X[0,:]
-        tmpvary[:] = self.grd.Y[:,0]
+        tmpvarx[:] = self.grd.xgrd
+        tmpvary[:] = self.grd.ygrd
         # Create the attributes
         tmpvarx.setncattr('long_name','Easting')
         tmpvarx.setncattr('units','metres')
@@ -448,13 +578,22 @@ class demBuilder(object):
         tmpvary.setncattr('units','metres')
         
         # Write the topo data
-        tmpvarz=nc.createVariable('topo','f8',(dimnamey,dimnamex),zlib=True,least_significant_digit=1)
-        tmpvarz[:] = self.Z
+        chunks = (min(self.chunksize,self.grd.ny), min(self.chunksize,self.grd.nx))
+        tmpvarz=nc.createVariable('topo','f8',(dimnamey,dimnamex),zlib=True,\
+            least_significant_digit=1,chunksizes=chunks)
+        # Write in blocks of whole tile rows so memory-mapped DEMs are not
+        # loaded at once
+        nrows = chunks[0]*max(int(1e7)//(self.grd.nx*chunks[0]), 1)
+        for j0 in range(0, self.grd.ny, nrows):
+            tmpvarz[j0:j0+nrows,:] = self.Z[j0:j0+nrows,:]
         tmpvarz.setncattr('long_name','Topographic elevation')
         tmpvarz.setncattr('units','metres')
         tmpvarz.setncattr('coordinates','X, Y')
         tmpvarz.setncattr('positive','up')
         tmpvarz.setncattr('datum',self.vdatum)
+
+        if self.overviews:
+            write_overviews(nc, chunksize=self.chunksize)
         
         nc.close()
         
@@ -509,13 +648,21 @@ class Grid(object):
         self.dx=dx
         self.dy=dy
         
-        xgrd = np.arange(self.x0,self.x1,dx)
-        ygrd = np.arange(self.y0,self.y1,dy)
-        self.nx = len(xgrd)
-        self.ny = len(ygrd)
+        self.xgrd = np.arange(self.x0,self.x1,dx)
+        self.ygrd = np.arange(self.y0,self.y1,dy)
+        self.nx = len(self.xgrd)
+        self.ny = len(self.ygrd)
         self.npts = self.nx*self.ny
-        
-        self.X,self.Y = np.meshgrid(xgrd,ygrd)
+
+    @property
+    def X(self):
+        """ Grid x coordinates [ny, nx] (only created when needed)"""
+        return np.meshgrid(self.xgrd,self.ygrd)[0]
+
+    @property
+    def Y(self):
+        """ Grid y coordinates [ny, nx] (only created when needed)"""
+        return np.meshgrid(self.xgrd,self.ygrd)[1]
         
     def ravel(self):
         """ Returns the grid coordinates as a vector"""
@@ -542,55 +689,24 @@ class Grid(object):
         return J,I
                 
 ## Other functions that don't need to be in a class ##
-def read_xyz_gz(fname):
-    # Read the raw data into an array
-    f = gzip.open(fname,'r')
-    
-    npts = line_count(f)-1
-    XY = np.zeros((npts,2))
-    Z = np.zeros((npts,1))
-    ii=-1
-    for line in f:
-        ii+=1
-        if ii > 0:
-            xyz = line.split(', ')
-            XY[ii-1,0] = float(xyz[0]) 
-            XY[ii-1,1] = float(xyz[1])
-            Z[ii-1,0] = float(xyz[2])
-            
-    f.close()
-      
-    return XY,Z
-    
-def read_xyz(fname):
-    # Read the raw data into an array
-    f =open(fname,'r')
-    
-    npts = line_count(f)-1
-    XY = np.zeros((npts,2))
-    Z = np.zeros((npts,1))
-    ii=-1
-    for line in f:
-        ii+=1
-        if ii > 0:
-            xyz = line.split(', ')
-            XY[ii-1,0] = float(xyz[0]) 
-            XY[ii-1,1] = float(xyz[1])
-            Z[ii-1,0] = float(xyz[2])
-            
-    f.close()
-      
-    return XY,Z
-    
-def line_count(f):
-    for i, l in enumerate(f):
-        pass
-#    try:
-#        f.rewind()
-#    except ValueError:
-#        f.seek(0,0) 
-    f.seek(0,0)
-    return i + 1
+def bin_points(J, I, Z, shape, stat='mean'):
+    """
+    Bins the values Z into the cells (J, I) of a grid
+
+    Inputs:
+        J, I - cell indices of each point (-1 for points outside the grid)
+        Z - point values
+        shape - grid shape (ny, nx)
+        stat - 'mean', 'sum', 'min', 'max', 'median' or 'count'
+
+    Returns:
+        Zbin [ny, nx] - NaN in empty cells (zero for 'sum' and 'count')
+        N [ny, nx] - number of points in each cell
+    """
+    ind = np.where((J>=0) & (I>=0), J*shape[1] + I, -1)
+    Zbin, N = bin_stats(ind, Z, shape[0]*shape[1], stat=stat)
+
+    return Zbin.reshape(shape), N.reshape(shape)
 
 def tile_vector(count,chunks):
     dx = count//chunks
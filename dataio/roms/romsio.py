@@ -12,16 +12,19 @@ import numpy as np
 from netCDF4 import Dataset, MFDataset, num2date
 from datetime import datetime, timedelta
 import matplotlib.pyplot as plt
-from scipy import interpolate
+from scipy import interpolate, spatial
 import operator
+import os
 
 # Private modules
-from soda.utils.interpXYZ import interpXYZ
+from soda.utils.interpXYZ import interpXYZ, cached_interpXYZ, ColumnInterp, coord_hash
 from soda.utils import othertime
+from soda.utils.parallel import parallel_map
 from soda.utils.timeseries import timeseries
 from soda.utils.maptools import ll2lcc
-from soda.utils.mygeometry import MyLine
+from soda.utils.mygeometry import MyLine, perpendicular_transects
 from soda.dataio.datadownload.mythredds import MFncdap
+import xray
 
 try:
     from octant.slice import isoslice
@@ -34,6 +37,10 @@ class ROMSGrid(object):
     """
     Class for ROMS grid
     """
+    # Cache the projected grid coordinates on disk
+    gridcache = True
+    cachedir = None # Defaults to '.gridcache' in the grid file folder
+
     def __init__(self,ncfile):
         self.grdfile = ncfile
         
@@ -199,35 +206,83 @@ class ROMSGrid(object):
         """
         Return the J,I indices of the nearst grid cell to x,y
         """
+        J, I = self.findNearestIJ(x,y,grid=grid)
         
-        if grid == 'rho':
-            lon = self.lon_rho
-            lat = self.lat_rho
-        elif grid == 'u':
-            lon = self.lon_u
-            lat = self.lat_u
-        elif grid =='v':
-            lon = self.lon_v
-            lat = self.lat_v
-        elif grid =='psi':
-            lon = self.lon_psi
-            lat = self.lat_psi
-            
-        dist = np.sqrt( (lon - x)**2 + (lat - y)**2)
-        
-        return np.argwhere(dist==dist.min())
+        return np.array([J,I]).T
+
+    def findNearestIJ(self,x,y,grid='rho'):
+        """
+        Return the J,I indices of the nearest grid cells to each of the
+        points in x,y (arrays)
+
+        Uses a KD-tree that is built once for each grid type
+        """
+        if not self.__dict__.has_key('_kdtree'):
+            self._kdtree = {}
+
+        lon = getattr(self,'lon_%s'%grid)
+        if not self._kdtree.has_key(grid):
+            lat = getattr(self,'lat_%s'%grid)
+            self._kdtree[grid] = spatial.cKDTree(np.vstack((lon.ravel(),lat.ravel())).T)
+
+        xy = np.vstack((np.ravel(x),np.ravel(y))).T
+        dist, ind = self._kdtree[grid].query(xy)
+
+        return np.unravel_index(ind, lon.shape)
         
     def utmconversion(self,lon,lat,utmzone,isnorth):
         """
         Convert the ROMS grid to utm coordinates
+
+        The projected coordinates are cached in memory and on disk (see
+        gridcache and cachedir) so the grid is only projected once.
         """
-        from maptools import ll2utm
+        if not self.__dict__.has_key('_utm'):
+            self._utm = {}
+
+        key = coord_hash(lon,lat,utmzone,isnorth)
+        if self._utm.has_key(key):
+            return self._utm[key]
+
+        cachefile = self._gridcache_file('utm_%s.npz'%key)
+        if cachefile is not None and os.path.isfile(cachefile):
+            cache = np.load(cachefile)
+            self._utm[key] = cache['x'], cache['y']
+            return self._utm[key]
+
+        from soda.utils.maptools import ll2utm
         
         M,N = lon.shape
         
         xy = ll2utm(np.hstack((np.reshape(lon,(M*N,1)),np.reshape(lat,(M*N,1)))),utmzone,north=isnorth)
         
-        return np.reshape(xy[:,0],(M,N)), np.reshape(xy[:,1],(M,N)) 
+        self._utm[key] = np.reshape(xy[:,0],(M,N)), np.reshape(xy[:,1],(M,N)) 
+
+        if cachefile is not None:
+            try:
+                if not os.path.isdir(os.path.dirname(cachefile)):
+                    os.makedirs(os.path.dirname(cachefile))
+                np.savez(cachefile, x=self._utm[key][0], y=self._utm[key][1])
+            except (IOError, OSError):
+                print 'Warning could not write the grid cache to: %s'%cachefile
+
+        return self._utm[key]
+
+    def _gridcache_file(self,name):
+        """
+        Path of a grid cache file or None if caching is off (or the grid
+        is not a local file)
+        """
+        if not self.gridcache:
+            return None
+
+        cachedir = self.cachedir
+        if cachedir is None:
+            if not isinstance(self.grdfile, basestring) or not os.path.isfile(self.grdfile):
+                return None
+            cachedir = os.path.join(os.path.dirname(os.path.abspath(self.grdfile)), '.gridcache')
+
+        return os.path.join(cachedir, name)
         
         
 class ROMS(ROMSGrid):
@@ -297,7 +352,7 @@ class ROMS(ROMSGrid):
         Loads model data from the netcdf file
         """
         
-        if varname == None:
+        if varname is None:
             varname=self.varname
 
             self._checkCoords(varname)
@@ -307,7 +362,7 @@ class ROMS(ROMSGrid):
             if self.ndim == 4:
                 self._checkVertCoords(varname)
             
-        if tstep == None:
+        if tstep is None:
             tstep = self.tstep
             
         if self.ndim==1:
@@ -350,7 +405,7 @@ class ROMS(ROMSGrid):
         Set z=None to load all layers, else load depth
         """
         
-        if varname == None:
+        if varname is None:
             self.varname = self.varname
         else:
             self.varname = varname
@@ -359,14 +414,14 @@ class ROMS(ROMSGrid):
                      
         if self.ndim == 4:
             self._checkVertCoords(self.varname)
-            if z == None:
+            if z is None:
                 self.zlayer=False
                 self.K = [-99]
             else:
                 self.zlayer=True
                 self.K = [z]
                 
-        if trange==None:
+        if trange is None:
             tstep=np.arange(0,self.Nt)
         
         # Set the index range to grab            
@@ -385,6 +440,142 @@ class ROMS(ROMSGrid):
             Zout = get_depth(self.S,self.C,self.hc,h,zeta=zeta, Vtransform=self.Vtransform).squeeze()
      
         return self.loadData(varname=varname,tstep=tstep), Zout
+
+    def loadStations(self,x,y,varnames=None,tstep=None,chunksize=24):
+        """
+        Load time series of several variables at many stations at once
+
+        The nearest grid points are found with a KD-tree for each grid type
+        and each chunk of 'chunksize' time steps is read once for all of the
+        stations.
+
+        Inputs:
+            x, y - station coordinates (same units as lon_rho/lat_rho)
+            varnames - list of variable names (default [self.varname])
+            tstep - list of time steps (default all)
+
+        Returns:
+            xray.Dataset with dimensions ('time', [s_rho/s_w,] 'station').
+            The depths 'z_rho' (and 'z_w') are calculated at the nearest rho
+            points from zeta and h.
+        """
+        if varnames is None:
+            varnames = [self.varname]
+        if tstep is None:
+            tstep = range(0,self.Nt)
+        tstep = np.asarray(tstep)
+
+        x = np.atleast_1d(x)
+        y = np.atleast_1d(y)
+        Ns = x.shape[0]
+
+        # Find the grid type and dimensions of each variable
+        vardims = {}
+        for vv in varnames:
+            coords = self.varcoords[vv].split()
+            if coords[0][-3:] == 'rho':
+                grid = 'rho'
+            elif coords[0][-3:] == 'n_u':
+                grid = 'u'
+            elif coords[0][-3:] == 'n_v':
+                grid = 'v'
+            else:
+                grid = 'psi'
+
+            ndim = len(coords)
+            if ndim == 4:
+                dims = ('time',coords[2],'station')
+            elif ndim == 3:
+                dims = ('time','station')
+            else:
+                dims = ('station',)
+            vardims[vv] = (grid, ndim, dims)
+
+        zcoords = set([vardims[vv][2][1] for vv in varnames if vardims[vv][1]==4])
+
+        # Locate all of the stations on each grid
+        JI = {}
+        for grid in set([vardims[vv][0] for vv in varnames] + ['rho']):
+            JI[grid] = self.findNearestIJ(x, y, grid=grid)
+
+        def read_points(varname, grid, t1, t2, ndim):
+            """Read the station points of a variable for time steps t1:t2"""
+            J, I = JI[grid]
+            # Read the bounding box or the rows/columns that are needed,
+            # whichever is smaller
+            if (J.ptp()+1)*(I.ptp()+1) <= np.unique(J).size*np.unique(I).size:
+                Ju = slice(J.min(), J.max()+1)
+                Iu = slice(I.min(), I.max()+1)
+                jj, ii = J-J.min(), I-I.min()
+            else:
+                Ju, jj = np.unique(J, return_inverse=True)
+                Iu, ii = np.unique(I, return_inverse=True)
+
+            var = self.nc.variables[varname]
+            if ndim == 4:
+                data = var[tstep[t1:t2],:,Ju,Iu]
+            elif ndim == 3:
+                data = var[tstep[t1:t2],Ju,Iu]
+            else:
+                data = var[Ju,Iu]
+
+            return data[...,jj,ii]
+
+        # Read the data one chunk of time steps at a time
+        Nt = tstep.shape[0]
+        data = {}
+        for vv in varnames:
+            grid, ndim, dims = vardims[vv]
+            if ndim == 2:
+                data[vv] = read_points(vv, grid, 0, Nt, ndim)
+
+        needzeta = len(zcoords) > 0
+        zeta = np.zeros((Nt,Ns))
+        for t1, t2 in time_chunks(Nt, chunksize):
+            print 'Reading time steps %d to %d of %d...'%(t1,t2,Nt)
+            if needzeta:
+                zeta[t1:t2,:] = read_points('zeta', 'rho', t1, t2, 3)
+
+            for vv in varnames:
+                grid, ndim, dims = vardims[vv]
+                if ndim < 3:
+                    continue
+                if not data.has_key(vv):
+                    data[vv] = np.zeros((Nt,) + self.nc.variables[vv].shape[1:-2] + (Ns,))
+                if vv == 'zeta' and needzeta:
+                    data[vv][t1:t2,...] = zeta[t1:t2,:]
+                else:
+                    data[vv][t1:t2,...] = read_points(vv, grid, t1, t2, ndim)
+
+        # Calculate the depths of all stations and time steps in one call
+        J, I = JI['rho']
+        h = self.h[J,I]
+        ds = {}
+        if 's_rho' in zcoords:
+            z = get_depth(self.s_rho,self.Cs_r,self.hc,h,zeta=zeta,Vtransform=self.Vtransform)
+            ds['z_rho'] = (('time','s_rho','station'), z)
+        if 's_w' in zcoords:
+            z = get_depth(self.s_w,self.Cs_w,self.hc,h,zeta=zeta,Vtransform=self.Vtransform)
+            ds['z_w'] = (('time','s_w','station'), z)
+
+        for vv in varnames:
+            grid, ndim, dims = vardims[vv]
+            attrs = {}
+            for aa in ['long_name','units']:
+                if hasattr(self.nc.variables[vv], aa):
+                    attrs[aa] = getattr(self.nc.variables[vv], aa)
+            ds[vv] = (dims, np.ma.filled(data[vv], np.nan), attrs)
+
+        coords = {'time':self.time[tstep],\
+            'station':np.arange(Ns),\
+            'x':('station',x),\
+            'y':('station',y),\
+            }
+        for grid in JI.keys():
+            coords['J_%s'%grid] = ('station',JI[grid][0])
+            coords['I_%s'%grid] = ('station',JI[grid][1])
+
+        return xray.Dataset(ds, coords=coords)
         
     def calcDepth(self,zeta=None):
         """
@@ -402,67 +593,99 @@ class ROMS(ROMSGrid):
          
         return get_depth(self.S,self.C,self.hc,h,zeta=zeta, Vtransform=self.Vtransform).squeeze()
         
-    def depthInt(self,var,grid='rho', z_w=None, cumulative=False):
+    def depthInt(self,var,grid='rho', z_w=None, cumulative=False, zeta=None):
         """
-        Depth-integrate data in variable, var (array [Nz, Ny, Nx])
+        Depth-integrate data in variable, var (array [Nz, Ny, Nx] or a block
+        of time steps [Nt, Nz, Ny, Nx])
         
         Set cumulative = True for cumulative integration i.e. for pressure calc.
+
+        zeta [Nt, Ny, Nx] (optional) includes the free surface in the layer
+        thicknesses.
         """
         
         sz = var.shape
-        if not sz[0] == self.Nz:
-            raise Exception, 'length of dimension 0 must equal %d (currently %d)'%(self.Nz,sz[0])
-        
-        if not len(sz)==3:
-            raise Exception, 'only 3-D arrays are supported.'
+        if not len(sz) in [3,4]:
+            raise Exception, 'only 3-D and 4-D arrays are supported.'
+
+        if not sz[-3] == self.Nz:
+            raise Exception, 'length of dimension %d must equal %d (currently %d)'%(len(sz)-3,self.Nz,sz[-3])
           
-        if grid == 'rho':
-            h = self.h
-        elif grid == 'psi':
-            h = 0.5 * (self.h[1:,1:] + self.h[0:-1,0:-1])
-        elif grid == 'u':
-            h = 0.5 * (self.h[:,1:] + self.h[:,0:-1])
-        elif grid == 'v':
-            h = 0.5 * (self.h[1:,:] + self.h[0:-1,:])
-            
         if z_w is None:
-            z_w = get_depth(self.s_w,self.Cs_w,self.hc,h,Vtransform=self.Vtransform).squeeze()
+            h = self._to_grid(self.h, grid)
+            z_w = get_depth(self.s_w,self.Cs_w,self.hc,h,zeta=zeta,Vtransform=self.Vtransform)
         
-        dz = np.diff(z_w,axis=0)
+        dz = np.diff(z_w,axis=-3)
         
         if cumulative:
-            return np.cumsum(dz*var,axis=0)
+            return np.cumsum(dz*var,axis=-3)
         else:
-            return np.sum(dz*var,axis=0)
+            return np.sum(dz*var,axis=-3)
         
-    def depthAvg(self, var, grid='rho', z_w=None):
+    def depthAvg(self, var, grid='rho', z_w=None, zeta=None):
         """
-        Depth-average data in variable, var (array [Nz, Ny, Nx])
+        Depth-average data in variable, var (array [Nz, Ny, Nx] or
+        [Nt, Nz, Ny, Nx])
         """
         
         sz = var.shape
-        if not sz[0] == self.Nz:
-            raise Exception, 'length of dimension 0 must equal %d (currently %d)'%(self.Nz,sz[0])
-        
-        if not len(sz)==3:
-            raise Exception, 'only 3-D arrays are supported.'
+        if not len(sz) in [3,4]:
+            raise Exception, 'only 3-D and 4-D arrays are supported.'
+
+        if not sz[-3] == self.Nz:
+            raise Exception, 'length of dimension %d must equal %d (currently %d)'%(len(sz)-3,self.Nz,sz[-3])
           
-        if grid == 'rho':
-            h = self.h
-        elif grid == 'psi':
-            h = 0.5 (self.h[1:,1:] + self.h[0:-1,0:-1])
-        elif grid == 'u':
-            h = 0.5 (self.h[:,1:] + self.h[:,0:-1])
-        elif grid == 'v':
-            h = 0.5 (self.h[1:,:] + self.h[0:-1,:])
-            
         if z_w is None:
-            z_w = get_depth(self.s_w,self.Cs_w,self.hc,h,Vtransform=self.Vtransform).squeeze()
+            h = self._to_grid(self.h, grid)
+            z_w = get_depth(self.s_w,self.Cs_w,self.hc,h,zeta=zeta,Vtransform=self.Vtransform)
         
-        dz = np.diff(z_w,axis=0)
+        dz = np.diff(z_w,axis=-3)
         
-        return np.sum(dz*var,axis=0) / h
+        return np.sum(dz*var,axis=-3) / np.sum(dz,axis=-3)
+
+    def depthIntSeries(self, varname, tstep=None, chunksize=24, avg=False, **kwargs):
+        """
+        Depth-integrate (or average with avg=True) a 4-D variable over many
+        time steps
+
+        The output is read and integrated in blocks of chunksize steps with
+        the free surface included in the layer thicknesses.
+
+        Returns an array [Nt, Ny, Nx]
+        """
+        if tstep is None:
+            tstep = range(len(self.time))
+
+        self._checkCoords(varname)
+        self._checkVertCoords(varname)
+        grid = self.gridtype
+
+        out = []
+        for t1,t2 in time_chunks(len(tstep), chunksize):
+            tt = tstep[t1:t2]
+            var = self.nc.variables[varname][tt,...]
+            zeta = self._to_grid(self.nc.variables['zeta'][tt,...], grid)
+
+            if avg:
+                out.append(self.depthAvg(var, grid=grid, zeta=zeta, **kwargs))
+            else:
+                out.append(self.depthInt(var, grid=grid, zeta=zeta, **kwargs))
+
+        return np.concatenate(out, axis=0)
         
+    def _to_grid(self, phi, grid):
+        """
+        Average a rho-point array [..., Ny, Nx] onto the psi, u or v points
+        """
+        if grid == 'rho':
+            return phi
+        elif grid == 'psi':
+            return 0.5 * (phi[...,1:,1:] + phi[...,0:-1,0:-1])
+        elif grid == 'u':
+            return 0.5 * (phi[...,:,1:] + phi[...,:,0:-1])
+        elif grid == 'v':
+            return 0.5 * (phi[...,1:,:] + phi[...,0:-1,:])
+
     def get_dxdy(self,grid):
 
         """
@@ -485,11 +708,11 @@ class ROMS(ROMSGrid):
 
     def gradH(self, phi, grid='rho'):
         """
-        Compute the horizontal gradient of a variable
+        Compute the horizontal gradient of a variable, phi [..., Ny, Nx]
         """
         dx, dy = self.get_dxdy(grid)
 
-        dphi_y, dphi_x = np.gradient(phi)
+        dphi_y, dphi_x = np.gradient(phi, axis=(-2,-1))
 
         return dphi_x/dx, dphi_y/dy
 
@@ -502,114 +725,137 @@ class ROMS(ROMSGrid):
         A = dx*dy
         return np.sum(var*A)
         
-    def gradZ(self,var,grid='rho',cumulative=False):
+    def gradZ(self,var,grid='rho',cumulative=False, z_r=None, zeta=None):
         """
-        Depth-gradient of data in variable, var (array [Nz, Ny, Nx])
+        Depth-gradient of data in variable, var (array [Nz, Ny, Nx] or
+        [Nt, Nz, Ny, Nx])
         
         """
         
-        sz = var.shape
-        #print sz
-        if not sz[0] == self.Nz:
-            raise Exception, 'length of dimension 0 must equal %d (currently %d)'%(self.Nz,sz[0])
-        
-       
         h = self.h[self.JRANGE[0]:self.JRANGE[1],self.IRANGE[0]:self.IRANGE[1]].squeeze()            
-        z_r = get_depth(self.s_rho,self.Cs_r,self.hc,h,Vtransform=self.Vtransform).squeeze()
+        if z_r is None:
+            z_r = get_depth(self.s_rho,self.Cs_r,self.hc,h,zeta=zeta,Vtransform=self.Vtransform)
+        nh = h.ndim
                 
-        dz = np.diff(z_r,axis=0)
-        dz_mid = 0.5 * (dz[1:,...] + dz[0:-1,...]) # N-2
+        # The vertical axis is the one in front of the horizontal axes
+        def k(sl):
+            return (Ellipsis, sl) + (slice(None),)*nh
+
+        sz = var.shape
+        if not sz[-nh-1] == self.Nz:
+            raise Exception, 'length of dimension %d must equal %d (currently %d)'%(len(sz)-nh-1,self.Nz,sz[-nh-1])
+        
+        dz = np.diff(z_r,axis=-nh-1)
+        dz_mid = 0.5 * (dz[k(slice(1,None))] + dz[k(slice(0,-1))]) # N-2
         
-        var_mid =  0.5 * (var[1:,...] + var[0:-1,...])
+        var_mid =  0.5 * (var[k(slice(1,None))] + var[k(slice(0,-1))])
         
-        dv_dz = np.zeros(sz)
+        dv_dz = np.zeros(np.broadcast(var, z_r).shape)
         # 2-nd order mid-points
-        dv_dz[1:-1,...] = (var_mid[1:,...] - var_mid[0:-1,...]) / dz_mid
+        dv_dz[k(slice(1,-1))] = (var_mid[k(slice(1,None))] - var_mid[k(slice(0,-1))]) / dz_mid
         # 1st order end points
-        dv_dz[0,...] = (var[1,...] - var[0,...]) / dz[0,...]
-        dv_dz[-1,...] = (var[-1,...] - var[-2,...]) / dz[-1,...]
+        dv_dz[k(0)] = (var[k(1)] - var[k(0)]) / dz[k(0)]
+        dv_dz[k(-1)] = (var[k(-1)] - var[k(-2)]) / dz[k(-1)]
         
         return dv_dz
 
     def vorticity(self, u, v):
         """
-        Calculate the horizontal vorticity field 
+        Calculate the horizontal vorticity field (u and v may have leading
+        time and depth dimensions)
         """
 
         dudx, dudy = self.gradH(u, grid='u')
         dvdx, dvdy = self.gradH(v, grid='v')
 
-        return   0.5*( dvdx[:,1:] + dvdx[:,0:-1]) - \
-            0.5*( dudy[1:,:] + dudy[0:-1,:]) 
+        return   0.5*( dvdx[...,:,1:] + dvdx[...,:,0:-1]) - \
+            0.5*( dudy[...,1:,:] + dudy[...,0:-1,:]) 
 
-    def MLD(self,tstep,thresh=-0.006,z_max=-20.0):
+    def MLD(self,tstep,thresh=-0.006,z_max=-20.0,zeta=None):
         """
         Mixed layer depth calculation
         
         thresh is the density gradient threshold
         z_max is the min mixed layer depth 
+
+        tstep can be a list of time steps in which case the whole block is
+        processed at once and mld is [Nt, Ny, Nx]
+
+        zeta is read for the same time steps unless it is given.
         """
-        
+        h = self.h[self.JRANGE[0]:self.JRANGE[1],self.IRANGE[0]:self.IRANGE[1]]
+        if zeta is None:
+            zeta = self.loadData(varname='zeta',tstep=tstep)
+
         # Load the density data
         self.K=[-99]
         
-        drho_dz=self.gradZ(self.loadData(varname='rho',tstep=tstep))
-        
-        # Mask drho_dz where z >= z_max
-        z = self.calcDepth()
-        mask = z >= z_max
-        
-        drho_dz[mask] = 0.0
-        #
+        rho = self.loadData(varname='rho',tstep=tstep)
         
-        mld_ind = np.where(drho_dz <= thresh)
+        # Depths of the whole block in one call
+        z = get_depth(self.S,self.C,self.hc,h,zeta=zeta,\
+            Vtransform=self.Vtransform).squeeze()
+        drho_dz = self.gradZ(rho, z_r=z)
         
-        zout = -99999.0*np.ones(z.shape)
-        zout[mld_ind[0],mld_ind[1],mld_ind[2]] = z[mld_ind[0],mld_ind[1],mld_ind[2]]
+        # Shallowest point (below z_max) where the gradient exceeds the
+        # threshold i.e. the base of the mixed layer
+        zout = np.where((drho_dz <= thresh) & (z < z_max), z, -99999.0)
         
-        mld = np.max(zout,axis=0)
+        mld = np.max(zout,axis=-3)
         
         # Isoslice averages when there is more than one value
         #mld = isoslice(z,drho_dz,thresh)
         
-        mld = np.max([mld,-self.h],axis=0)
+        mld = np.maximum(mld,-h.squeeze())
         
         return mld
 
+    def MLDseries(self, tstep=None, chunksize=24, **kwargs):
+        """
+        Mixed layer depth for many time steps
+
+        The density (and zeta) is read and processed chunksize steps at a
+        time.
+
+        Returns an array [Nt, Ny, Nx] (for the JRANGE/IRANGE subset)
+        """
+        if tstep is None:
+            tstep = range(len(self.time))
+        zeta = kwargs.pop('zeta', None)
+
+        mld = None
+        for t1,t2 in time_chunks(len(tstep), chunksize):
+            if zeta is None:
+                mldt = self.MLD(tstep[t1:t2], **kwargs)
+            else:
+                mldt = self.MLD(tstep[t1:t2], zeta=zeta[t1:t2,...], **kwargs)
+
+            # Single time steps are squeezed by loadData
+            if mld is None:
+                sz = mldt.shape[1:] if t2-t1 > 1 else mldt.shape
+                mld = np.zeros((len(tstep),)+sz)
+            mld[t1:t2,...] = mldt.reshape((t2-t1,)+sz)
+
+        return mld
+
     def MLDmask(self,mld,zeta=0.0,grid='rho'):
         """
         Compute a 3D mask for variables beneath the mixed layer
+
+        mld [Nt, Ny, Nx] and zeta [Nt, Ny, Nx] return a mask [Nt, Nz, Ny, Nx]
         """
-        if grid == 'rho':
-            h = self.h
-        elif grid == 'psi':
-            h = 0.5 * (self.h[1:,1:] + self.h[0:-1,0:-1])
-            mld =0.5 * (mld[1:,1:] + mld[0:-1,0:-1]) 
-        elif grid == 'u':
-            h = 0.5 * (self.h[:,1:] + self.h[:,0:-1])
-            mld = 0.5 * (mld[:,1:] + mld[:,0:-1])
-        elif grid == 'v':
-            h = 0.5 * (self.h[1:,:] + self.h[0:-1,:])
-            mld = 0.5 * (mld[1:,:] + mld[0:-1,:])
+        h = self._to_grid(self.h, grid)
+        mld = self._to_grid(mld, grid)
+        if not np.isscalar(zeta):
+            zeta = self._to_grid(zeta, grid)
             
         #if z == None:
         z = -get_depth(self.s_rho,self.Cs_r,self.hc,h,\
-            zeta=zeta, Vtransform=self.Vtransform).squeeze()
-        
-        mask = np.zeros((z.shape[0],)+mld.shape,np.bool)
-        for kk in range(0,z.shape[0]):
-            mask[kk,...] = z[kk,...] >= mld
-        #for jj in range(mld.shape[0]):
-        #    for ii in range(mld.shape[1]):
-        #        #ind = z[:,jj,ii] >= mld[jj,ii]
-        #        ind = z[:,jj,ii] > mld[jj,ii]
-        #        if mld[jj,ii]>=0.:
-        #            mask[ind,jj,ii]=1.0
-        
-        return mask
+            zeta=zeta, Vtransform=self.Vtransform)
         
+        mask = z >= np.expand_dims(mld, -3)
         
-
+        return mask
     def pcolor(self,data=None,titlestr=None,colorbar=True,ax=None,fig=None,**kwargs):
         """
         Pcolor plot of the data in variable
@@ -879,6 +1125,9 @@ class ROMSLagSlice(ROMS):
         # Load the ROMS file
         ROMS.__init__(self,romsfile,**kwargs)
 
+        # Interpolation objects for each grid type (rho/psi/u/v)
+        self._Finterp = {}
+
         # Clip points outside of the time and domain limits
         self._clip_points(x,y,time)
 
@@ -895,57 +1144,69 @@ class ROMSLagSlice(ROMS):
         # Load the data
         self.loadData(varname=varname,tstep=range(self.Nt))
 
-        # Interpolate onto the time step
-        self.slicedata=np.zeros((self.Nt,self.ntrack,self.nwidth))
+        # Interpolate all time steps (and layers) at once
         print 'Interpolating slice data...'
-        for tt in range(self.Nt):
-            #print 'Interpolating step %d of %d...'%(tt,self.Nt)
-            self.slicedata[tt,...]=\
-                self.interp(self.data[tt,...].squeeze())
+        self.slicedata = self.interp(self.data)
 
     def interp(self,phi):
         """
-        Interpolate onto the lagrangian grid
+        Interpolate phi [..., ny, nx] onto the lagrangian grid
+
+        The interpolant for each grid type is built once and reused. Any
+        leading dimensions (time, depth) are interpolated together.
         """
-        if self.xcoord == 'lon_rho':
-            xyout = np.array([self.lonslice.ravel(),self.latslice.ravel()]).T
-            if not self.__dict__.has_key('Frho'):
-                xy = np.array([self.lon_rho.ravel(),self.lat_rho.ravel()]).T
-                Frho = interpXYZ(xy, xyout)
-            F = Frho
-        elif self.xcoord=='lon_psi':
+        F = self._get_interp(self.xcoord.split('_')[-1])
+
+        sz = phi.shape
+        phi = phi.reshape((-1,sz[-2]*sz[-1])).T
+        data = F(phi)
+
+        return data.T.reshape(sz[:-2]+(self.ntrack,self.nwidth))
+
+    def _get_interp(self,grid):
+        """
+        Returns the (cached) interpolation object for grid type 'grid'
+        """
+        if not self._Finterp.has_key(grid):
+            xy = np.array([self['lon_%s'%grid].ravel(),self['lat_%s'%grid].ravel()]).T
             xyout = np.array([self.lonslice.ravel(),self.latslice.ravel()]).T
-            if not self.__dict__.has_key('Fpsi'):
-                xy = np.array([self.lon_psi.ravel(),self.lat_psi.ravel()]).T
-                Fpsi = interpXYZ(xy, xyout)
-            F = Fpsi
+            self._Finterp[grid] = interpXYZ(xy, xyout)
 
-        data = F(phi.ravel())
-        return data.reshape((self.ntrack,self.nwidth))
+        return self._Finterp[grid]
 
     def tinterp(self,dt):
         """
         Interpolate from the lagrangian grid to the timestep along the track
         at t = t0 + dt
+
+        dt can also be an array of offsets. All of them are then
+        interpolated at once and the output has a leading dimension len(dt).
         """
+        dt = np.asarray(dt, dtype=np.float64)
+        t = self.track_tsec[np.newaxis,:] + dt.reshape((-1,1))
+
         # Find the high and low indices
-        tlow = np.zeros((self.ntrack,),np.int16)
-        thigh = np.zeros((self.ntrack,),np.int16)
-        for ii in range(self.ntrack):
-            ind = np.argwhere(self.track_tsec[ii]+dt>=self.tsec)
-            if ind.size>0:
-                tlow[ii]=ind[-1]
-            else:
-                tlow[ii]=0
-            thigh[ii] = min(tlow[ii]+1,self.Nt)
+        tlow = np.searchsorted(self.tsec, t, side='right') - 1
+        tlow = np.clip(tlow, 0, self.Nt-1)
+        thigh = np.minimum(tlow+1, self.Nt-1)
 
         # Calculate the interpolation weights
-        w1 =\
-            (self.track_tsec+dt-self.tsec[tlow])/(self.tsec[thigh]-self.tsec[tlow])
-        w1 = np.repeat(w1[...,np.newaxis],self.nwidth,axis=-1)
+        dtsec = self.tsec[thigh]-self.tsec[tlow]
+        w1 = np.where(dtsec>0, (t-self.tsec[tlow])/np.where(dtsec>0, dtsec, 1.), 0.)
+
+        # Index the block as [ntrack, Nt, ..., nwidth]
+        data = np.rollaxis(self.slicedata, -2, 0)
+        itrack = np.arange(self.ntrack)[np.newaxis,:]
+        w1 = w1.reshape(w1.shape + (1,)*(data.ndim-2))
+
+        out = (1.-w1)*data[itrack,tlow,...] + w1*data[itrack,thigh,...]
 
-        return (1.-w1)*self.slicedata[tlow,range(self.ntrack),:] +\
-            w1*self.slicedata[thigh,range(self.ntrack),:]
+        # Back to [ndt, ..., ntrack, nwidth]
+        out = np.rollaxis(out, 1, out.ndim-1)
+        if dt.ndim == 0:
+            out = out[0,...]
+
+        return out
             
 
     def project(self,lon,lat):
@@ -1022,19 +1283,10 @@ class ROMSLagSlice(ROMS):
         # Compute the normalized distance along the line
         normdist = (self.track_tsec-self.track_tsec[0])\
             /(self.track_tsec[-1]-self.track_tsec[0]) 
-        #P = line.perpendicular(0.4,1.)
-        perplines = [self.centreline.perpline(normdist[ii],width) \
-            for ii in range(self.ntrack)]
 
         self.nwidth=nwidth
-        # Initialize the output coordinates
-        self.lonslice = np.zeros((self.ntrack,self.nwidth))
-        self.latslice = np.zeros((self.ntrack,self.nwidth))
-        for ii,ll in enumerate(perplines):
-            points = ll.multipoint(self.nwidth)
-            for jj,pp in enumerate(points):
-                self.lonslice[ii,jj]=pp.x
-                self.latslice[ii,jj]=pp.y
+        self.lonslice, self.latslice = perpendicular_transects(\
+            self.track_x, self.track_y, normdist, width, self.nwidth)
 
     def _project_coords(self):
         """
@@ -1068,26 +1320,6 @@ class ROMSLagSlice(ROMS):
 
         self.Ycross,self.Xalong =np.meshgrid(acrossdist,along_dist)
 
-    def interp(self,phi):
-        """
-        Interpolate onto the lagrangian grid
-        """
-        if self.xcoord == 'lon_rho':
-            xyout = np.array([self.lonslice.ravel(),self.latslice.ravel()]).T
-            if not self.__dict__.has_key('Frho'):
-                xy = np.array([self.lon_rho.ravel(),self.lat_rho.ravel()]).T
-                Frho = interpXYZ(xy, xyout)
-            F = Frho
-        elif self.xcoord=='lon_psi':
-            xyout = np.array([self.lonslice.ravel(),self.latslice.ravel()]).T
-            if not self.__dict__.has_key('Fpsi'):
-                xy = np.array([self.lon_psi.ravel(),self.lat_psi.ravel()]).T
-                Fpsi = interpXYZ(xy, xyout)
-            F = Fpsi
-
-        data = F(phi.ravel())
-        return data.reshape((self.ntrack,self.nwidth))
-
 
 
 class ROMSslice(ROMS):
@@ -1120,19 +1352,12 @@ class ROMSslice(ROMS):
         Nk = len(self.K)
 
         # Interpolate onto the output data
-        data = np.zeros((Nt,Nk,self.nslice))
         if ndim == 2:
             return self.F(dataslice.ravel())
-        elif Nt>1 and Nk==1:
-            for tt in range(Nt):
-                data[tt,:,:] = self.F(dataslice[tt,:,:].ravel())
-        elif Nk>1 and Nt==1:
-            for kk in range(Nk):
-                data[:,kk,:] = self.F(dataslice[:,kk,:].ravel())
-        else: # 4D array
-            for kk in range(Nk):
-                for tt in range(Nt):
-                    data[tt,kk,:] = self.F(dataslice[tt,kk,:,:].ravel())
+
+        # All time steps and layers at once
+        data = self.F(dataslice.reshape((-1,self.xy.shape[0])).T).T
+        data = data.reshape((Nt,Nk,self.nslice))
 
         data[data>1e36]=0.
         return data.squeeze()
@@ -1250,6 +1475,16 @@ class roms_timeseries(ROMS, timeseries):
         else:
             self.__dict__[key]=value
 
+def roms_stations(ncfile,x,y,varnames=['zeta','temp','salt'],tstep=None,chunksize=24):
+    """
+    Extract time series of varnames at all of the stations x,y
+
+    Returns an xray.Dataset with a 'station' dimension (see ROMS.loadStations)
+    """
+    roms = ROMS(ncfile,varname=varnames[0])
+
+    return roms.loadStations(x,y,varnames=varnames,tstep=tstep,chunksize=chunksize)
+
                             
 
 class roms_subset(ROMSGrid):
@@ -1257,6 +1492,20 @@ class roms_subset(ROMSGrid):
     Class for subsetting ROMS output
     """
     gridfile = None
+
+    # Parallel options
+    numprocs = 1 # Number of worker processes
+    chunksize = 24 # Number of time steps per chunk
+
+    # Output file options
+    ncformat = 'NETCDF4_CLASSIC'
+    zlib = True # Compress the output (netcdf4 formats only)
+    complevel = 4
+    shuffle = True
+    float32 = False # Store the data variables as single precision
+    tile = 64 # Horizontal chunk size of the output variables
+
+    datavars = ['ocean_time','zeta','temp','salt','u','v']
     
     def __init__(self,ncfiles,bbox,timelims,**kwargs):
         self.__dict__.update(kwargs)
@@ -1281,7 +1530,7 @@ class roms_subset(ROMSGrid):
         ind1 = othertime.findNearest(self.t1,ftime.time)
         
         self.time = ftime.time[ind0:ind1]
-        self.tind,self.fname = ftime(self.time) # list of time indices and corresponding files
+        self.tind,self.fname,_ = ftime(self.time) # list of time indices and corresponding files
         
         self.Nt = len(self.tind)
         
@@ -1342,6 +1591,9 @@ class roms_subset(ROMSGrid):
         self.h = self.h[self.J0:self.J1,self.I0:self.I1]
         self.angle = self.angle[self.J0:self.J1,self.I0:self.I1]
 
+        # The KD-trees were built on the full grid
+        self._kdtree = {}
+
     def ReadVertCoords(self):
         """
         
@@ -1379,10 +1631,90 @@ class roms_subset(ROMSGrid):
         self.v = nc.variables['v'][t0,:,self.J0:self.J1,self.I0:self.I1-1]
         
         nc.close()
+
+    def ReadChunk(self, t1, t2):
+        """
+        Reads time steps t1 to t2-1 with one read per variable for each
+        run of consecutive time steps in a file
+
+        Returns t1 and a dictionary of data arrays [t2-t1, ...]
+        """
+        print 'Reading data from %s to %s...'%(datetime.strftime(self.time[t1],'%Y-%m-%d %H:%M:%S'),\
+            datetime.strftime(self.time[t2-1],'%Y-%m-%d %H:%M:%S'))
+
+        window = self._window()
+        data = dict([(vv, []) for vv in self.datavars])
+        for fname, t0, nt in self._file_runs(t1, t2):
+            nc = Dataset(fname)
+            for vv in self.datavars:
+                data[vv].append(nc.variables[vv][(slice(t0,t0+nt),)+window[vv]])
+            nc.close()
+
+        for vv in self.datavars:
+            data[vv] = np.concatenate(data[vv], axis=0)
+
+        return t1, data
+
+    def _window(self):
+        """
+        Spatial index of the subset for each data variable
+        """
+        J0, J1, I0, I1 = self.J0, self.J1, self.I0, self.I1
+        return {'ocean_time':(),\
+            'zeta':(slice(J0,J1),slice(I0,I1)),\
+            'temp':(slice(None),slice(J0,J1),slice(I0,I1)),\
+            'salt':(slice(None),slice(J0,J1),slice(I0,I1)),\
+            'u':(slice(None),slice(J0,J1-1),slice(I0,I1)),\
+            'v':(slice(None),slice(J0,J1),slice(I0,I1-1)),\
+            }
+
+    def _file_runs(self, t1, t2):
+        """
+        Split time steps t1 to t2-1 into runs of consecutive time indices in
+        the same file
+
+        Returns a list of (file name, first time index, number of steps)
+        """
+        runs = []
+        for ii in range(t1,t2):
+            if len(runs) > 0 and self.fname[ii] == runs[-1][0] \
+                    and self.tind[ii] == runs[-1][1]+runs[-1][2]:
+                runs[-1][2] += 1
+            else:
+                runs.append([self.fname[ii], self.tind[ii], 1])
+
+        return [tuple(rr) for rr in runs]
+
+    def _source_chunks(self):
+        """
+        Chunks of time steps of about self.chunksize steps that start on
+        the time chunk boundaries of the source files so that each source
+        chunk is only read (and decompressed) once
+        """
+        nc = Dataset(self.fname[0])
+        chunking = nc.variables['temp'].chunking()
+        nc.close()
+        if chunking is None or chunking == 'contiguous':
+            tchunk = 1
+        else:
+            tchunk = chunking[0]
+
+        bounds = [0]
+        for ii in range(1,self.Nt):
+            if ii-bounds[-1] >= self.chunksize and \
+                    (self.tind[ii] % tchunk == 0 or self.fname[ii] != self.fname[ii-1]):
+                bounds.append(ii)
+        bounds.append(self.Nt)
+
+        return [(t1,t2) for t1,t2 in zip(bounds[:-1],bounds[1:])]
         
     def Writefile(self,outfile,verbose=True):
         """
         Writes subsetted grid and coordinate variables to a netcdf file
+
+        The data variables are compressed (zlib, shuffle) and chunked in
+        blocks of chunksize time steps and tile x tile points for netcdf4
+        output.
         
         Code modified from roms.py in the Octant package
         """
@@ -1397,7 +1729,7 @@ class roms_subset(ROMSGrid):
         el = self.lat_rho[self.mask_rho==1.0].ptp()
         
         # Write ROMS grid to file
-        nc = Dataset(outfile, 'w', format='NETCDF3_CLASSIC')
+        nc = Dataset(outfile, 'w', format=self.ncformat)
         nc.Description = 'ROMS subsetted history file'
         nc.Author = ''
         nc.Created = datetime.now().isoformat()
@@ -1435,8 +1767,18 @@ class roms_subset(ROMSGrid):
             if verbose:
                 print ' ... wrote ', name
                 
-        def create_nc_var(name, dimensions, units=None):
-            nc.createVariable(name, 'f8', dimensions)
+        compress = not self.ncformat.startswith('NETCDF3')
+        tchunk = max(min(self.chunksize, self.Nt), 1)
+
+        def create_nc_var(name, dimensions, units=None, dtype='f8'):
+            if compress and len(dimensions) >= 3:
+                shape = [len(nc.dimensions[dd]) for dd in dimensions]
+                shape[0] = tchunk
+                nc.createVariable(name, dtype, dimensions, zlib=self.zlib,\
+                    complevel=self.complevel, shuffle=self.shuffle,\
+                    chunksizes=nc_chunksizes(shape, self.tile))
+            else:
+                nc.createVariable(name, dtype, dimensions)
             if units is not None:
                 nc.variables[name].units = units
             if verbose:
@@ -1469,12 +1811,16 @@ class roms_subset(ROMSGrid):
         write_nc_var(self.Vtransform, 'Vtransform', ())
         
         # Create the data variables
-        create_nc_var('ocean_time',('ocean_time'),'seconds since 1970-01-01 00:00:00')
-        create_nc_var('zeta',('ocean_time','eta_rho','xi_rho'),'meter')
-        create_nc_var('salt',('ocean_time','s_rho','eta_rho','xi_rho'),'psu')
-        create_nc_var('temp',('ocean_time','s_rho','eta_rho','xi_rho'),'degrees C')
-        create_nc_var('u',('ocean_time','s_rho','eta_u','xi_u'),'meter second-1')
-        create_nc_var('v',('ocean_time','s_rho','eta_v','xi_v'),'meter second-1')
+        create_nc_var('ocean_time',('ocean_time',),'seconds since 1970-01-01 00:00:00')
+        if self.float32:
+            dtype = 'f4'
+        else:
+            dtype = 'f8'
+        create_nc_var('zeta',('ocean_time','eta_rho','xi_rho'),'meter',dtype=dtype)
+        create_nc_var('salt',('ocean_time','s_rho','eta_rho','xi_rho'),'psu',dtype=dtype)
+        create_nc_var('temp',('ocean_time','s_rho','eta_rho','xi_rho'),'degrees C',dtype=dtype)
+        create_nc_var('u',('ocean_time','s_rho','eta_u','xi_u'),'meter second-1',dtype=dtype)
+        create_nc_var('v',('ocean_time','s_rho','eta_v','xi_v'),'meter second-1',dtype=dtype)
         
         nc.close()
         
@@ -1490,14 +1836,30 @@ class roms_subset(ROMSGrid):
         nc.variables['v'][tstep,:,:,:]=self.v
 
         nc.close()
-        
+
+    def WriteChunk(self, t1, data):
+        """
+        Writes a dictionary of data arrays [Nt, ...] starting at time step t1
+        """
+        nc = Dataset(self.outfile, 'a')
+
+        for vv in self.datavars:
+            t2 = t1 + data[vv].shape[0]
+            nc.variables[vv][t1:t2,...] = data[vv]
+
+        nc.close()
+
     def Go(self):
         """
         Downloads and append each time step to a file
+
+        The time steps are read in chunks aligned with the chunking of the
+        source files. With numprocs > 1 the chunks are downloaded in
+        parallel and written to the file in time order.
         """
-        for ii in range(0,self.Nt):
-            self.ReadData(ii)
-            self.Writedata(ii)
+        args = self._source_chunks()
+        for t1, data in parallel_map(self, 'ReadChunk', args, numprocs=self.numprocs):
+            self.WriteChunk(t1, data)
             
         print '##################\nDone!\n##################'
         
@@ -1519,6 +1881,13 @@ class roms_interp(ROMSGrid):
     sill = 0.8
     vrange = 250.0
 
+    # Parallel options
+    numprocs = 1 # Number of worker processes
+    chunksize = 24 # Number of ROMS time steps per chunk
+
+    # Folder to cache the interpolation weights in (None to disable)
+    cachedir = None
+
     def __init__(self,romsfile, xi, yi, zi, timei, **kwargs):
         
         self.__dict__.update(kwargs)
@@ -1540,7 +1909,7 @@ class roms_interp(ROMSGrid):
         ind1 = othertime.findNearest(self.t1,ftime.time)
         
         self.time = ftime.time[ind0:ind1+1]
-        self.tind,self.fname = ftime(self.time) # list of time indices and corresponding files
+        self.tind,self.fname,_ = ftime(self.time) # list of time indices and corresponding files
         
         # Step 2) Prepare the grid variables for the interpolation class
         ROMSGrid.__init__(self,self.romsfile[0])
@@ -1560,10 +1929,12 @@ class roms_interp(ROMSGrid):
         #self.xy_out = np.hstack((xi[...,np.newaxis],yi[...,np.newaxis]))  
         self.xy_out = np.vstack((xi.ravel(),yi.ravel())).T
 
-        self.Frho = interpXYZ(self.xy_rho,self.xy_out,method=self.interpmethod,NNear=self.NNear,\
+        self.Frho = cached_interpXYZ(self.xy_rho,self.xy_out,cachedir=self.cachedir,\
+            method=self.interpmethod,NNear=self.NNear,\
             p=self.p,varmodel=self.varmodel,nugget=self.nugget,sill=self.sill,vrange=self.vrange)
         
-        self.Fuv = interpXYZ(self.xy_uv,self.xy_out,method=self.interpmethod,NNear=self.NNear,\
+        self.Fuv = cached_interpXYZ(self.xy_uv,self.xy_out,cachedir=self.cachedir,\
+            method=self.interpmethod,NNear=self.NNear,\
             p=self.p,varmodel=self.varmodel,nugget=self.nugget,sill=self.sill,vrange=self.vrange)
         
         # Read the vertical coordinate
@@ -1582,70 +1953,22 @@ class roms_interp(ROMSGrid):
             1) Interpolate onto the horizontal coordinates
             2) Interpolate onto the vertical coordinates
             3) Interpolate onto the time coordinates
+
+        Steps 1) and 2) are done on chunks of 'chunksize' ROMS time steps
+        by 'numprocs' worker processes.
         """
         
         # Initialise the output arrays @ roms time step
         zetaroms, temproms, saltroms, uroms, vroms = self.initArrays(self.Nt_roms,self.Nx,self.Nz)
-        
-        tempold = np.zeros((self.Nz_roms,self.Nx))
-        saltold = np.zeros((self.Nz_roms,self.Nx))
-        uold = np.zeros((self.Nz_roms,self.Nx))
-        vold = np.zeros((self.Nz_roms,self.Nx))
 
-        # Interpolate h
-        h = self.Frho(self.h[self.mask_rho==1])
-        
-        # Loop through each time step            
-        for tstep in range(0,self.Nt_roms):
-        
-            # Read all variables
-            self.ReadData(tstep)
-                    
-            # Interpolate zeta
-            if seth:
-                zetaroms[tstep,:] = self.Frho(self.zeta[self.mask_rho==1])
-            
-            # Interpolate other 3D variables
-            for k in range(0,self.Nz_roms):
-                tmp = self.temp[k,:,:]
-                tempold[k,:] = self.Frho(tmp[self.mask_rho==1])
-                
-                tmp = self.salt[k,:,:]
-                saltold[k,:] = self.Frho(tmp[self.mask_rho==1])
-                
-                if setUV:
-                    tmp = self.u[k,:,:]
-                    uold[k,:] = self.Fuv(tmp[self.mask_uv==1])
-                    
-                    tmp = self.v[k,:,:]
-                    vold[k,:] = self.Fuv(tmp[self.mask_uv==1])
-    
-            # Calculate depths (zeta dependent)
-            #zroms = get_depth(self.s_rho,self.Cs_r,self.hc, h, zetaroms[tstep,:], Vtransform=self.Vtransform)
-            zroms = get_depth(self.s_rho,self.Cs_r,self.hc, h, zeta=zetaroms[tstep,:], Vtransform=self.Vtransform)
+        # Loop through each chunk of time steps
+        t1 = 0
+        for chunk in self._map_chunks(zinterp,setUV,seth):
+            t2 = t1 + chunk[0].shape[0]
+            for out, data in zip((zetaroms, temproms, saltroms, uroms, vroms), chunk):
+                out[t1:t2,...] = data
+            t1 = t2
 
-    
-            # Interpolate vertically
-            for ii in range(0,self.Nx):
-                y = tempold[:,ii]
-                Fz = interpolate.interp1d(zroms[:,ii],y,kind=zinterp,bounds_error=False,fill_value=y[0])
-                temproms[tstep,:,ii] = Fz(self.zi)
-                
-                y = saltold[:,ii]
-                Fz = interpolate.interp1d(zroms[:,ii],y,kind=zinterp,bounds_error=False,fill_value=y[0])
-                saltroms[tstep,:,ii] = Fz(self.zi)
-                
-                if setUV:
-                    y = uold[:,ii]
-                    Fz = interpolate.interp1d(zroms[:,ii],y,kind=zinterp,bounds_error=False,fill_value=y[0])
-                    uroms[tstep,:,ii] = Fz(self.zi)
-                    
-                    y = vold[:,ii]
-                    Fz = interpolate.interp1d(zroms[:,ii],y,kind=zinterp,bounds_error=False,fill_value=y[0])
-                    vroms[tstep,:,ii] = Fz(self.zi)
-                    
-                
-            # End time loop
         
         # Initialise the output arrays @ output time step
         
@@ -1685,6 +2008,188 @@ class roms_interp(ROMSGrid):
         
         return zetaout, tempout, saltout, uout, vout
         
+    def interp_chunk(self,t1,t2,zinterp='linear',setUV=True,seth=True):
+        """
+        Interpolates ROMS time steps t1 to t2-1 onto the output points
+        (horizontally) and depths (vertically)
+
+        Returns zeta, temp, salt, u, v at the ROMS time steps
+        """
+        # Initialise the output arrays @ roms time step
+        zetaroms, temproms, saltroms, uroms, vroms = self.initArrays(t2-t1,self.Nx,self.Nz)
+        
+        # Interpolate h
+        h = self.Frho(self.h[self.mask_rho==1])
+        
+        # Loop through each time step            
+        for tstep in range(t1,t2):
+            nn = tstep-t1
+        
+            # Read all variables
+            self.ReadData(tstep)
+                    
+            # Interpolate zeta
+            if seth:
+                zetaroms[nn,:] = self.Frho(self.zeta[self.mask_rho==1])
+            
+            # Interpolate other 3D variables (all layers at once)
+            tempold = self.Frho(self.temp[:,self.mask_rho==1].T).T
+            saltold = self.Frho(self.salt[:,self.mask_rho==1].T).T
+                
+            if setUV:
+                uold = self.Fuv(self.u[:,self.mask_uv==1].T).T
+                vold = self.Fuv(self.v[:,self.mask_uv==1].T).T
+    
+            # Calculate depths (zeta dependent)
+            #zroms = get_depth(self.s_rho,self.Cs_r,self.hc, h, zetaroms[nn,:], Vtransform=self.Vtransform)
+            zroms = get_depth(self.s_rho,self.Cs_r,self.hc, h, zeta=zetaroms[nn,:], Vtransform=self.Vtransform)
+
+    
+            # Interpolate vertically. The weights only depend on zeta so
+            # are shared by all of the variables at this time step.
+            if zinterp in ColumnInterp.kinds:
+                Fz = ColumnInterp(zroms, self.zi, kind=zinterp)
+                temproms[nn,:,:] = Fz(tempold)
+                saltroms[nn,:,:] = Fz(saltold)
+                if setUV:
+                    uroms[nn,:,:] = Fz(uold)
+                    vroms[nn,:,:] = Fz(vold)
+            else:
+                for ii in range(0,self.Nx):
+                    y = tempold[:,ii]
+                    Fz = interpolate.interp1d(zroms[:,ii],y,kind=zinterp,bounds_error=False,fill_value=y[0])
+                    temproms[nn,:,ii] = Fz(self.zi)
+                
+                    y = saltold[:,ii]
+                    Fz = interpolate.interp1d(zroms[:,ii],y,kind=zinterp,bounds_error=False,fill_value=y[0])
+                    saltroms[nn,:,ii] = Fz(self.zi)
+                
+                    if setUV:
+                        y = uold[:,ii]
+                        Fz = interpolate.interp1d(zroms[:,ii],y,kind=zinterp,bounds_error=False,fill_value=y[0])
+                        uroms[nn,:,ii] = Fz(self.zi)
+                    
+                        y = vold[:,ii]
+                        Fz = interpolate.interp1d(zroms[:,ii],y,kind=zinterp,bounds_error=False,fill_value=y[0])
+                        vroms[nn,:,ii] = Fz(self.zi)
+                    
+                
+            # End time loop
+
+        return zetaroms, temproms, saltroms, uroms, vroms
+
+    def interp2nc(self,outfile,zinterp='linear',tinterp='linear',setUV=True,seth=True):
+        """
+        Same as interp() but the output is streamed to the netcdf file
+        'outfile' one chunk of ROMS time steps at a time so only one chunk
+        (per worker) is held in memory.
+
+        Each chunk is interpolated in time together with the last ROMS step
+        of the previous chunk, so only linear time interpolation is
+        supported (use interp() for the other kinds).
+        """
+        if not tinterp == 'linear':
+            raise Exception, "interp2nc only supports tinterp='linear' (not '%s')"%tinterp
+
+        troms = othertime.SecondsSince(self.time)
+        if self.Nt_roms > 1:
+            tout = othertime.SecondsSince(self.timei)
+        else:
+            tout = troms
+
+        varnames = ['temp','salt']
+        if seth:
+            varnames = ['zeta'] + varnames
+        if setUV:
+            varnames += ['u','v']
+
+        nc = self._create_interp_nc(outfile, tout, varnames)
+
+        n0 = 0
+        t1 = 0
+        prev = None
+        for chunk in self._map_chunks(zinterp,setUV,seth):
+            chunk = dict(zip(['zeta','temp','salt','u','v'], chunk))
+            t2 = t1 + chunk['temp'].shape[0]
+
+            if self.Nt_roms > 1:
+                tt = troms[t1:t2]
+                if prev is not None:
+                    tt = troms[t1-1:t2]
+                    for vv in varnames:
+                        chunk[vv] = np.concatenate((prev[vv][-1:,...], chunk[vv]), axis=0)
+
+                # Output times up to the end of this chunk (or all of the
+                # remaining times for the last chunk)
+                if t2 == self.Nt_roms:
+                    n1 = tout.shape[0]
+                else:
+                    n1 = np.searchsorted(tout, tt[-1], side='right')
+
+                if n1 > n0:
+                    print 'Writing output time steps %d to %d of %d...'%(n0,n1,tout.shape[0])
+                    for vv in varnames:
+                        Ft = interpolate.interp1d(tt,chunk[vv],axis=0,kind=tinterp,bounds_error=False)
+                        nc.variables[vv][n0:n1,...] = Ft(tout[n0:n1])
+            else:
+                n1 = 1
+                for vv in varnames:
+                    nc.variables[vv][0:1,...] = chunk[vv]
+
+            nc.sync()
+            prev = chunk
+            n0 = n1
+            t1 = t2
+
+        nc.close()
+        print 'Done writing interpolated ROMS data to:\n\t%s'%outfile
+
+    def _map_chunks(self,zinterp,setUV,seth):
+        """
+        Returns an iterator over the output of interp_chunk for each chunk
+        of ROMS time steps, in time order
+        """
+        # The first chunk needs two steps for the time interpolation
+        chunks = time_chunks(self.Nt_roms, max(self.chunksize,2))
+        args = [(t1,t2,zinterp,setUV,seth) for t1,t2 in chunks]
+
+        return parallel_map(self, 'interp_chunk', args, numprocs=self.numprocs)
+
+    def _create_interp_nc(self,outfile,tout,varnames):
+        """
+        Create the netcdf file for interp2nc
+        """
+        nc = Dataset(outfile, 'w', format='NETCDF4_CLASSIC')
+        nc.Description = 'ROMS output interpolated onto scattered points'
+        nc.Created = datetime.now().isoformat()
+
+        nc.createDimension('time', None)
+        nc.createDimension('Nz', self.Nz)
+        nc.createDimension('Nx', self.Nx)
+
+        coords = {'time':(tout,('time',),'seconds since 1990-01-01 00:00:00'),\
+            'x':(self.xy_out[:,0],('Nx',),'meters'),\
+            'y':(self.xy_out[:,1],('Nx',),'meters'),\
+            'z':(self.zi,('Nz',),'meters'),\
+            }
+        for vv in ['time','x','y','z']:
+            data, dims, units = coords[vv]
+            nc.createVariable(vv, 'f8', dims)
+            nc.variables[vv].units = units
+            nc.variables[vv][:] = data
+
+        units = {'zeta':'meter','temp':'degrees C','salt':'psu',\
+            'u':'meter second-1','v':'meter second-1'}
+        for vv in varnames:
+            if vv == 'zeta':
+                dims = ('time','Nx')
+            else:
+                dims = ('time','Nz','Nx')
+            nc.createVariable(vv, 'f8', dims)
+            nc.variables[vv].units = units[vv]
+
+        return nc
+
     def initArrays(self,Nt,Nx,Nz):
         
         zetaout = np.zeros((Nt,Nx))
@@ -1741,28 +2246,52 @@ class roms_interp(ROMSGrid):
     
            
     
+def nc_chunksizes(shape, tile=64):
+    """
+    Netcdf chunk shape for a variable [Nt, (Nz), Ny, Nx]
+
+    Each chunk holds shape[0] time steps of a single layer on a tile x tile
+    horizontal patch, so that both time series and maps only need to read
+    a few chunks.
+    """
+    chunks = [shape[0]] + [1]*(len(shape)-3) + [min(nn, tile) for nn in shape[-2:]]
+    return [max(cc, 1) for cc in chunks]
+
+def time_chunks(Nt, chunksize):
+    """
+    Returns a list of (t1, t2) index pairs splitting Nt time steps into
+    chunks of at most chunksize steps
+    """
+    chunksize = max(int(chunksize), 1)
+    return [(t1, min(t1+chunksize, Nt)) for t1 in range(0, Nt, chunksize)]
+
 def get_depth(S,C,hc,h,zeta=None, Vtransform=1):
     """
     Calculates the sigma coordinate depth
+
+    Returns z [N, ...] where h has shape [...]. zeta may have extra leading
+    (e.g. time) dimensions, zeta [Nt, ...], in which case z is [Nt, N, ...].
     """
-    if zeta == None:
+    h = np.asarray(h, dtype=np.float64)
+    if zeta is None:
         zeta = 0.0*h
-        
+    zeta = np.asarray(zeta, dtype=np.float64)
+
+    # Vertical coordinate arrays as [N, 1, ..., 1]
     N = len(S)
-    
-    #Nj,Ni = np.size(h)
-    shp = (N,)+h.shape    
-    
-    z = np.zeros(shp)
-    
+    S = np.asarray(S, dtype=np.float64).reshape((N,)+(1,)*h.ndim)
+    C = np.asarray(C, dtype=np.float64).reshape((N,)+(1,)*h.ndim)
+
+    # Insert the vertical axis after any leading dimensions of zeta
+    if zeta.ndim > h.ndim:
+        zeta = np.expand_dims(zeta, zeta.ndim-h.ndim)
+
     if Vtransform == 1:
-        for k in range(0,N):
-            z0 = (S[k]-C[k])*hc + C[k]*h
-            z[k,...] = z0 + (zeta *(1.0 + z0/h))
+        z0 = (S-C)*hc + C*h
+        z = z0 + (zeta *(1.0 + z0/h))
     elif Vtransform == 2:
-        for k in range(0,N):
-            z0 = (hc*S[k]+C[k]*h)/(hc+h)
-            z[k,...] = zeta + (zeta+h)*z0
+        z0 = (hc*S+C*h)/(hc+h)
+        z = zeta + (zeta+h)*z0
     
     return z
         
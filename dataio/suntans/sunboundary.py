@@ -68,6 +68,8 @@ class Boundary(object):
         nugget = 0.1,
         sill = 0.8,
         vrange = 10000.0,
+        sparse = False, # Precompute sparse space-time operators (Interp4D only)
+        cachedir = None, # Folder to cache the horizontal interpolation weights in
     )
  
     
@@ -773,6 +775,8 @@ class InitialCond(Grid):
         nugget = 0.1,
         sill = 0.8,
         vrange = 10000.0,
+        sparse = False, # Precompute sparse space-time operators (Interp4D only)
+        cachedir = None, # Folder to cache the horizontal interpolation weights in
     )
     
    
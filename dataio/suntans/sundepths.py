@@ -12,9 +12,11 @@ import matplotlib.pyplot as plt
 
 from sunpy import Grid
 from soda.dataio.ugrid.gridsearch import GridSearch
-from soda.utils.interpXYZ import Inputs, interpXYZ
+from soda.utils.interpXYZ import Inputs, interpXYZ, cached_interpXYZ
+from soda.utils.tiledinterp import TiledInterp
 from soda.utils.ufilter import ufilter
-from soda.dataio.conversion.dem import DEM
+from soda.utils.binning import bin_stats, cell_reduce
+from soda.dataio.conversion.dem import DEM, TiledDEM
 
 import time
 
@@ -40,6 +42,16 @@ class DepthDriver(object):
     nugget = 0.1
     sill = 0.8
     vrange = 250.0
+
+    # Folder to cache the interpolation weights in (None to disable)
+    cachedir = None
+
+    # Out-of-core interpolation from a point index folder (see
+    # soda.utils.tiledinterp.build_point_index)
+    pointindex = None
+    maxdist = 1000.0 # Search radius and tile halo
+    tilesize = 10000.0
+    numprocs = 1
     
     # Projection conversion info for input data
     convert2utm=False
@@ -55,15 +67,26 @@ class DepthDriver(object):
     smoothnear=5 # No. of points to use for smoothing
     smoothrange = 50.
 
+    # Reduction of the node depths onto each cell with interpnodes ('max' or 'mean')
+    nodereduce = 'max'
+
     # Set if the input data is a DEM
     isDEM = False
+    demres = None # Resolution to sample netcdf DEMs at (None for full resolution)
     
     def __init__(self,depthfile,**kwargs):
         
         self.__dict__.update(kwargs)
         
         # Parse the depth data into an object
-        if self.isDEM:
+        if self.pointindex is not None:
+            print 'Using the point index in: %s'%self.pointindex
+
+        elif self.isDEM and depthfile[-3:]=='.nc':
+            # Only reads the DEM tiles around the grid points
+            self.indata = TiledDEM(depthfile,res=self.demres)
+
+        elif self.isDEM:
             self.indata = DEM(depthfile)
 
         else:
@@ -101,6 +124,9 @@ class DepthDriver(object):
         if self.smooth:
             self.smoothDepths()
         
+        if np.any(np.isnan(self.grd.dv)):
+            raise Exception, '%d cells have no depth'%np.isnan(self.grd.dv).sum()
+
         # Cap the maximum depth
         ind = self.grd.dv<=depthmax
         self.grd.dv[ind]=depthmax
@@ -125,9 +151,18 @@ class DepthDriver(object):
     def interp_depths(self):
 
         # Initialise the Interpolation class
-        if not self.isDEM:
+        if self.pointindex is not None:
+            print 'Interpolating tiles from the point index...'
+            self.F = TiledInterp(self.pointindex,method=self.interpmethod,NNear=self.NNear,\
+                    p=self.p,varmodel=self.varmodel,nugget=self.nugget,sill=self.sill,vrange=self.vrange,\
+                    maxdist=self.maxdist,tilesize=self.tilesize,numprocs=self.numprocs)
+            dv = self.F(self.xy)*self.scalefac
+            dv = self._fill_missing(dv)
+
+        elif not self.isDEM:
             print 'Building interpolant class...'
-            self.F = interpXYZ(self.indata.XY,self.xy,method=self.interpmethod,NNear=self.NNear,\
+            self.F = cached_interpXYZ(self.indata.XY,self.xy,cachedir=self.cachedir,\
+                    method=self.interpmethod,NNear=self.NNear,\
                     p=self.p,varmodel=self.varmodel,nugget=self.nugget,sill=self.sill,vrange=self.vrange)
 
             # Interpolate the data
@@ -139,13 +174,27 @@ class DepthDriver(object):
             dv = self.indata.interp(self.xy[:,0],self.xy[:,1])*self.scalefac
 
         if self.interpnodes:
-            self.grd.dv = np.zeros_like(self.grd.xv)
-            for nn in range(self.grd.Nc):
-                self.grd.dv[nn] = np.max(dv[self.grd.cells[nn,0:self.grd.nfaces[nn] ] ])
-                #self.grd.dv[nn] = np.mean(dv[self.grd.cells[nn,0:self.grd.nfaces[nn] ] ])
+            self.grd.dv = cell_reduce(dv, self.grd.cells, self.grd.nfaces, op=self.nodereduce)
                 
         else:
             self.grd.dv = dv
+
+    def _fill_missing(self, dv):
+        """
+        Fills the points with no data within maxdist (NaN) with the nearest
+        interpolated value
+        """
+        bad = np.isnan(dv)
+        if not bad.any():
+            return dv
+        if bad.all():
+            raise Exception, 'no depth data within maxdist (%f) of the grid'%self.maxdist
+
+        print 'Filling %d of %d points with no data within maxdist...'%(bad.sum(),bad.shape[0])
+        F = interpXYZ(self.xy[~bad,:],self.xy[bad,:],method='nn')
+        dv[bad] = F(dv[~bad])
+
+        return dv
  
     def smoothDepths(self):
         """ 
@@ -227,6 +276,9 @@ class AverageDepth(Grid):
     isnorth=True
     vdatum = 'MSL'
 
+    # Statistic of the depths in each cell: 'mean', 'median', 'min', 'max' or 'count'
+    stat = 'mean'
+
     def __init__(self,suntanspath,**kwargs):
         
         self.__dict__.update(kwargs)
@@ -245,10 +297,16 @@ class AverageDepth(Grid):
             
         tic = time.clock()
         print 'Performing triangle search...'
-        cells = self.tsearch(self.indata.XY[:,0],self.indata.XY[:,1])
+        cells = self.tsearch.locate(self.indata.XY[:,0],self.indata.XY[:,1])
         
         toc = time.clock()
         print 'Search time: %f seconds.'%(toc-tic)
+
+        # Cells without any depths are NaN
+        self.dv, self.count = bin_stats(cells, self.indata.Zin, self.Nc, stat=self.stat)
+        print 'Found depths in %d of %d cells.'%((self.count>0).sum(), self.Nc)
+
+        return self.dv
             
 def adjust_channel_depth(grd,shpfile,lcmax=500.):
     """
@@ -256,48 +314,26 @@ def adjust_channel_depth(grd,shpfile,lcmax=500.):
 
     The shapefile must have an attribute called "contour"
     """
-    from shapely import geometry, speedups
+    from soda.utils.mygeometry import polyline_distance
     from maptools import readShpPointLine
 
-    if speedups.available:
-        speedups.enable()
-
     print 'Adjusting depths in channel regions with a shapefile...'
         
     # Load the shapefile
     xyline,contour = readShpPointLine(shpfile,FIELDNAME='contour')
-    
-    # Load all of the points into shapely type geometry
-    
-    # Distance method won't work with numpy array
-    #P = geometry.asPoint(xy)
-    
-    P = [geometry.Point(grd.xv[i],grd.yv[i]) for i in range(grd.Nc)]
-    
-    L=[]
-    for ll in xyline:
-        L.append(geometry.asLineString(ll))
-     
-    nlines = len(L)
-    weight_all = np.zeros((grd.Nc,nlines))
-    for n in range(nlines):
-        print 'Calculating distance from line %d...'%n
-        
-        dist = [L[n].distance(P[i]) for i in range(grd.Nc)]
-        dist = np.array(dist)
+    contour = np.asarray(contour,dtype=np.float64)
 
-        # Calculate the weight from the distance
-        weight = -dist/lcmax+1.
-        weight[dist>=lcmax]=0.
-        
-        weight_all[:,n] = weight
+    # Distance from each cell centre to each line within lcmax
+    print 'Calculating distances from %d lines...'%len(xyline)
+    ipt, iline, dist = polyline_distance(grd.xv,grd.yv,xyline,lcmax)
+
+    # Calculate the weight from the distance
+    weight = -dist/lcmax+1.
 
     # Now go through and re-calculate the depths
-    dv =  grd.dv*(1-weight_all.sum(axis=-1))
-    for n in range(nlines):
-        dv += weight_all[:,n]*contour[n]
-        
-    grd.dv=dv   
+    wsum = np.bincount(ipt,weights=weight,minlength=grd.Nc)
+    wz = np.bincount(ipt,weights=weight*contour[iline],minlength=grd.Nc)
+    grd.dv = grd.dv*(1-wsum) + wz
     return grd
 
 
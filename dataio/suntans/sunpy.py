@@ -103,6 +103,9 @@ class Grid(object):
 
     VERBOSE=True
 
+    # Cache the ascii grid files in binary format
+    gridcache=True
+
     def __init__(self,infile ,**kwargs):
                
         self.__dict__.update(kwargs)
@@ -139,79 +142,38 @@ class Grid(object):
     def __loadascii(self):
         """
         Load the grid variables from the ascii files: points.dat, edges.dat, cells.dat
+
+        The parsed arrays are cached in binary form in the folder
+        '.gridcache' and memory-mapped on later calls, as long as the ascii
+        files have not changed. Set gridcache=False to disable.
         """
-        pointdata = readTXT(self.infile+'/points.dat')
-        celldata = readTXT(self.infile+'/cells.dat')
-        edgedata = readTXT(self.infile+'/edges.dat')
+        gridvars = None
+        if self.gridcache:
+            gridvars = load_grid_cache(self.infile)
+
+        if gridvars is None:
+            gridvars = read_suntans_ascii(self.infile, fillvalue=self._FillValue)
+            if self.gridcache:
+                try:
+                    save_grid_cache(self.infile, gridvars)
+                except (IOError, OSError):
+                    if self.VERBOSE:
+                        print 'Warning could not write the grid cache to: %s'%self.infile
+
+        for vv in ['xp','yp','xv','yv','cells','neigh','nfaces',\
+                'edges','mark','grad','edge_id']:
+            setattr(self, vv, gridvars[vv])
         
-        self.xp = pointdata[:,0]
-        self.yp = pointdata[:,1]
         #self.dv = pointdata[:,2] # zero to start
         self.Np = len(self.xp)
-        
-        # Work out if cells.dat is in the quad grid format based on number of
-        # columns
-        self.Nc = celldata.shape[0]
-        if celldata.ndim==2:
-            ncols = celldata.shape[1]
-            #print '!!!cells.dat has %d columns!!!'%ncols
-            if ncols==8: # Old format
-                self.xv = celldata[:,0]
-                self.yv = celldata[:,1]
-                self.cells = np.asarray(celldata[:,2:5],int)
-                self.neigh = np.asarray(celldata[:,5:8])
-                self.nfaces = 3*np.ones((self.Nc,),np.int)
-                self.maxfaces=self.MAXFACES
-            elif ncols==9: # New format
-                nfaces = celldata[:,0]
-                self.nfaces = np.zeros((self.Nc,),np.int)
-                self.nfaces[:] = nfaces
-                self.xv = celldata[:,1]
-                self.yv = celldata[:,2]
-                self.cells = np.asarray(celldata[:,3:6],int)
-                self.neigh = np.asarray(celldata[:,6:9])
-                self.nfaces = 3*np.ones((self.Nc,),np.int)
-                self.maxfaces=self.MAXFACES
-
-            elif ncols==11: # Quad grid format
-                nfaces = celldata[:,0]
-                self.nfaces = np.zeros((self.Nc,),np.int)
-                self.nfaces[:] = nfaces
-                self.xv = celldata[:,1]
-                self.yv = celldata[:,2]
-                self.cells = np.asarray(celldata[:,3:7],int)
-                self.neigh = np.asarray(celldata[:,7:11])
-                self.maxfaces=4
-        else: # Uneven number of cells
-            celldata = celldata.tolist()
-            nfaces = [ll[0] for ll in celldata]
-            self.nfaces=np.array(nfaces,np.int)
-            self.maxfaces=self.nfaces.max()
-            self.cells = self._FillValue*np.ones((self.Nc,self.maxfaces),int)
-            self.neigh = self._FillValue*np.ones((self.Nc,self.maxfaces),int)
-            self.xv = np.zeros((self.Nc,))
-            self.yv = np.zeros((self.Nc,))
-            for ii in range(self.Nc):
-                nf = self.nfaces[ii]
-                self.xv[ii] = celldata[ii][1]
-                self.yv[ii] = celldata[ii][2]
-                self.cells[ii,0:nf] = celldata[ii][3:3+nf]
-                self.neigh[ii,0:nf] = celldata[ii][3+nf:3+2*nf]
-
-        
-        self.edges = np.asarray(edgedata[:,0:2],int)
+        self.Nc = self.cells.shape[0]
         self.Ne = self.edges.shape[0]
-        self.mark = np.asarray(edgedata[:,2],int)
-        self.grad = np.asarray(edgedata[:,3:5],int)
-        if np.size(edgedata,1)==6:
-            self.edge_id = np.asarray(edgedata[:,5],int)
-        else:
-            self.edge_id = np.zeros((self.Ne,),int)
+        self.maxfaces = self.cells.shape[1]
         
         # Load the vertical grid info from vertspace.dat if it exists
-        try:
-            vertspace=readTXT(self.infile+'/vertspace.dat')
-        except:
+        if gridvars.has_key('vertspace'):
+            vertspace = gridvars['vertspace']
+        else:
             if self.VERBOSE:
                 print 'Warning could not find vertspace.dat in folder, setting Nkmax=1'
             vertspace=0.0
@@ -3133,6 +3095,170 @@ def readTXT(fname,sep=None):
     
     return data
 
+def readTXTrows(fname):
+    """
+    Fast reader for whitespace delimited text files of numbers
+
+    Returns the values as a flat float array and the number of values on each
+    (non-empty) row, so files with a variable number of columns can be parsed
+    without a python loop over the lines.
+    """
+    fp = open(fname,'rb')
+    txt = fp.read()
+    fp.close()
+
+    vals = np.fromstring(txt, dtype=np.float64, sep=' ')
+
+    # Count the tokens on each line
+    b = np.frombuffer(txt, dtype=np.uint8)
+    isspace = (b==32) | (b==9) | (b==10) | (b==13)
+    tokstart = np.flatnonzero(~isspace & np.hstack(([True],isspace[:-1])))
+    newline = np.flatnonzero(b==10)
+    ntok = np.bincount(np.searchsorted(newline, tokstart),\
+        minlength=newline.size+1)
+    ntok = ntok[ntok>0]
+
+    if ntok.sum() != vals.size:
+        raise Exception('could not parse all of the values in: %s'%fname)
+
+    return vals, ntok
+
+def readTXTcols(fname):
+    """
+    Fast version of readTXT for files with a fixed number of columns
+    """
+    vals, ntok = readTXTrows(fname)
+    if np.any(ntok != ntok[0]):
+        raise Exception('variable number of columns in: %s'%fname)
+
+    return vals.reshape((ntok.size, ntok[0]))
+
+def read_suntans_ascii(suntanspath, fillvalue=FILLVALUE):
+    """
+    Parse the suntans ascii grid files (points.dat, cells.dat, edges.dat and
+    vertspace.dat) into a dictionary of arrays
+
+    Handles the 8 column (triangle), 9 and 11 column (nfaces first) and
+    variable width (hybrid) cells.dat formats.
+    """
+    pointdata = readTXTcols(suntanspath+'/points.dat')
+    edgedata = readTXTcols(suntanspath+'/edges.dat')
+    cellvals, ntok = readTXTrows(suntanspath+'/cells.dat')
+
+    gridvars = {}
+    gridvars['xp'] = pointdata[:,0]
+    gridvars['yp'] = pointdata[:,1]
+
+    Nc = ntok.size
+    if np.all(ntok==8): # Old format (triangles, no nfaces column)
+        celldata = cellvals.reshape((Nc,8))
+        gridvars['nfaces'] = 3*np.ones((Nc,),np.int)
+        gridvars['xv'] = celldata[:,0]
+        gridvars['yv'] = celldata[:,1]
+        gridvars['cells'] = np.asarray(celldata[:,2:5],int)
+        gridvars['neigh'] = np.asarray(celldata[:,5:8],int)
+    else:
+        # Each row: nfaces, xv, yv, nfaces*cells, nfaces*neigh
+        rowstart = np.hstack((0,np.cumsum(ntok)[:-1]))
+        nfaces = cellvals[rowstart].astype(np.int)
+        if np.any(ntok != 3+2*nfaces):
+            raise Exception('inconsistent number of columns in: %s/cells.dat'%suntanspath)
+
+        maxfaces = nfaces.max()
+        nf = np.arange(maxfaces)[np.newaxis,:]
+        mask = nf >= nfaces[:,np.newaxis]
+        cellidx = np.where(mask, 0, rowstart[:,np.newaxis]+3+nf)
+        neighidx = np.where(mask, 0, cellidx+nfaces[:,np.newaxis])
+
+        cells = cellvals[cellidx].astype(int)
+        neigh = cellvals[neighidx].astype(int)
+        cells[mask] = fillvalue
+        neigh[mask] = fillvalue
+
+        gridvars['nfaces'] = nfaces
+        gridvars['xv'] = cellvals[rowstart+1]
+        gridvars['yv'] = cellvals[rowstart+2]
+        gridvars['cells'] = cells
+        gridvars['neigh'] = neigh
+
+    Ne = edgedata.shape[0]
+    gridvars['edges'] = np.asarray(edgedata[:,0:2],int)
+    gridvars['mark'] = np.asarray(edgedata[:,2],int)
+    gridvars['grad'] = np.asarray(edgedata[:,3:5],int)
+    if np.size(edgedata,1)==6:
+        gridvars['edge_id'] = np.asarray(edgedata[:,5],int)
+    else:
+        gridvars['edge_id'] = np.zeros((Ne,),int)
+
+    if os.path.isfile(suntanspath+'/vertspace.dat'):
+        gridvars['vertspace'] = readTXTcols(suntanspath+'/vertspace.dat')
+
+    return gridvars
+
+# Ascii grid files that the binary cache depends on
+suntans_gridfiles = ['points.dat','cells.dat','edges.dat','vertspace.dat']
+
+def _grid_cache_stamp(suntanspath):
+    """
+    Size and modification time of each of the ascii grid files
+    """
+    stamp = []
+    for ff in suntans_gridfiles:
+        fname = os.path.join(suntanspath, ff)
+        if os.path.isfile(fname):
+            st = os.stat(fname)
+            stamp.append([st.st_size, st.st_mtime])
+        else:
+            stamp.append([-1, -1])
+
+    return np.array(stamp, dtype=np.float64)
+
+def save_grid_cache(suntanspath, gridvars):
+    """
+    Save the grid arrays to memory-mappable .npy files in suntanspath/.gridcache
+    """
+    cachedir = os.path.join(suntanspath, '.gridcache')
+    if not os.path.isdir(cachedir):
+        os.mkdir(cachedir)
+
+    # Remove any stale arrays from a previous cache
+    for ff in os.listdir(cachedir):
+        if ff.endswith('.npy'):
+            os.remove(os.path.join(cachedir, ff))
+
+    for vv in gridvars.keys():
+        np.save(os.path.join(cachedir, vv+'.npy'), gridvars[vv])
+
+    # Write the stamp last so that a partial cache is never used
+    np.save(os.path.join(cachedir, 'stamp.npy'), _grid_cache_stamp(suntanspath))
+
+def load_grid_cache(suntanspath):
+    """
+    Load the grid arrays from suntanspath/.gridcache
+
+    The arrays are memory-mapped copy-on-write. Returns None if the cache
+    does not exist or the ascii files have changed since it was written.
+    """
+    cachedir = os.path.join(suntanspath, '.gridcache')
+    stampfile = os.path.join(cachedir, 'stamp.npy')
+    if not os.path.isfile(stampfile):
+        return None
+
+    try:
+        stamp = np.load(stampfile)
+        if not np.array_equal(stamp, _grid_cache_stamp(suntanspath)):
+            return None
+
+        gridvars = {}
+        for ff in os.listdir(cachedir):
+            vv, ext = os.path.splitext(ff)
+            if ext == '.npy' and vv != 'stamp':
+                gridvars[vv] = np.load(os.path.join(cachedir, ff), mmap_mode='c')
+    except (IOError, OSError, ValueError):
+        return None
+
+    return gridvars
+
 def unsurfm(points, cells, z,clim=None,title=None,**kwargs):
     """
     Plot cell-centred data using the mayavi/tvtk libraries
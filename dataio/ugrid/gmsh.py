@@ -311,29 +311,316 @@ def read_msh(mshfile):
     
     return nodes, elements
 
+def read_msh_arrays(mshfile, celltype=None):
+    """
+    Fast reader for gmsh *.msh files
+
+    Parses the $Nodes and $Elements blocks in bulk with numpy. Handles ASCII
+    MSH 2.2, 4.0 and 4.1 and binary MSH 2.2 and 4.1 files.
+
+    Inputs:
+        - mshfile: gmsh file name
+        - celltype: dictionary {gmsh element type: number of faces} of the
+        elements to keep. Default is triangles and quads, {2:3, 3:4}
+    Returns:
+        - xp, yp: nodal coordinates (sorted by node tag)
+        - cells: zero-based node indices of each cell [Nc, maxfaces]
+        - nfaces: number of faces of each cell
+    """
+    if celltype is None:
+        celltype = {2:3,3:4} # lookup table for cell type
+
+    f = open(mshfile,'rb')
+    data = f.read()
+    f.close()
+
+    version, binary, dsize, endian = _msh_format(data)
+    if binary and version == 4.0:
+        raise Exception('binary MSH 4.0 files are not supported')
+
+    if version < 4:
+        if binary:
+            tags, xyz = _msh2_nodes_binary(data, endian)
+            blocks = _msh2_elements_binary(data, endian)
+        else:
+            tags, xyz = _msh2_nodes_ascii(data)
+            blocks = _msh2_elements_ascii(data)
+    else:
+        if binary:
+            tags, xyz = _msh4_nodes_binary(data, endian, dsize)
+            blocks = _msh4_elements_binary(data, endian, dsize)
+        else:
+            tags, xyz = _msh4_nodes_ascii(data, version)
+            blocks = _msh4_elements_ascii(data, version)
+
+    # Sort the nodes by tag and map the tags to zero-based indices
+    order = np.argsort(tags, kind='mergesort')
+    tags = tags[order]
+    xyz = xyz[order,:]
+    node_index = -1*np.ones((tags.max()+1,), np.int64)
+    node_index[tags] = np.arange(tags.shape[0])
+
+    # Only keep the requested element types (in file order)
+    blocks = [(etype, conn) for etype, conn in blocks\
+        if etype in celltype.keys() and conn.shape[0] > 0]
+    if len(blocks) == 0:
+        raise Exception('no elements of type %s in %s'%(celltype.keys(), mshfile))
+
+    Nc = sum([conn.shape[0] for etype, conn in blocks])
+    maxfaces = max([celltype[etype] for etype, conn in blocks])
+
+    cells = np.zeros((Nc,maxfaces),np.int)-999999
+    nfaces = np.zeros((Nc,),np.int)
+    n1 = 0
+    for etype, conn in blocks:
+        nf = celltype[etype]
+        n2 = n1 + conn.shape[0]
+        cells[n1:n2,0:nf] = node_index[conn[:,0:nf]]
+        nfaces[n1:n2] = nf
+        n1 = n2
+
+    return xyz[:,0].copy(), xyz[:,1].copy(), cells, nfaces
+
 def gmsh2hybridgrid(mshfile):
     """
     Convert the gmsh msh file to the hybrid grid class
     """
+    xp, yp, cells, nfaces = read_msh_arrays(mshfile)
 
-    celltype = {2:3,3:4} # lookup table for cell type
+    return HybridGrid(xp,yp,cells,nfaces=nfaces)    
 
-    # Read the raw ascii file    
-    nodes, elements  = read_msh(mshfile)
-    
-    # Get the coordinates
-    x = [nodes[ii]['X'] for ii in nodes.keys()]
-    y = [nodes[ii]['Y'] for ii in nodes.keys()]
-    
-    cells = [elements[ii]['cells'] for ii in elements.keys() if elements[ii]['type'] in celltype.keys()]
-    nfaces = [len(cells[ii]) for ii in range(len(cells))]
-    
-    Nc = len(cells)
-    cellsin = np.zeros((Nc,max(nfaces)),np.int)-999999
-    for ii in range(Nc):
-        cellsin[ii,0:nfaces[ii]]=cells[ii]
+###
+# Fast msh parsing utilities
+###
+
+# Number of nodes for each gmsh element type
+gmsh_nnodes = {1:2, 2:3, 3:4, 4:4, 5:8, 6:6, 7:5, 8:3, 9:6, 10:9, 11:10,\
+    12:27, 13:18, 14:14, 15:1, 16:8, 17:20, 18:15, 19:13, 20:9, 21:10,\
+    22:12, 23:15, 24:15, 25:21, 26:4, 27:5, 28:6, 29:20, 30:35, 31:56}
 
-    return HybridGrid(np.array(x),np.array(y),cellsin,nfaces=nfaces)    
+def _msh_section(data, name):
+    """
+    Returns the byte offsets of the start and end of a $name section
+    """
+    start = data.find('$%s'%name)
+    if start < 0:
+        raise Exception('cannot find section $%s'%name)
+    start = data.find('\n', start) + 1
+    end = data.find('$End%s'%name, start)
+
+    return start, end
+
+def _msh_readline(data, pos):
+    """
+    Returns the ascii line starting at pos and the offset of the next line
+    """
+    end = data.find('\n', pos)
+
+    return data[pos:end], end+1
+
+def _msh_format(data):
+    """
+    Parse the $MeshFormat section
+
+    Returns the version, binary flag, data size and endian character
+    """
+    start, end = _msh_section(data, 'MeshFormat')
+    line, pos = _msh_readline(data, start)
+    ll = line.split()
+    version = float(ll[0])
+    binary = int(ll[1]) == 1
+    dsize = int(ll[2])
+
+    endian = '<'
+    if binary:
+        one = np.frombuffer(data, dtype='<i4', count=1, offset=pos)[0]
+        if one != 1:
+            endian = '>'
+
+    return version, binary, dsize, endian
+
+def _msh_element_runs(T, starts):
+    """
+    Splits a MSH 2.2 ascii element stream into runs of identical records
+
+    Each record is [id, type, ntags, tags..., nodes...] and starts at
+    T[starts]. The run boundaries are found in one pass and consecutive
+    records of the same type and ntags are reshaped in one go.
+    """
+    etype = T[starts+1]
+    ntags = T[starts+2]
+    change = np.flatnonzero((np.diff(etype)!=0) | (np.diff(ntags)!=0)) + 1
+    r0 = np.concatenate(([0], change))
+    r1 = np.concatenate((change, [starts.shape[0]]))
+
+    blocks = []
+    for i0, i1 in zip(r0, r1):
+        et = int(etype[i0])
+        nt = int(ntags[i0])
+        L = 3 + nt + gmsh_nnodes[et]
+        rec = T[starts[i0]:starts[i0]+(i1-i0)*L].reshape((i1-i0,L))
+        blocks.append((et, rec[:,3+nt:]))
+
+    return blocks
+
+def _msh_line_tokens(text):
+    """
+    Returns the number of whitespace separated tokens on each line of text
+    """
+    b = np.frombuffer(text, dtype=np.uint8)
+    space = (b==ord(' ')) | (b==ord('\t')) | (b==ord('\r')) | (b==ord('\n'))
+    tokstart = np.flatnonzero(~space & np.concatenate(([True], space[:-1])))
+    newline = np.flatnonzero(b==ord('\n'))
+
+    return np.bincount(np.searchsorted(newline, tokstart),\
+        minlength=newline.shape[0]+1)
+
+def _msh2_nodes_ascii(data):
+    start, end = _msh_section(data, 'Nodes')
+    T = np.fromstring(data[start:end], dtype=np.float64, sep=' ')
+    Nnode = int(T[0])
+    T = T[1:1+4*Nnode].reshape((Nnode,4))
+
+    return T[:,0].astype(np.int64), T[:,1:4]
+
+def _msh2_elements_ascii(data):
+    start, end = _msh_section(data, 'Elements')
+    T = np.fromstring(data[start:end], dtype=np.int64, sep=' ')
+    Nel = int(T[0])
+
+    # Each record is on its own line, which gives where each one starts
+    ntok = _msh_line_tokens(data[start:end])
+    ntok = ntok[ntok>0]
+    if ntok.sum() != T.shape[0]:
+        raise Exception('could not parse the $Elements section')
+    starts = np.cumsum(ntok) - ntok
+
+    return _msh_element_runs(T, starts[1:1+Nel])
+
+def _msh4_nodes_ascii(data, version):
+    start, end = _msh_section(data, 'Nodes')
+    T = np.fromstring(data[start:end], dtype=np.float64, sep=' ')
+
+    nblocks = int(T[0])
+    p = 4 if version >= 4.1 else 2
+
+    tags = []
+    xyz = []
+    for bb in range(nblocks):
+        if version >= 4.1:
+            dim, tag, param, n = [int(tt) for tt in T[p:p+4]]
+            p += 4
+            ncoord = 3 + dim*param
+            tags.append(T[p:p+n].astype(np.int64))
+            p += n
+            xyz.append(T[p:p+n*ncoord].reshape((n,ncoord))[:,0:3])
+            p += n*ncoord
+        else:
+            tag, dim, param, n = [int(tt) for tt in T[p:p+4]]
+            p += 4
+            ncoord = 3 + dim*param
+            rec = T[p:p+n*(1+ncoord)].reshape((n,1+ncoord))
+            tags.append(rec[:,0].astype(np.int64))
+            xyz.append(rec[:,1:4])
+            p += n*(1+ncoord)
+
+    return np.concatenate(tags), np.concatenate(xyz, axis=0)
+
+def _msh4_elements_ascii(data, version):
+    start, end = _msh_section(data, 'Elements')
+    T = np.fromstring(data[start:end], dtype=np.int64, sep=' ')
+
+    nblocks = int(T[0])
+    p = 4 if version >= 4.1 else 2
+
+    blocks = []
+    for bb in range(nblocks):
+        etype, n = int(T[p+2]), int(T[p+3])
+        p += 4
+        L = 1 + gmsh_nnodes[etype]
+        rec = T[p:p+n*L].reshape((n,L))
+        blocks.append((etype, rec[:,1:]))
+        p += n*L
+
+    return blocks
+
+def _msh2_nodes_binary(data, endian):
+    start, end = _msh_section(data, 'Nodes')
+    line, pos = _msh_readline(data, start)
+    Nnode = int(line)
+    dtype = np.dtype([('tag',endian+'i4'),('xyz',endian+'f8',(3,))])
+    rec = np.frombuffer(data, dtype=dtype, count=Nnode, offset=pos)
+
+    return rec['tag'].astype(np.int64), rec['xyz'].astype(np.float64)
+
+def _msh2_elements_binary(data, endian):
+    start, end = _msh_section(data, 'Elements')
+    line, pos = _msh_readline(data, start)
+    Nel = int(line)
+    i4 = np.dtype(endian+'i4')
+
+    blocks = []
+    while Nel > 0:
+        etype, n, ntags = [int(tt) for tt in\
+            np.frombuffer(data, dtype=i4, count=3, offset=pos)]
+        pos += 3*i4.itemsize
+        L = 1 + ntags + gmsh_nnodes[etype]
+        rec = np.frombuffer(data, dtype=i4, count=n*L, offset=pos)
+        blocks.append((etype, rec.reshape((n,L))[:,1+ntags:].astype(np.int64)))
+        pos += n*L*i4.itemsize
+        Nel -= n
+
+    return blocks
+
+def _msh4_nodes_binary(data, endian, dsize):
+    start, end = _msh_section(data, 'Nodes')
+    i4 = np.dtype(endian+'i4')
+    st = np.dtype(endian+'u%d'%dsize)
+    f8 = np.dtype(endian+'f8')
+
+    pos = start
+    nblocks = int(np.frombuffer(data, dtype=st, count=4, offset=pos)[0])
+    pos += 4*st.itemsize
+
+    tags = []
+    xyz = []
+    for bb in range(nblocks):
+        dim, tag, param = [int(tt) for tt in\
+            np.frombuffer(data, dtype=i4, count=3, offset=pos)]
+        pos += 3*i4.itemsize
+        n = int(np.frombuffer(data, dtype=st, count=1, offset=pos)[0])
+        pos += st.itemsize
+        tags.append(np.frombuffer(data, dtype=st, count=n, offset=pos).astype(np.int64))
+        pos += n*st.itemsize
+        ncoord = 3 + dim*param
+        rec = np.frombuffer(data, dtype=f8, count=n*ncoord, offset=pos)
+        xyz.append(rec.reshape((n,ncoord))[:,0:3].astype(np.float64))
+        pos += n*ncoord*f8.itemsize
+
+    return np.concatenate(tags), np.concatenate(xyz, axis=0)
+
+def _msh4_elements_binary(data, endian, dsize):
+    start, end = _msh_section(data, 'Elements')
+    i4 = np.dtype(endian+'i4')
+    st = np.dtype(endian+'u%d'%dsize)
+
+    pos = start
+    nblocks = int(np.frombuffer(data, dtype=st, count=4, offset=pos)[0])
+    pos += 4*st.itemsize
+
+    blocks = []
+    for bb in range(nblocks):
+        dim, tag, etype = [int(tt) for tt in\
+            np.frombuffer(data, dtype=i4, count=3, offset=pos)]
+        pos += 3*i4.itemsize
+        n = int(np.frombuffer(data, dtype=st, count=1, offset=pos)[0])
+        pos += st.itemsize
+        L = 1 + gmsh_nnodes[etype]
+        rec = np.frombuffer(data, dtype=st, count=n*L, offset=pos)
+        blocks.append((etype, rec.reshape((n,L))[:,1:].astype(np.int64)))
+        pos += n*L*st.itemsize
+
+    return blocks
 
 
 def get_nnodes_from_line( xy, dx):
@@ -260,30 +260,75 @@ class GridSearch(HybridGrid):
     def tsearch(self,xin,yin,MAXNODES=8):
         """
         Vectorized version of tseach
-        
+
+        (MAXNODES is no longer used, see locate)
         """
-        xyin  = np.vstack((xin,yin)).T
-        node =  self.findnearest(xyin)
+        return self.locate(xin,yin)
+
+    def locate(self,xin,yin,NNear=3,chunksize=1000000):
+        """
+        Returns the index of the cell containing each point (-1 if none)
+
+        The candidate cells of each point are the cells around its nearest
+        node, then around the next nearest nodes (up to NNear) for any
+        points not found yet. All of the candidates are tested at once,
+        chunksize points at a time.
+        """
+        xin = np.asarray(xin,dtype=np.float64)
+        yin = np.asarray(yin,dtype=np.float64)
         Np = xin.shape[0]
+        node2cell = self.node_cells()
 
-        cell = -1*np.ones((Np,MAXNODES),dtype=np.int32)
-        for nn in range(Np):
-            p2c = self.my_pnt2cells(node[nn])
-            cell[nn,0:len(p2c)]=p2c
-        #cell = [self.pnt2cells(node[nn]) for nn in range(Np)]
-            
         cellind = -1*np.ones((Np,),dtype=np.int32)
-        for ii in range(MAXNODES):
-            ind = op.and_(cell[:,ii]!=-1,cellind==-1)
-            if any(ind):
-                ind2 = self.inCellVec(cell[ind,ii],xin[ind],yin[ind])
-                
-                ind3=np.where(ind)
-                
-                cellind[ind3[0][ind2]]= cell[ind3[0][ind2],ii]
-    
+        for p0 in range(0,Np,chunksize):
+            x = xin[p0:p0+chunksize]
+            y = yin[p0:p0+chunksize]
+            found = cellind[p0:p0+chunksize]
+
+            todo = np.arange(x.shape[0])
+            for kk in range(min(NNear,self.xp.shape[0])):
+                xy = np.vstack((x[todo],y[todo])).T
+                if kk == 0:
+                    node = self.findnearest(xy)
+                else:
+                    node = self.findnearest(xy,NNear=kk+1)[:,kk]
+
+                cand = node2cell[node,:]
+                for cc in range(cand.shape[1]):
+                    ind = np.flatnonzero((found[todo]==-1) & (cand[:,cc]!=-1))
+                    if ind.size == 0:
+                        continue
+                    inside = self.inCellVec(cand[ind,cc],x[todo[ind]],y[todo[ind]])
+                    found[todo[ind[inside]]] = cand[ind[inside],cc]
+
+                todo = np.flatnonzero(found==-1)
+                if todo.size == 0:
+                    break
+
         return cellind
-        
+
+    def node_cells(self):
+        """
+        Returns the cells around each node as a padded array [Np, maxcells]
+        (filled with -1)
+        """
+        if not self.__dict__.has_key('_node2cell'):
+            cells = np.asarray(np.ma.filled(self.cells,-1))
+            valid = np.arange(cells.shape[1])[np.newaxis,:] < self.nfaces[:,np.newaxis]
+            node = cells[valid]
+            cell = np.repeat(np.arange(self.Nc),self.nfaces)
+
+            order = np.argsort(node,kind='mergesort')
+            node = node[order]
+            cell = cell[order]
+            count = np.bincount(node,minlength=self.xp.shape[0])
+            pos = np.arange(node.shape[0]) - (np.cumsum(count)-count)[node]
+
+            self._node2cell = -1*np.ones((self.xp.shape[0],count.max()),dtype=np.int32)
+            self._node2cell[node,pos] = cell
+
+        return self._node2cell
+
     def my_pnt2cells(self,pnt_i):
         """
         Returns the cell indices for a point, pnt_i
@@ -359,20 +404,27 @@ class GridSearch(HybridGrid):
         
     def inCellVec(self,cellinds,x,y):
         """
-        Check whether a point is inside a cell
+        Check whether each point is inside its cell
 
-        Basically a wrapper for points_inside_poly function        
+        Vectorized crossing number test over the cell edges
         """
-        nx = x.shape[0]                          
+        n = x.shape[0]
+        cells = np.asarray(np.ma.filled(self.cells,0))[cellinds,:]
+        nf = self.nfaces[cellinds]
+        xv = self.xp[cells]
+        yv = self.yp[cells]
+
+        inpoly = np.zeros((n,),dtype=np.bool)
+        for kk in range(cells.shape[1]):
+            k2 = np.where(kk+1<nf, kk+1, 0)
+            xa, ya = xv[:,kk], yv[:,kk]
+            xb, yb = xv[np.arange(n),k2], yv[np.arange(n),k2]
+            cross = ((ya>y) != (yb>y)) & (kk<nf)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                xint = xa + (y-ya)*(xb-xa)/(yb-ya)
+                inpoly ^= cross & (x<xint)
 
-        xy = np.zeros((1,2))
-        def _xy(ii):
-            xy[0,0]=x[ii]
-            xy[0,1]=y[ii]
-            return xy
-
-        inpoly = [self.xypoly[cellinds[ii]].contains_points(_xy(ii))[0] for ii in range(nx) ]
-        return np.array(inpoly)
+        return inpoly
 
 
     def inCellVecOld(self,cellinds,x,y):
@@ -412,22 +412,12 @@ class HybridGrid(object):
 
         #DEF = np.ma.masked_array(DEF,mask=cellmask)
 
-        # SUNTANS code
-        Nc = self.Ncells()
         maxfaces = self.nfaces.max()
+        face, mask = self.valid_face(maxfaces)
 
-        self.DEF = np.zeros((Nc,maxfaces))
-        
-        for i in range(Nc):
-            nf = self.nfaces[i]
-            for n in range(nf):
-                ne = self.face[i,n]
-                e = self.edges[ne,0]
-                #self.DEF[i,n] = -( (self.xv[n]-self.xp[e])*self.n1[ne] +\
-                #    (self.yv[n]-self.yp[e])*self.n2[ne]) *\
-                #    self.normal[i,n]
-                self.DEF[i,n] = dist(self.xv[i],self.xe[ne],\
-                    self.yv[i],self.ye[ne])
+        self.DEF = dist(self.xv[:,np.newaxis],self.xe[face],\
+            self.yv[:,np.newaxis],self.ye[face])
+        self.DEF[mask] = 0.
 
                 
 
@@ -561,15 +551,22 @@ class HybridGrid(object):
         Create the normal array
         """
         Nc = self.Ncells()
+        face, mask = self.valid_face(self.MAXFACES)
 
-        self.normal=np.zeros((Nc,self.MAXFACES))
-        
-        for ii in range(Nc):
-            for nf in range(self.nfaces[ii]):
-                if self.grad[self.face[ii,nf],0]==ii:
-                    self.normal[ii,nf]=-1
-                else:
-                    self.normal[ii,nf]=1
+        self.normal = np.where(self.grad[face,0]==np.arange(Nc)[:,np.newaxis],\
+            -1., 1.)
+        self.normal[mask] = 0.
+
+    def valid_face(self, maxfaces):
+        """
+        Returns the first maxfaces columns of the face array with the unused
+        faces set to zero, and the mask of the unused faces
+        """
+        mask = np.arange(maxfaces)[np.newaxis,:] >= self.nfaces[:,np.newaxis]
+        face = np.array(self.face[:,0:maxfaces], dtype=np.int64)
+        face[mask] = 0
+
+        return face, mask
 
         
     def make_edges_from_cells_sparse(self):
@@ -657,6 +654,121 @@ class HybridGrid(object):
             orthoang[i]=maxangle
         
         return orthoang
+
+    def calc_quality(self, dv=None, dt=None, grav=9.81):
+        """
+        Vectorized grid quality report
+
+        Inputs (optional):
+            dv - depth of each cell (positive) for the CFL calculation
+            dt - time step for the CFL calculation
+            grav - gravity
+
+        Returns:
+            quality - dictionary of arrays:
+                'orthog' : edge orthogonality error [degrees, Ne]
+                'inside' : True if the Voronoi point is inside the cell [Nc]
+                'def_dg' : ratio of def to dg for each cell face [Nc, maxfaces]
+                'dg' : Voronoi distance [Ne]
+                'aspect' : ratio of the longest to the shortest cell edge [Nc]
+                'cfl' : barotropic CFL number sqrt(g*dv)*dt/dg [Nc]
+                'dtmax' : largest stable barotropic time step [Nc]
+            stats - dictionary of summary statistics
+        """
+        maxfaces = self.nfaces.max()
+        face, mask = self.valid_face(maxfaces)
+        grad = self.grad
+        bdy1 = grad[:,0]<0
+        bdy2 = grad[:,1]<0
+
+        # Vector between the Voronoi points (edge point for boundaries)
+        x1 = np.where(bdy1, self.xe, self.xv[grad[:,0]])
+        y1 = np.where(bdy1, self.ye, self.yv[grad[:,0]])
+        x2 = np.where(bdy2, self.xe, self.xv[grad[:,1]])
+        y2 = np.where(bdy2, self.ye, self.yv[grad[:,1]])
+        vx = x2-x1
+        vy = y2-y1
+        vmag = np.sqrt(vx*vx + vy*vy)
+
+        # Angle between the Voronoi segment and the edge tangent
+        tx = self.xp[self.edges[:,1]] - self.xp[self.edges[:,0]]
+        ty = self.yp[self.edges[:,1]] - self.yp[self.edges[:,0]]
+        tmag = np.sqrt(tx*tx + ty*ty)
+        costheta = np.abs(vx*tx + vy*ty) / np.maximum(vmag*tmag, 1e-300)
+        orthog = 90. - np.degrees(np.arccos(np.clip(costheta, 0., 1.)))
+        orthog[vmag==0] = 90.
+
+        # Voronoi point inside cell test (cells are counter-clockwise)
+        cells = np.array(self.cells[:,0:maxfaces], dtype=np.int64)
+        cells[mask] = 0
+        nfp1 = (np.arange(maxfaces)[np.newaxis,:]+1) % self.nfaces[:,np.newaxis]
+        cellsp1 = cells[np.arange(self.Nc)[:,np.newaxis], nfp1]
+        xa = self.xp[cells]
+        ya = self.yp[cells]
+        cross = (self.xp[cellsp1]-xa)*(self.yv[:,np.newaxis]-ya) -\
+            (self.yp[cellsp1]-ya)*(self.xv[:,np.newaxis]-xa)
+        cross[mask] = 0.
+        inside = np.all(cross >= 0., axis=1)
+
+        # Edge lengths and distance ratios
+        df = dist(xa, self.xp[cellsp1], ya, self.yp[cellsp1])
+        dfmax = np.where(mask, 0., df).max(axis=1)
+        dfmin = np.where(mask, np.inf, df).min(axis=1)
+        aspect = dfmax/dfmin
+
+        # Use the grid's own dg and DEF (see calc_dg and calc_def) so that
+        # the report matches the grid
+        if not self.__dict__.has_key('dg'):
+            self.calc_dg()
+        if not self.__dict__.has_key('DEF'):
+            self.calc_def()
+        dg = np.asarray(self.dg, dtype=np.float64)
+        DEF = np.ma.filled(self.DEF, 0.)[:,0:maxfaces]
+
+        # Boundary edges read from suntans files have dg = 0
+        nodg = mask | (dg[face] <= 0.)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            def_dg = np.ma.masked_array(DEF/dg[face], mask=nodg)
+
+        quality = {'orthog':orthog,\
+            'inside':inside,\
+            'def_dg':def_dg,\
+            'dg':dg,\
+            'aspect':aspect,\
+            }
+
+        interior = ~(bdy1 | bdy2)
+        dgint = np.where(interior, dg, np.inf)
+        stats = {'orthog_max':orthog.max(),\
+            'orthog_mean':orthog.mean(),\
+            'orthog_edge':np.argmax(orthog),\
+            'n_outside':np.sum(~inside),\
+            'def_dg_min':def_dg.min(),\
+            'dg_min':dgint.min(),\
+            'dg_min_edge':np.argmin(dgint),\
+            'aspect_max':aspect.max(),\
+            'aspect_cell':np.argmax(aspect),\
+            }
+
+        # Barotropic CFL condition limited by the smallest face distance
+        if dv is not None:
+            dgcell = np.where(nodg, np.inf, dg[face]).min(axis=1)
+            c = np.sqrt(grav*np.abs(dv))
+            dtmax = dgcell / np.maximum(c, 1e-300)
+            quality['dtmax'] = dtmax
+            stats['dtmax'] = dtmax.min()
+            stats['dtmax_cell'] = np.argmin(dtmax)
+            if dt is not None:
+                cfl = dt / dtmax
+                quality['cfl'] = cfl
+                stats['cfl_max'] = cfl.max()
+                stats['n_cfl_exceeded'] = np.sum(cfl > 1.)
+
+        if self.VERBOSE:
+            for kk in sorted(stats.keys()):
+                print '%s : %s'%(kk, stats[kk])
+
+        return quality, stats
         
     ###########################
     # Input output functions
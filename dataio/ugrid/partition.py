@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+"""
+Geometric domain decomposition of unstructured grids
+
+Splits a grid into Nparts compact subdomains with a balanced number of
+active 3D cells, without needing METIS. Each subdomain is returned as a set
+of cell indices (owned cells followed by the halo cells) that can be passed
+straight to e.g. Spatial.j so that post-processing can be distributed over
+workers by region.
+
+Example:
+---
+    from soda.dataio.suntans.sunpy import Spatial
+    from soda.dataio.ugrid.partition import partition_grid
+
+    sun = Spatial(ncfile, VERBOSE=False)
+    part, subdomains = partition_grid(sun, 8, nhalo=1)
+
+    for sub in subdomains:
+        sun.j = sub['j']
+        ...
+"""
+
+import numpy as np
+
+def partition_grid(grd, Nparts, method='rcb', nhalo=1, weight=None):
+    """
+    Partition the cells of a grid into Nparts subdomains
+
+    Inputs:
+        grd - HybridGrid or suntans Grid object (needs xv, yv, nfaces, neigh)
+        Nparts - number of subdomains
+    *Optional*
+        method - 'rcb' recursive coordinate bisection or 'greedy' graph
+            growing over the neighbour graph
+        nhalo - number of layers of halo cells around each subdomain
+        weight - cell weights [Nc]. Defaults to the number of active
+            layers (Nk+1) if the grid has a 'Nk' attribute, otherwise one.
+
+    Returns:
+        part - subdomain number of each cell [Nc]
+        subdomains - list of dictionaries with keys:
+            'j' : owned cells followed by the halo cells
+            'owned' : cells belonging to the subdomain
+            'halo' : neighbouring cells owned by other subdomains
+            'weight' : total weight of the owned cells
+    """
+    xv = np.asarray(grd.xv, dtype=np.float64)
+    yv = np.asarray(grd.yv, dtype=np.float64)
+    Nc = xv.shape[0]
+
+    if weight is None:
+        weight = cell_weights(grd)
+    weight = np.asarray(weight, dtype=np.float64)
+
+    Nparts = int(min(Nparts, Nc))
+    neigh = valid_neigh(grd)
+
+    if method == 'rcb':
+        part = rcb_partition(xv, yv, weight, Nparts)
+    elif method == 'greedy':
+        part = greedy_partition(xv, yv, weight, neigh, Nparts)
+    else:
+        raise Exception('unknown partition method: %s'%method)
+
+    subdomains = []
+    for pp in range(Nparts):
+        owned = np.flatnonzero(part==pp)
+        halo = halo_cells(part==pp, neigh, nhalo=nhalo)
+        subdomains.append({'j':np.hstack((owned, halo)),\
+            'owned':owned,\
+            'halo':halo,\
+            'weight':weight[owned].sum(),\
+            })
+
+    return part, subdomains
+
+def cell_weights(grd):
+    """
+    Number of active 3D cells in each water column (Nk is zero-based)
+    """
+    Nc = np.asarray(grd.xv).shape[0]
+    Nk = getattr(grd, 'Nk', None)
+    if Nk is None or np.size(Nk) != Nc:
+        return np.ones((Nc,))
+
+    return np.asarray(Nk, dtype=np.float64) + 1.
+
+def valid_neigh(grd):
+    """
+    Returns the neighbour array with missing or unused faces set to -1
+    """
+    neigh = np.array(np.ma.filled(grd.neigh, -1), dtype=np.int64)
+    nfaces = np.asarray(grd.nfaces)
+    Nc, maxfaces = neigh.shape
+    unused = np.arange(maxfaces)[np.newaxis,:] >= nfaces[:,np.newaxis]
+    neigh[unused] = -1
+    neigh[(neigh<0) | (neigh>=Nc)] = -1
+
+    return neigh
+
+def rcb_partition(x, y, weight, Nparts):
+    """
+    Recursive coordinate bisection
+
+    Each set of cells is split perpendicular to its longest axis at the point
+    that divides the weight in proportion to the number of parts on each side.
+    """
+    part = np.zeros(x.shape, np.int64)
+
+    # Stack of (cell indices, first part number, number of parts)
+    stack = [(np.arange(x.shape[0]), 0, Nparts)]
+    while len(stack) > 0:
+        idx, p0, nparts = stack.pop()
+        if nparts == 1 or idx.size <= 1:
+            part[idx] = p0
+            continue
+
+        xi = x[idx]
+        yi = y[idx]
+        if xi.max()-xi.min() >= yi.max()-yi.min():
+            order = np.argsort(xi, kind='mergesort')
+        else:
+            order = np.argsort(yi, kind='mergesort')
+        idx = idx[order]
+
+        nleft = nparts//2
+        wsum = np.cumsum(weight[idx])
+        target = wsum[-1] * float(nleft)/nparts
+        cut = np.searchsorted(wsum, target)
+        cut = min(max(cut, nleft), idx.size-(nparts-nleft))
+
+        stack.append((idx[:cut], p0, nleft))
+        stack.append((idx[cut:], p0+nleft, nparts-nleft))
+
+    return part
+
+def greedy_partition(x, y, weight, neigh, Nparts):
+    """
+    Greedy graph growing over the neighbour graph
+
+    Each part is grown breadth-first from the unassigned cell furthest from
+    the centre of the remaining cells until it holds its share of the weight.
+    """
+    Nc = x.shape[0]
+    part = -1*np.ones((Nc,), np.int64)
+
+    wremain = weight.sum()
+    for pp in range(Nparts):
+        free = np.flatnonzero(part<0)
+        if pp == Nparts-1:
+            part[free] = pp
+            break
+
+        target = wremain / (Nparts-pp)
+
+        # Seed at the extremity of the unassigned region
+        xm, ym = x[free].mean(), y[free].mean()
+        dist = (x[free]-xm)**2 + (y[free]-ym)**2
+        seed = free[np.argmax(dist)]
+
+        part[seed] = pp
+        wpart = weight[seed]
+        frontier = np.array([seed])
+        while wpart < target:
+            nn = neigh[frontier,:].ravel()
+            nn = np.unique(nn[nn>=0])
+            nn = nn[part[nn]<0]
+
+            if nn.size == 0:
+                # Disconnected region: jump to the nearest unassigned cell
+                free = np.flatnonzero(part<0)
+                if free.size == 0:
+                    break
+                dist = (x[free]-x[seed])**2 + (y[free]-y[seed])**2
+                nn = free[[np.argmin(dist)]]
+
+            # Add the closest frontier cells first so as not to overshoot
+            dist = (x[nn]-x[seed])**2 + (y[nn]-y[seed])**2
+            nn = nn[np.argsort(dist, kind='mergesort')]
+            wsum = wpart + np.cumsum(weight[nn])
+            nadd = np.searchsorted(wsum, target) + 1
+            nn = nn[:nadd]
+
+            part[nn] = pp
+            wpart = wsum[nn.size-1]
+            frontier = nn
+
+        wremain -= wpart
+
+    return part
+
+def halo_cells(inpart, neigh, nhalo=1):
+    """
+    Returns the cells within nhalo neighbour layers of the cells where
+    inpart is True, excluding those cells themselves
+    """
+    inside = inpart.copy()
+    frontier = np.flatnonzero(inpart)
+    for nn in range(nhalo):
+        cand = neigh[frontier,:].ravel()
+        cand = np.unique(cand[cand>=0])
+        frontier = cand[~inside[cand]]
+        inside[frontier] = True
+
+    return np.flatnonzero(inside & ~inpart)
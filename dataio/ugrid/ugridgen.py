@@ -4,6 +4,7 @@ Unstructured grid generation and modification utilities
 Usage include:
     - Create a cartesian mesh
     - Reorder grid cells using metis
+    - Reorder grid cells, edges and nodes along a space-filling curve
 """
 import numpy as np
 from soda.dataio.ugrid.hybridgrid import HybridGrid
@@ -106,4 +107,163 @@ def reorder_ugrid(grd):
     # Create a new grid with this ordering
     return HybridGrid(grd.xp, grd.yp, grd.cells[perm, ...])
 
+def sfc_reorder_ugrid(grd, curve='hilbert', nbits=16):
+    """
+    Re-order the nodes, cells and edges of a grid along a space-filling curve
+
+    Neighbouring cells end up close together in memory (and on disk) which
+    speeds up bounding box subsets, tsearch walks and chunked netcdf reads.
+
+    Inputs:
+        grd - HybridGrid or suntans Grid object
+        curve - 'hilbert' or 'morton'
+        nbits - number of bits used to quantize each coordinate
+
+    Returns:
+        newgrd - a reordered HybridGrid object
+        cellperm - old cell index of each new cell
+        edgeperm - old edge index of each new edge
+        nodeperm - old node index of each new node
+
+    Existing cell-based output is remapped with e.g. data[...,cellperm]
+    """
+    xp = np.asarray(grd.xp)
+    yp = np.asarray(grd.yp)
+    nfaces = np.asarray(grd.nfaces)
+    cells = np.ma.filled(grd.cells, HybridGrid._FillValue)
+    edges = np.asarray(grd.edges)
+    grad = np.asarray(grd.grad)
+    mark = np.asarray(grd.mark)
+
+    Np = xp.shape[0]
+    Nc, maxfaces = cells.shape
+
+    # Only the first nfaces entries of each row are valid
+    valid = np.arange(maxfaces)[np.newaxis,:] < nfaces[:,np.newaxis]
+
+    # Sort the nodes, cells and edges by their position along the curve
+    xlims = [xp.min(), xp.max()]
+    ylims = [yp.min(), yp.max()]
+
+    def _curve_order(x, y):
+        d = sfc_index(x, y, xlims, ylims, curve=curve, nbits=nbits)
+        return np.argsort(d, kind='mergesort')
+
+    cellxy = np.where(valid, cells, 0)
+    xc = np.sum(np.where(valid, xp[cellxy], 0.), axis=1)/nfaces
+    yc = np.sum(np.where(valid, yp[cellxy], 0.), axis=1)/nfaces
+
+    nodeperm = _curve_order(xp, yp)
+    cellperm = _curve_order(xc, yc)
+    edgeperm = _curve_order(xp[edges].mean(axis=1), yp[edges].mean(axis=1))
+
+    # Inverse permutations: old index -> new index
+    nodeinv = np.zeros((Np,), np.int64)
+    nodeinv[nodeperm] = np.arange(Np)
+    cellinv = np.zeros((Nc,), np.int64)
+    cellinv[cellperm] = np.arange(Nc)
+
+    def _remap(idx, inv, mask):
+        out = idx.copy()
+        out[mask] = inv[idx[mask]]
+        return out
+
+    valid = valid[cellperm,:]
+    cells = cells[cellperm,:]
+    cells = _remap(cells, nodeinv, valid)
+
+    edges = nodeinv[edges[edgeperm,:]]
+    grad = grad[edgeperm,:]
+    grad = _remap(grad, cellinv, grad>=0)
+
+    kwargs = {'nfaces':nfaces[cellperm],\
+        'edges':edges,\
+        'grad':grad,\
+        'mark':mark[edgeperm],\
+        }
+
+    if getattr(grd, 'neigh', None) is not None:
+        neigh = np.ma.filled(grd.neigh, -1)[cellperm,:]
+        kwargs['neigh'] = _remap(neigh, cellinv, valid & (neigh>=0))
+
+    if getattr(grd, 'xv', None) is not None:
+        kwargs['xv'] = np.asarray(grd.xv)[cellperm]
+        kwargs['yv'] = np.asarray(grd.yv)[cellperm]
+
+    newgrd = HybridGrid(xp[nodeperm], yp[nodeperm], cells, **kwargs)
+
+    # Carry across any vertical grid information
+    for vv in ['Nk', 'dv']:
+        if getattr(grd, vv, None) is not None:
+            setattr(newgrd, vv, np.asarray(getattr(grd, vv))[cellperm])
+    if getattr(grd, 'dz', None) is not None:
+        newgrd.dz = grd.dz
+        newgrd.Nkmax = np.size(grd.dz)
+
+    return newgrd, cellperm, edgeperm, nodeperm
+
+def sfc_index(x, y, xlims, ylims, curve='hilbert', nbits=16):
+    """
+    Distance along a space-filling curve for points x, y
+
+    The points are quantized onto a 2**nbits x 2**nbits lattice spanning
+    xlims and ylims.
+
+    curve - 'hilbert' or 'morton'
+    """
+    n = 2**nbits
+    def _quantize(z, zlims):
+        scale = (n-1) / max(float(zlims[1]-zlims[0]), 1e-12)
+        zi = np.floor((np.asarray(z)-zlims[0])*scale).astype(np.int64)
+        return np.clip(zi, 0, n-1)
+
+    xi = _quantize(x, xlims)
+    yi = _quantize(y, ylims)
+
+    if curve == 'hilbert':
+        return hilbert_index(xi, yi, nbits)
+    elif curve == 'morton':
+        return morton_index(xi, yi, nbits)
+    else:
+        raise Exception('unknown curve type: %s'%curve)
+
+def hilbert_index(xi, yi, nbits):
+    """
+    Hilbert curve distance of the integer coordinates xi, yi
+    """
+    n = 2**nbits
+    x = np.array(xi, dtype=np.int64)
+    y = np.array(yi, dtype=np.int64)
+    d = np.zeros(x.shape, np.int64)
+
+    s = n//2
+    while s > 0:
+        rx = (x & s) > 0
+        ry = (y & s) > 0
+        d += s * s * ((3 * rx.astype(np.int64)) ^ ry.astype(np.int64))
+
+        # Rotate the quadrant
+        flip = (~ry) & rx
+        x[flip] = n-1 - x[flip]
+        y[flip] = n-1 - y[flip]
+        swap = ~ry
+        tmp = x[swap]
+        x[swap] = y[swap]
+        y[swap] = tmp
+
+        s //= 2
+
+    return d
+
+def morton_index(xi, yi, nbits):
+    """
+    Morton (Z-order) curve distance of the integer coordinates xi, yi
+    """
+    x = np.asarray(xi, dtype=np.int64)
+    y = np.asarray(yi, dtype=np.int64)
+    d = np.zeros(x.shape, np.int64)
+    for b in range(nbits):
+        d |= ((x >> b) & 1) << (2*b)
+        d |= ((y >> b) & 1) << (2*b+1)
 
+    return d
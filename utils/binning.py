@@ -0,0 +1,103 @@
+"""
+Vectorized binning of scattered values into cells
+
+bin_stats reduces values sharing the same bin index (e.g. the grid cell each
+sounding falls in) to a per-bin statistic in one pass, using np.bincount or a
+single sort. cell_reduce reduces values on the nodes of an unstructured grid
+onto its cells using the padded cells array.
+
+Example:
+---
+    from soda.utils.binning import bin_stats, cell_reduce
+
+    cell = grd.find_cell(x, y)
+    dv, count = bin_stats(cell, z, grd.Nc, stat='median')
+
+    dv = cell_reduce(dp, grd.cells, grd.nfaces, op='max')
+"""
+
+import numpy as np
+
+def bin_stats(ind, Z, nbins, stat='mean'):
+    """
+    Reduce the values Z into nbins bins
+
+    Inputs:
+        ind - bin index of each value (negative for values to ignore)
+        Z - values
+        nbins - number of bins
+        stat - 'mean', 'sum', 'min', 'max', 'median' or 'count'
+
+    Returns:
+        Zbin [nbins] - NaN in empty bins (zero for 'sum' and 'count')
+        N [nbins] - number of values in each bin
+
+    Non-finite values are ignored.
+    """
+    Z = np.ravel(Z)
+    ind = np.ravel(ind)
+    good = (ind>=0) & np.isfinite(Z)
+    ind = ind[good]
+    Z = Z[good]
+
+    N = np.bincount(ind, minlength=nbins)
+    full = N>0
+
+    if stat in ['sum','mean']:
+        # bincount of an empty index returns integers, even with weights
+        Zbin = np.bincount(ind, weights=Z, minlength=nbins).astype(np.float64)
+        if stat=='mean':
+            Zbin[full] /= N[full]
+            Zbin[~full] = np.nan
+
+    elif stat=='count':
+        Zbin = N.astype(np.float64)
+
+    elif stat in ['min','max','median']:
+        # Sort by bin and then value so each bin is a sorted run
+        order = np.lexsort((Z, ind))
+        Z = Z[order]
+        start = np.cumsum(N) - N
+        Nf = N[full]
+        if stat=='min':
+            lo = hi = start[full]
+        elif stat=='max':
+            lo = hi = start[full] + Nf - 1
+        else:
+            lo = start[full] + (Nf-1)//2
+            hi = start[full] + Nf//2
+        Zbin = np.nan*np.ones((nbins,))
+        Zbin[full] = 0.5*(Z[lo]+Z[hi])
+
+    else:
+        raise Exception, 'unknown statistic: %s'%stat
+
+    return Zbin, N
+
+def cell_reduce(values, cells, nfaces, op='max'):
+    """
+    Reduce node values onto the cells of an unstructured grid
+
+    Inputs:
+        values - node values [Np]
+        cells - padded cell to node array [Nc, maxfaces]
+        nfaces - number of nodes of each cell [Nc]
+        op - 'max', 'min' or 'mean'
+
+    Returns:
+        cell values [Nc]
+    """
+    values = np.asarray(values)
+    cells = np.asarray(np.ma.filled(cells, 0), dtype=np.int64)
+    nfaces = np.asarray(nfaces)
+    unused = np.arange(cells.shape[1])[np.newaxis,:] >= nfaces[:,np.newaxis]
+
+    V = values[np.where(unused, 0, cells)]
+    if op=='max':
+        return np.where(unused, -np.inf, V).max(axis=1)
+    elif op=='min':
+        return np.where(unused, np.inf, V).min(axis=1)
+    elif op=='mean':
+        return np.where(unused, 0., V).sum(axis=1)/nfaces
+    else:
+        raise Exception, 'unknown reduction: %s'%op
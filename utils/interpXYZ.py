@@ -10,7 +10,10 @@
 """
 
 import gzip
+import os
+import hashlib
 from scipy import spatial
+from scipy import sparse
 import numpy as np
 from maptools import ll2utm, readShpBathy, readraster
 from kriging import kriging
@@ -46,12 +49,24 @@ class interpXYZ(object):
 
     clip=False
 
+    # File to load the weights from (if it matches the coordinates) or
+    # save them to
+    weightfile = None
+
     
     def __init__(self,XY,XYout,**kwargs):
         
         self.__dict__.update(kwargs)
 
         self.bbox = [XYout[:,0].min(),XYout[:,0].max(),XYout[:,1].min(),XYout[:,1].max()]
+        self.XYout = XYout
+
+        if self.weightfile is not None and self.method!='curvmin':
+            self.coordhash = interp_hash(XY,XYout,**kwargs)
+            if os.path.exists(self.weightfile) and self.load_weights(self.weightfile):
+                self.XY = XY
+                self.Finterp = None
+                return
 
         if self.clip:
             print 'Clipping points outside of range'
@@ -59,8 +74,15 @@ class interpXYZ(object):
         else:
             self.XY = XY
 
-        self.XYout = XYout
+        self._build()
 
+        if self.weightfile is not None and self.method!='curvmin':
+            self.save_weights(self.weightfile)
+
+    def _build(self):
+        """
+        Build the interpolation object for self.method
+        """
         if self.method=='nn':
             #print 'Building DEM with Nearest Neighbour interpolation...'
             self._nearestNeighbour()
@@ -86,7 +108,12 @@ class interpXYZ(object):
         
     def __call__(self,Zin):
         """
+        Interpolate Zin [Nin, ...] onto the output points
+
+        Any trailing dimensions of Zin (e.g. layers and time steps) are
+        interpolated together with one sparse matrix product. 
         
+        Returns Z [Nout, ...]
         """
         
         if self.clip:
@@ -94,21 +121,128 @@ class interpXYZ(object):
         else:
             self.Zin = Zin  
         
-        if self.method in ['nn','idw','kriging','curvmin']:
-            #print 'Building DEM with Nearest Neighbour interpolation...'
-            self.Z = self.Finterp(Zin)
+        if self.method in ['nn','idw','kriging','linear']:
+            W = self.get_weights()
 
-        elif self.method=='linear':
-            self.Finterp.values[:]=Zin[:,np.newaxis]
-            self.Z=self.Finterp(self.XYout)
-            
+            Zin = np.asarray(Zin)
+            sz = Zin.shape
+            Z = W.dot(Zin.reshape((sz[0],-1)))
+
+            # Points outside of maxdist (or the convex hull)
+            if self.method=='linear':
+                Z[self._empty,:] = self.fill_value
+            else:
+                Z[self._empty,:] = np.nan
+
+            self.Z = Z.reshape((W.shape[0],)+sz[1:])
+
+        elif self.method=='curvmin':
+            self.Z = self.Finterp(Zin)
 
         else:
             raise Exception, 'Error - Unknown interpolation type: %s.'%self.method
         
         
         return self.Z
-        
+
+    def get_weights(self):
+        """
+        Returns the (cached) sparse weight matrix, see weight_matrix
+        """
+        if getattr(self, '_W', None) is None:
+            self._W = self.weight_matrix()
+            self._empty = np.diff(self._W.indptr)==0
+
+        return self._W
+
+    def save_weights(self,wfile):
+        """
+        Save the sparse weight matrix and the coordinate hash to a numpy
+        .npz file
+        """
+        W = self.get_weights()
+        clipindex = getattr(self, 'clipindex', np.zeros((0,),np.bool))
+        np.savez(wfile, W_data=W.data, W_indices=W.indices,\
+            W_indptr=W.indptr, W_shape=W.shape, clipindex=clipindex,\
+            coordhash=self.coordhash)
+
+    def load_weights(self,wfile):
+        """
+        Load the weights saved with save_weights
+
+        Returns False if the file was created for different coordinates or
+        interpolation options
+        """
+        ww = np.load(wfile)
+        if str(ww['coordhash']) != self.coordhash:
+            print 'Interpolation weight file %s does not match the coordinates.'%wfile
+            return False
+
+        self._W = sparse.csr_matrix((ww['W_data'], ww['W_indices'],\
+            ww['W_indptr']), shape=tuple(ww['W_shape']))
+        self._empty = np.diff(self._W.indptr)==0
+        if self.clip:
+            self.clipindex = ww['clipindex']
+        ww.close()
+
+        return True
+
+    def weight_matrix(self):
+        """
+        Returns the interpolation as a sparse matrix W [Nout, Nin] so that
+        Z = W.dot(Zin)
+
+        Output points with no valid neighbours have an empty row (i.e. zero
+        instead of NaN/fill_value). Not available for 'curvmin'.
+        """
+        if getattr(self, 'Finterp', None) is None:
+            # Loaded from a weight file
+            return self._W
+
+        Nout = self.XYout.shape[0]
+        Nin = self.XY.shape[0]
+
+        if self.method=='nn':
+            rows = np.flatnonzero(~self.Finterp.mask)
+            cols = self.Finterp.ind[rows]
+            vals = np.ones(rows.shape)
+
+        elif self.method in ['idw','kriging']:
+            ind = self.Finterp.ind
+            W = self.Finterp.W
+            if self.method=='kriging':
+                W = W.T
+            ind = ind.reshape((Nout,-1))
+            W = W.reshape((Nout,-1))
+            rows = np.repeat(np.arange(Nout), ind.shape[1])
+            cols = ind.ravel()
+            vals = W.ravel()
+
+        elif self.method=='linear':
+            tri = self.Finterp.tri
+            simplex = tri.find_simplex(self.XYout)
+            inside = simplex >= 0
+            T = tri.transform[simplex[inside]]
+            b = np.einsum('ijk,ik->ij', T[:,:2,:], self.XYout[inside,:]-T[:,2,:])
+            bary = np.hstack((b, 1-b.sum(axis=1)[:,np.newaxis]))
+            rows = np.repeat(np.flatnonzero(inside), 3)
+            cols = tri.simplices[simplex[inside]].ravel()
+            vals = bary.ravel()
+
+        else:
+            raise Exception, 'Error - no weight matrix for interpolation type: %s.'%self.method
+
+        # Drop out of range neighbours
+        good = (cols >= 0) & (cols < Nin) & (vals != 0) & np.isfinite(vals)
+        rows, cols, vals = rows[good], cols[good], vals[good]
+
+        # Map back onto the unclipped input points
+        if self.clip:
+            cols = np.flatnonzero(self.clipindex)[cols]
+            Nin = self.clipindex.shape[0]
+
+        return sparse.csr_matrix((vals,(rows,cols)), shape=(Nout,Nin))
+
     def _nearestNeighbour(self):
         """ Nearest neighbour interpolation algorithm
             Sets any points outside of maxdist to NaN
@@ -131,7 +265,8 @@ class interpXYZ(object):
     def _krig(self):    
         """ Kriging interpolation"""
        
-        self.Finterp = kriging(self.XY,self.XYout,maxdist=self.maxdist,NNear=self.NNear)
+        self.Finterp = kriging(self.XY,self.XYout,maxdist=self.maxdist,NNear=self.NNear,\
+            varmodel=self.varmodel,nugget=self.nugget,sill=self.sill,vrange=self.vrange)
 
     def _linear(self):
         self.Finterp =\
@@ -227,20 +362,38 @@ class interpXYZ(object):
 class Interp4D(object):
     """
     4-dimensional interpolation class
+
+    With sparse=True the horizontal, vertical and time weights are composed
+    into precomputed sparse operators that are applied to each variable with
+    a sparse matrix multiply. If opfile is set the operators are saved to
+    (and reloaded from) opfile suffixed by the hash of the coordinates, so
+    one opfile name can be shared by several operators.
     """
 
     zinterp_method = 'linear'
     tinterp_method = 'linear'
 
-    def __init__(self,xin,yin,zin,tin,xout,yout,zout,tout,mask=None,**kwargs):
+    def __init__(self,xin,yin,zin,tin,xout,yout,zout,tout,mask=None,\
+        sparse=False,opfile=None,**kwargs):
         """
         Construct the interpolation components
 
-        **kwargs are passed straight to interpXYZ
+        **kwargs are passed straight to interpXYZ (via cached_interpXYZ, so
+        set cachedir to reuse the horizontal weights between runs)
 
         """
+        self.sparse = sparse
+        if sparse and opfile is not None:
+            self.coordhash = coord_hash(xin,yin,zin,tin,xout,yout,zout,tout,mask,\
+                repr(sorted(kwargs.items())), self.zinterp_method, self.tinterp_method)
+            opfile = '%s_%s.npz'%(os.path.splitext(opfile)[0], self.coordhash)
+
+        if sparse and opfile is not None and os.path.exists(opfile):
+            if self.load_operator(opfile):
+                return
+
         self.is4D=True
-        if zin == None:
+        if zin is None:
             self.is4D=False
             self.nz=1
         else:
@@ -251,7 +404,7 @@ class Interp4D(object):
 
         # Create a 3D mask
         self.szxy = xin.shape
-        if mask==None:
+        if mask is None:
             self.mask = np.zeros((self.nz,)+self.szxy,np.bool)
         else:
             self.mask=mask
@@ -267,7 +420,7 @@ class Interp4D(object):
             xyout = np.vstack([xout.ravel(),yout.ravel()]).T
             self.nxy = xyout.shape[0]
 
-            self._Fxy.append(interpXYZ(xyin,xyout,**kwargs))
+            self._Fxy.append(cached_interpXYZ(xyin,xyout,**kwargs))
 
         # Just store the other coordinates for now
                 # Convert time to floats
@@ -275,6 +428,11 @@ class Interp4D(object):
         self.tout = othertime.SecondsSince(tout)
         self.nt = tin.shape[0]
 
+        if sparse:
+            self._build_operator()
+            if opfile is not None:
+                self.save_operator(opfile)
+
     def __call__(self,data):
         """
         Performs the interpolation in this order:
@@ -285,6 +443,8 @@ class Interp4D(object):
             3) Interpolate onto
                 the time coordinates
         """
+        if self.sparse:
+            return self._apply_operator(data)
 
         # Interpolate horizontally for all time steps and depths
         if self.is4D:
@@ -296,14 +456,13 @@ class Interp4D(object):
             # Reshape data
             data=data.reshape((self.nt,self.szxy[0]))
 
-        for tt in range(self.nt):
-            if self.is4D:
-                for kk in range(self.nz):
-                    mask = self.mask[kk,...]
-                    tmp = self._Fxy[kk](data[tt,kk,~mask].ravel())
-                    data_xy[tt,kk,:] = tmp
-            else:
-                 data_xy[tt,:] = self._Fxy[0](data[tt,~self.mask].ravel())
+        # All time steps at once (one call per layer mask)
+        if self.is4D:
+            for kk in range(self.nz):
+                mask = self.mask[kk,...]
+                data_xy[:,kk,:] = self._Fxy[kk](data[:,kk,~mask].T).T
+        else:
+            data_xy[:] = self._Fxy[0](data[:,~self.mask].T).T
                 
 
         # Now create a z-interpolation class
@@ -318,10 +477,311 @@ class Interp4D(object):
         # Time interpolation
         _Ft = interpolate.interp1d(self.tin,data_xyz,axis=0,kind=self.tinterp_method,\
             bounds_error=False,fill_value=0.)
-         
+
         return _Ft(self.tout)
 
+    def _build_operator(self):
+        """
+        Compose the horizontal and vertical weights into one sparse operator
+        Wxyz [nzout*nxy, nz*nin] and the time weights into Wt [ntout, nt]
+        """
+        nin = self.szxy[0]
+        if self.is4D:
+            Wz = interp1d_weights(self.zin, self.zout, kind=self.zinterp_method)
+        else:
+            Wz = sparse.csr_matrix(np.ones((1,1)))
+
+        blocks = []
+        empty = np.zeros((self.nz,self.nxy),np.bool)
+        for kk in range(self.nz):
+            if self.is4D:
+                mask = self.mask[kk,...]
+            else:
+                mask = self.mask
+            # Horizontal weights for this layer onto all of the input points
+            Wxy = self._Fxy[kk].weight_matrix().tocoo()
+            cols = np.flatnonzero(~mask.ravel())[Wxy.col]
+            Wxy = sparse.csr_matrix((Wxy.data,(Wxy.row,cols)), shape=(self.nxy,nin))
+            empty[kk,:] = np.diff(Wxy.indptr)==0
+
+            blocks.append(sparse.kron(Wz[:,kk], Wxy, format='csr'))
+
+        self.Wxyz = sparse.hstack(blocks, format='csr')
+
+        # Output rows that use a point with no horizontal neighbours are NaN
+        # (fill_value for 'linear') as in the dense interpolation
+        F = self._Fxy[0]
+        self.emptyvalue = F.fill_value if F.method=='linear' else np.nan
+        self.emptyrows = (abs(Wz).dot(empty.astype(np.float64)) > 0).ravel()
+
+        self.Wt = interp1d_weights(self.tin, self.tout, kind=self.tinterp_method)
+
+        if self.is4D:
+            self.outshape = (self.tout.shape[0], np.size(self.zout), self.nxy)
+        else:
+            self.outshape = (self.tout.shape[0], self.nxy)
+
+    def _apply_operator(self,data):
+        """
+        Apply the precomputed sparse operators to data [nt, nz, nin]
+        """
+        data = np.ma.filled(data, 0.).reshape((self.Wt.shape[1], -1))
+        data_xyz = self.Wxyz.dot(data.T)
+        data_xyz[self.emptyrows,:] = self.emptyvalue
+
+        return self.Wt.dot(data_xyz.T).reshape(self.outshape)
+
+    def save_operator(self,opfile):
+        """
+        Save the sparse interpolation operators to a numpy .npz file
+        """
+        np.savez(opfile,\
+            Wxyz_data=self.Wxyz.data, Wxyz_indices=self.Wxyz.indices,\
+            Wxyz_indptr=self.Wxyz.indptr, Wxyz_shape=self.Wxyz.shape,\
+            Wt_data=self.Wt.data, Wt_indices=self.Wt.indices,\
+            Wt_indptr=self.Wt.indptr, Wt_shape=self.Wt.shape,\
+            outshape=self.outshape, coordhash=self.coordhash,\
+            emptyrows=self.emptyrows, emptyvalue=self.emptyvalue)
+
+    def load_operator(self,opfile):
+        """
+        Load the sparse interpolation operators saved with save_operator
+
+        Returns False if the file was created for different coordinates
+        """
+        ops = np.load(opfile)
+        if str(ops['coordhash']) != self.coordhash:
+            print 'Interpolation operator file %s does not match the coordinates.'%opfile
+            return False
+
+        self.Wxyz = sparse.csr_matrix((ops['Wxyz_data'], ops['Wxyz_indices'],\
+            ops['Wxyz_indptr']), shape=tuple(ops['Wxyz_shape']))
+        self.Wt = sparse.csr_matrix((ops['Wt_data'], ops['Wt_indices'],\
+            ops['Wt_indptr']), shape=tuple(ops['Wt_shape']))
+        self.outshape = tuple(ops['outshape'])
+        self.emptyrows = ops['emptyrows']
+        self.emptyvalue = float(ops['emptyvalue'])
+        ops.close()
+
+        return True
+
+def interp1d_weights(x, xout, kind='linear', chunk=1000):
+    """
+    Sparse matrix W [Nout, N] reproducing
+        interp1d(x, y, axis=0, kind=kind, bounds_error=False, fill_value=0.)(xout)
+    as W.dot(y)
+
+    The weights are found by interpolating the identity matrix in blocks of
+    chunk output points.
+    """
+    x = np.asarray(x, dtype=np.float64)
+    xout = np.asarray(xout, dtype=np.float64).ravel()
+    F = interpolate.interp1d(x, np.eye(x.shape[0]), axis=0, kind=kind,\
+        bounds_error=False, fill_value=0.)
+
+    W = [sparse.csr_matrix(F(xout[ii:ii+chunk])) for ii in range(0,xout.shape[0],chunk)]
+
+    return sparse.vstack(W, format='csr')
+
+def interp_hash(XY, XYout, **kwargs):
+    """
+    Hash of the input and output coordinates and the interpXYZ options
+    (kwargs, or the class defaults)
+    """
+    opts = ['method','maxdist','NNear','p','varmodel','nugget','sill',\
+        'vrange','fill_value','clip']
+    opts = [repr(kwargs.get(oo, getattr(interpXYZ, oo))) for oo in opts]
+
+    return coord_hash(XY, XYout, *opts)
+
+def cached_interpXYZ(XY, XYout, cachedir=None, **kwargs):
+    """
+    Returns an interpXYZ object, loading the weights from cachedir if an
+    interpolant with the same coordinates and options has been built
+    before (and saving them there otherwise)
+
+    The weight files are named by the hash of the coordinates. With
+    cachedir=None this is the same as calling interpXYZ.
+    """
+    method = kwargs.get('method', interpXYZ.method)
+    if cachedir is None or method == 'curvmin':
+        return interpXYZ(XY, XYout, **kwargs)
+
+    if not os.path.isdir(cachedir):
+        os.makedirs(cachedir)
+
+    wfile = os.path.join(cachedir, 'interpXYZ_%s.npz'%interp_hash(XY, XYout, **kwargs))
+
+    return interpXYZ(XY, XYout, weightfile=wfile, **kwargs)
+
+def coord_hash(*args):
+    """
+    md5 hash of a set of coordinate arrays and options (None is allowed)
+    """
+    md5 = hashlib.md5()
+    for aa in args:
+        if aa is None:
+            md5.update('None')
+            continue
+        aa = np.ascontiguousarray(np.asarray(aa))
+        if aa.dtype == object:
+            aa = np.array([str(a) for a in aa.ravel()])
+        md5.update(str(aa.shape))
+        md5.update(aa.tostring())
+
+    return md5.hexdigest()
+
+
+
+class ColumnInterp(object):
+    """
+    Batched vertical interpolation of many water columns at once
+
+    The bracketing levels and weights are computed once for a set of source
+    depths and can then be applied to any number of variables on the same
+    columns, e.g.:
+
+        Fz = ColumnInterp(zroms, zout, kind='linear')
+        temp_out = Fz(temp)
+        salt_out = Fz(salt)
+
+    Inputs:
+        zin - source depths [Nzin, Nx] (or [Nzin] if the same for all columns)
+        zout - output depths [Nzout, Nx] (or [Nzout])
+        kind - 'linear', 'nearest' or 'pchip' (monotone cubic)
+        fill_value - value for points outside of the source depth range:
+            None uses the first source level of each column (as with
+            interp1d(...,fill_value=y[0])), 'nearest' uses the closest end
+            level, otherwise a constant.
+    """
+    kinds = ['linear','nearest','pchip']
+
+    def __init__(self, zin, zout, kind='linear', fill_value=None):
+        if kind not in self.kinds:
+            raise Exception, 'Error - Unknown vertical interpolation type: %s.'%kind
+
+        self.kind = kind
+        self.fill_value = fill_value
+
+        zin = np.asarray(zin, dtype=np.float64)
+        zout = np.asarray(zout, dtype=np.float64)
+        if zin.ndim == 1:
+            zin = zin[:,np.newaxis]
+        if zout.ndim == 1:
+            zout = zout[:,np.newaxis]
+
+        self.Nzin = zin.shape[0]
+        self.Nx = max(zin.shape[1], zout.shape[1])
+        zin = zin * np.ones((1,self.Nx))
+        zout = zout * np.ones((1,self.Nx))
+
+        # Sort each column into ascending order
+        self.order = None
+        if np.any(np.diff(zin, axis=0) < 0):
+            self.order = np.argsort(zin, axis=0, kind='mergesort')
+            zin = zin[self.order, np.arange(self.Nx)[np.newaxis,:]]
+
+        self.zin = zin
+
+        # Find the bracketing levels with one searchsorted call by shifting
+        # each (normalised) column into its own unit interval
+        zlo = min(zin.min(), zout.min())
+        span = max(zin.max(), zout.max()) - zlo + 1.
+        col = np.arange(self.Nx)[np.newaxis,:]
+        keyin = ((zin-zlo)/span + col).T.ravel()
+        keyout = ((zout-zlo)/span + col).T.ravel()
+        pos = np.searchsorted(keyin, keyout, side='right')
+        pos = pos.reshape((self.Nx, zout.shape[0])).T - col*self.Nzin
+
+        self.k0 = np.clip(pos-1, 0, max(self.Nzin-2, 0))
+        self.k1 = np.minimum(self.k0+1, self.Nzin-1)
+        self.col = col
+
+        z0 = zin[self.k0, col]
+        z1 = zin[self.k1, col]
+        self.dz = z1 - z0
+        self.t = np.where(self.dz > 0, (zout-z0)/np.where(self.dz>0, self.dz, 1.), 0.)
+
+        self.below = zout < zin[0,:]
+        self.above = zout > zin[-1,:]
+        self.outside = self.below | self.above
+
+    def __call__(self, data):
+        """
+        Interpolate data [Nzin, Nx, ...] onto the output depths
+
+        If zin and zout are both 1-D data can have any trailing shape.
+        """
+        data = np.asarray(data)
+        shp = data.shape
+        data = data.reshape((self.Nzin, self.Nx, -1))
+        if self.order is not None:
+            data = data[self.order, self.col, :]
+
+        t = self.t[...,np.newaxis]
+        y0 = data[self.k0, self.col, :]
+        y1 = data[self.k1, self.col, :]
+
+        if self.kind == 'linear':
+            out = y0 + t*(y1-y0)
+        elif self.kind == 'nearest':
+            out = np.where(t > 0.5, y1, y0)
+        elif self.kind == 'pchip':
+            d = self._pchip_slopes(data)
+            d0 = d[self.k0, self.col, :]
+            d1 = d[self.k1, self.col, :]
+            h = self.dz[...,np.newaxis]
+            t2 = t*t
+            t3 = t2*t
+            out = (2*t3-3*t2+1)*y0 + (t3-2*t2+t)*h*d0 +\
+                (-2*t3+3*t2)*y1 + (t3-t2)*h*d1
+
+        # Fill the points outside of the source range
+        if self.fill_value is None:
+            fill = data[0,:,:][np.newaxis,...] * np.ones_like(out)
+        elif self.fill_value == 'nearest':
+            fill = np.where(self.below[...,np.newaxis],\
+                data[0,:,:][np.newaxis,...], data[-1,:,:][np.newaxis,...])
+        else:
+            fill = self.fill_value * np.ones_like(out)
+
+        out = np.where(self.outside[...,np.newaxis], fill, out)
+
+        return out.reshape((self.k0.shape[0],) + shp[1:])
+
+    def _pchip_slopes(self, data):
+        """
+        Monotone (Fritsch-Carlson) derivatives at the source levels, as used
+        by scipy.interpolate.PchipInterpolator
+        """
+        h = np.diff(self.zin, axis=0)[...,np.newaxis]
+        hs = np.where(h > 0, h, 1.)
+        delta = np.diff(data, axis=0) / hs
+        d = np.zeros(data.shape)
+        if self.Nzin == 2:
+            d[:] = delta
+            return d
+
+        # Interior points: weighted harmonic mean where the slopes agree
+        w1 = 2*h[1:] + h[:-1]
+        w2 = h[1:] + 2*h[:-1]
+        same = (np.sign(delta[1:]) * np.sign(delta[:-1])) > 0
+        dl = np.where(same, delta[:-1], 1.)
+        dr = np.where(same, delta[1:], 1.)
+        d[1:-1] = np.where(same, (w1+w2)/(w1/dl + w2/dr), 0.)
 
+        # End points: one-sided three point estimate
+        def _edge(h0, h1, m0, m1):
+            de = ((2*h0+h1)*m0 - h0*m1)/(h0+h1)
+            de = np.where(np.sign(de) != np.sign(m0), 0., de)
+            de = np.where((np.sign(m0) != np.sign(m1)) &\
+                (np.abs(de) > np.abs(3*m0)), 3*m0, de)
+            return de
+
+        d[0] = _edge(h[0], h[1], delta[0], delta[1])
+        d[-1] = _edge(h[-1], h[-2], delta[-1], delta[-2])
+
+        return d
 
 class Inputs(object):
     """
@@ -336,6 +796,9 @@ class Inputs(object):
     isnorth=True
     vdatum = 'MSL'
     shapefieldname='contour'
+
+    # Convert text files to a binary cache the first time they are read
+    cache = False
      
     def __init__(self,infile,**kwargs):
     
@@ -345,10 +808,8 @@ class Inputs(object):
         
         # Read in the array
         print 'Reading data from: %s...'%self.infile
-        if self.infile[-3:]=='.gz':
-            LL,self.Zin = read_xyz_gz(self.infile)
-        elif self.infile[-3:] in ['txt','dat']:
-            LL,self.Zin = read_xyz(self.infile)
+        if self.infile[-3:] in ['.gz','txt','dat','xyz'] or os.path.isdir(self.infile):
+            LL,self.Zin = read_xyz(self.infile, cache=self.cache)
             self.Zin = np.ravel(self.Zin)
         elif self.infile[-3:]=='shp':
             LL,self.Zin = readShpBathy(self.infile,FIELDNAME=self.shapefieldname)
@@ -482,25 +943,11 @@ class nn(object):
 ## Other functions that don't need to be in a class ##
 
     
-def read_xyz_gz(fname):
-    # Read the raw data into an array
-    f = gzip.open(fname,'r')
-    
-    npts = line_count(f)-1
-    XY = np.zeros((npts,2))
-    Z = np.zeros((npts,1))
-    ii=-1
-    for line in f:
-        ii+=1
-        if ii > 0:
-            xyz = line.split(', ')
-            XY[ii-1,0] = float(xyz[0]) 
-            XY[ii-1,1] = float(xyz[1])
-            Z[ii-1,0] = float(xyz[2])
-            
-    f.close()
-      
-    return XY,Z
+def read_xyz_gz(fname, **kwargs):
+    """
+    Read a gzipped xyz text file (see read_xyz)
+    """
+    return read_xyz(fname, **kwargs)
 
 class CurvMin(object):
     """
@@ -516,38 +963,223 @@ class CurvMin(object):
 
         return F(self.XYout)
     
-def read_xyz(fname):
-    # Read the raw data into an array
-    f =open(fname,'r')
-    
-    npts = line_count(f)-1
-    XY = np.zeros((npts,2))
-    Z = np.zeros((npts,1))
-    ii=-1
-    for line in f:
-        ii+=1
-        if ii > 0:
-            xyz = line.split()
-            XY[ii-1,0] = float(xyz[0]) 
-            XY[ii-1,1] = float(xyz[1])
-            Z[ii-1,0] = float(xyz[2])
-#            try: # comma delimeted
-#                xyz = line.split(', ')
-#                XY[ii-1,0] = float(xyz[0]) 
-#                XY[ii-1,1] = float(xyz[1])
-#                Z[ii-1,0] = float(xyz[2])
-#            except: # space delimitede
-#                xyz = line.split(' ')
-#                XY[ii-1,0] = float(xyz[0]) 
-#                XY[ii-1,1] = float(xyz[1])
-#                print xyz[2]
-#                Z[ii-1,0] = float(xyz[2])
-                
-            
+def read_xyz(fname, cache=False, dtype=np.float64):
+    """
+    Read a comma or white space delimited x, y, z text file
+
+    The delimiter, any header lines and gzip compression are detected
+    automatically and the file is parsed in large blocks.
+
+    Inputs:
+        fname - text file name (or a cache folder from xyz_cache)
+    *Optional*
+        cache - if True the file is converted to a binary cache the first
+            time it is read (see xyz_cache) and loaded from there afterwards
+        dtype - data type of the cached z values
+
+    Returns:
+        XY [N,2], Z [N,1]
+    """
+    if cache and not os.path.isdir(fname):
+        fname = xyz_cache(fname, dtype=dtype)
+
+    if os.path.isdir(fname):
+        x, y, z, bbox = load_xyz_cache(fname)
+        return np.column_stack((x,y)), np.array(z).reshape((-1,1))
+
+    XY = []
+    Z = []
+    for xy, zz in xyz_chunks(fname):
+        XY.append(xy)
+        Z.append(zz)
+
+    if len(Z) == 0:
+        return np.zeros((0,2)), np.zeros((0,1))
+
+    return np.concatenate(XY), np.concatenate(Z).reshape((-1,1))
+
+def xyz_chunks(fname, usecols=(0,1,2), blocksize=2**25):
+    """
+    Iterator over blocks of (XY [n,2], Z [n]) from an xyz text file or a
+    cache folder from xyz_cache, e.g. for tiledinterp.build_point_index
+
+    Inputs:
+        fname - text file (gzipped or not) or cache folder name
+    *Optional*
+        usecols - columns holding x, y and z
+        blocksize - number of bytes of text parsed at a time
+    """
+    if os.path.isdir(fname):
+        x, y, z, bbox = load_xyz_cache(fname)
+        nblock = max(blocksize//32, 1)
+        for i0 in range(0, z.shape[0], nblock):
+            yield np.column_stack((x[i0:i0+nblock], y[i0:i0+nblock])),\
+                np.array(z[i0:i0+nblock])
+        return
+
+    f = _open_text(fname)
+
+    # Skip any header lines and work out the delimiter from the first row
+    line = f.readline()
+    while line != '' and _parse_row(line) is None:
+        line = f.readline()
+    if line == '':
+        f.close()
+        return
+
+    comma = ',' in line
+    ncols = len(_parse_row(line))
+    if max(usecols) >= ncols:
+        f.close()
+        raise Exception, 'only %d columns in %s'%(ncols,fname)
+
+    rest = line
+    while True:
+        buf = f.read(blocksize)
+        if buf == '':
+            break
+        buf = rest + buf
+        nl = buf.rfind('\n')
+        if nl < 0:
+            rest = buf
+            continue
+        rest = buf[nl+1:]
+        data = _parse_block(buf[:nl+1], ncols, comma, fname)
+        yield data[:,usecols[0:2]], data[:,usecols[2]]
+
     f.close()
-      
-    return XY,Z
-    
+
+    if rest.strip() != '':
+        data = _parse_block(rest, ncols, comma, fname)
+        yield data[:,usecols[0:2]], data[:,usecols[2]]
+
+def xyz_cache(fname, cachedir=None, dtype=np.float64, **kwargs):
+    """
+    Convert an xyz text file into a binary columnar cache
+
+    The x and y (float64) and z (dtype) columns are stored as raw binary
+    files in cachedir (default: fname+'.cache') that can be memory-mapped
+    with load_xyz_cache. The cache is only rebuilt if the text file has
+    changed since it was written.
+
+    Other keyword arguments are passed to xyz_chunks.
+
+    Returns the cache folder name
+    """
+    if cachedir is None:
+        cachedir = fname+'.cache'
+
+    stat = os.stat(fname)
+    source = np.array([stat.st_size, stat.st_mtime])
+    metafile = os.path.join(cachedir, 'meta.npz')
+    if os.path.exists(metafile):
+        meta = np.load(metafile)
+        valid = np.all(meta['source']==source) and meta['zdtype']==np.dtype(dtype).str
+        meta.close()
+        if valid:
+            return cachedir
+        os.remove(metafile)
+    elif not os.path.isdir(cachedir):
+        os.makedirs(cachedir)
+
+    print 'Writing xyz cache: %s...'%cachedir
+    out = {}
+    for vv in ['x','y','z']:
+        out[vv] = open(os.path.join(cachedir, vv+'.bin'), 'wb')
+    npts = 0
+    bbox = [np.inf, -np.inf, np.inf, -np.inf]
+    for XY, Z in xyz_chunks(fname, **kwargs):
+        if Z.shape[0] == 0:
+            continue
+        bbox = [min(bbox[0], XY[:,0].min()), max(bbox[1], XY[:,0].max()),\
+            min(bbox[2], XY[:,1].min()), max(bbox[3], XY[:,1].max())]
+        out['x'].write(np.ascontiguousarray(XY[:,0]).tostring())
+        out['y'].write(np.ascontiguousarray(XY[:,1]).tostring())
+        out['z'].write(Z.astype(dtype).tostring())
+        npts += Z.shape[0]
+    for vv in out.keys():
+        out[vv].close()
+
+    # Written last so that an interrupted conversion is not reused
+    np.savez(metafile, npts=npts, bbox=bbox, zdtype=np.dtype(dtype).str,\
+        source=source)
+
+    return cachedir
+
+def load_xyz_cache(cachedir, mmap_mode='r'):
+    """
+    Memory-map a cache folder written by xyz_cache
+
+    Returns:
+        x [N], y [N], z [N], bbox [xmin, xmax, ymin, ymax]
+    """
+    meta = np.load(os.path.join(cachedir, 'meta.npz'))
+    npts = int(meta['npts'])
+    bbox = meta['bbox']
+    zdtype = np.dtype(str(meta['zdtype']))
+    meta.close()
+
+    out = []
+    for vv, dt in [('x',np.float64), ('y',np.float64), ('z',zdtype)]:
+        if npts == 0:
+            out.append(np.zeros((0,), dt))
+        else:
+            out.append(np.memmap(os.path.join(cachedir, vv+'.bin'), dtype=dt,\
+                mode=mmap_mode, shape=(npts,)))
+
+    return out[0], out[1], out[2], bbox
+
+def _open_text(fname):
+    """
+    Opens a text file, decompressing it if it is gzipped
+    """
+    f = open(fname, 'rb')
+    magic = f.read(2)
+    f.close()
+    if magic == '\x1f\x8b':
+        return gzip.open(fname, 'rb')
+    else:
+        return open(fname, 'rb')
+
+def _parse_row(line):
+    """
+    Returns the values on a text line or None if it is not all numbers
+    """
+    vals = line.replace(',',' ').split()
+    if len(vals) == 0:
+        return None
+    try:
+        return [float(vv) for vv in vals]
+    except ValueError:
+        return None
+
+def _parse_block(buf, ncols, comma, fname):
+    """
+    Parses a block of complete text lines into an array [n,ncols]
+
+    Blank and comment (#) lines are skipped. Any other line that is not
+    ncols numbers raises an exception.
+    """
+    if comma:
+        buf = buf.replace(',',' ')
+
+    # np.fromstring stops at the first token it cannot parse, so only accept
+    # the block if every line was read
+    nlines = buf.count('\n') + (not buf.endswith('\n'))
+    data = np.fromstring(buf, dtype=np.float64, sep=' ')
+    if data.size == ncols*nlines:
+        return data.reshape((-1,ncols))
+
+    lines = [ll for ll in buf.splitlines() \
+        if ll.strip() != '' and not ll.lstrip().startswith('#')]
+    data = np.fromstring('\n'.join(lines), dtype=np.float64, sep=' ')
+    if data.size != ncols*len(lines):
+        for ll in lines:
+            vals = _parse_row(ll)
+            if vals is None or len(vals) != ncols:
+                raise Exception, 'could not parse line in %s: %s'%(fname,ll.strip())
+
+    return data.reshape((-1,ncols))
 
 def line_count(f):
     for i, l in enumerate(f):
@@ -16,11 +16,14 @@ class kriging(object):
     NNear = 12
     
     # Variogram paramters
-    varmodel = 'spherical'
+    varmodel = 'spherical' # 'spherical', 'exponential' or 'gaussian'
     nugget = 0.1
     sill = 0.8
     vrange = 250.0
     
+    # Number of points whose kriging systems are solved at once
+    blocksize = 10000
+
     verbose = True
     
     def __init__(self,XYin,XYout,**kwargs):
@@ -34,10 +37,11 @@ class kriging(object):
     def __call__(self,Zin):
         """
         Calls the interpolation function with the scalar in Zin
+
+        Points with no neighbours within maxdist are set to NaN
         """
-        self.Z = np.zeros((self.Nc,))
-        for ii in range(0,self.Nc):
-            self.Z[ii] = np.dot(self.W[:,ii],Zin[self.ind[ii,:]])
+        self.Z = np.sum(self.W.T*Zin[self.ind],axis=1)
+        self.Z[self.mask] = np.nan
             
         return self.Z
                 
@@ -51,79 +55,99 @@ class kriging(object):
                 distance_upper_bound=self.maxdist,
                 k=self.NNear)
         
+        dist = dist.reshape((-1,self.NNear))
+        self.ind = self.ind.reshape((-1,self.NNear))
+
+        # Neighbours outside of maxdist are returned with an infinite
+        # distance and an index of len(XYin)
+        miss = dist==np.inf
+        self.ind[miss] = 0
+        self.mask = np.all(miss,axis=1)
+
         self.Nc = np.size(self.ind,axis=0)
         print '%d interpolation points.'%self.Nc
-        # Now loop through and get the weights for each point
+        # Solve the kriging systems a block of points at a time
         self.W = np.zeros((self.NNear,self.Nc))
 
-        # Print percentages
-        p0=0
-        pstep=5
-        for ii in range(0,self.Nc):
-            
+        for i0 in range(0,self.Nc,self.blocksize):
+            i1 = min(i0+self.blocksize,self.Nc)
             if self.verbose:
-                pfinish = float(ii)/float(self.Nc)*100.0
-                if  pfinish> p0:
-                    print '%3.1f %% complete...'%pfinish
-                    p0+=pstep
+                print '%3.1f %% complete...'%(float(i0)/float(self.Nc)*100.0)
                                 
-            W = self.getWeights(dist[ii,:],\
-                self.XYin[self.ind[ii,:],0],\
-                self.XYin[self.ind[ii,:],1])
+            W = self.getWeights(dist[i0:i1,:],\
+                self.XYin[self.ind[i0:i1,:],0],\
+                self.XYin[self.ind[i0:i1,:],1])
             
-            self.W[:,ii] = W.T 
+            self.W[:,i0:i1] = W.T 
                 
         
     def getWeights(self,dist,xin,yin):
         
-        """ Calculates the kriging weights point by point"""
+        """
+        Calculates the kriging weights for a block of points
+
+        Inputs:
+            dist - distance to the neighbours [Nb, Ns] (inf for missing)
+            xin, yin - neighbour coordinates [Nb, Ns]
+
+        Returns:
+            W - weights [Nb, Ns]
+        """
         
         eps = 1e-10
-        Ns = len(dist)
+        dist = np.atleast_2d(dist)
+        xin = np.atleast_2d(xin)
+        yin = np.atleast_2d(yin)
+        Nb, Ns = dist.shape
         
-        # Construct the LHS matrix C
-        C=np.ones((Ns+1,Ns+1))
-        for i in range(0,Ns):
-            C[i,i]=0
-            for j in range(i+1,Ns):
-                D = np.sqrt((xin[i]-xin[j])**2+(yin[i]-yin[j])**2)
-                C[i,j] = self.semivariogram(D+eps)
-                C[j,i] = C[i,j]
+        # Construct the LHS matrices C [Nb, Ns+1, Ns+1]
+        D = np.sqrt((xin[:,:,np.newaxis]-xin[:,np.newaxis,:])**2 +\
+            (yin[:,:,np.newaxis]-yin[:,np.newaxis,:])**2)
+        C = np.ones((Nb,Ns+1,Ns+1))
+        C[:,0:Ns,0:Ns] = self.semivariogram(D+eps)
+        diag = np.arange(Ns+1)
+        C[:,diag,diag] = 0
 
-        C[Ns,Ns]=0
+        # RHS vectors
+        gamma = np.ones((Nb,Ns+1))
+        gamma[:,0:Ns] = self.semivariogram(dist+eps)
 
-        ###
-        # Old method
-        ###
-        # Calculate the inverse of C 
-        #Cinv = np.linalg.inv(C)
-        
-        # Loop through each model point and calculate the vector D
-        gamma = np.ones((Ns+1,1))
-        
-        for j in range(0,Ns):
-            gamma[j,0]= self.semivariogram(dist[j]+eps)
+        # Decouple missing neighbours so their weights are zero
+        miss = dist==np.inf
+        if np.any(miss):
+            allmiss = np.all(miss,axis=1)
+            bb, jj = np.nonzero(miss)
+            C[bb,jj,:] = 0.
+            C[bb,:,jj] = 0.
+            C[bb,jj,jj] = 1.
+            gamma[bb,jj] = 0.
 
-        # Solve the matrix to get the weights
-        #W = np.dot(Cinv,gamma)
-        #W = W[:-1,:]
+            # No neighbours at all: identity system
+            C[allmiss,...] = np.eye(Ns+1)
+            gamma[allmiss,:] = 0.
 
-        W = np.linalg.solve(C,gamma)
+        # Solve the matrix to get the weights
+        try:
+            W = np.linalg.solve(C,gamma[...,np.newaxis])[...,0]
+        except np.linalg.LinAlgError:
+            # Singular systems (e.g. duplicate points) one at a time
+            W = np.zeros((Nb,Ns+1))
+            for ii in range(Nb):
+                W[ii,:] = np.linalg.lstsq(C[ii,...],gamma[ii,:],rcond=None)[0]
 
-        #print np.size(gamma,axis=0),np.size(gamma,axis=1)   
-        return W[:-1]
-        #
-        #return 1.0/float(Ns)*np.ones((Ns,1))
+        return W[:,:-1]
         
     def semivariogram(self,D):
-        """ Semivariogram functions"""
+        """ Semivariogram functions (D is an array of distances)"""
+        tmp = np.asarray(D,dtype=np.float64)/self.vrange
         if self.varmodel == 'spherical':
-            if D > self.vrange:
-                F = self.sill
-            else:
-                tmp = D/self.vrange
-                F = self.nugget + (self.sill-self.nugget)*(1.5*tmp - 0.5*tmp**3)
+            # Equal to the sill beyond the range
+            tmp = np.minimum(tmp,1.0)
+            F = self.nugget + (self.sill-self.nugget)*(1.5*tmp - 0.5*tmp**3)
+        elif self.varmodel == 'exponential':
+            F = self.nugget + (self.sill-self.nugget)*(1. - np.exp(-3.*tmp))
+        elif self.varmodel == 'gaussian':
+            F = self.nugget + (self.sill-self.nugget)*(1. - np.exp(-3.*tmp**2))
+        else:
+            raise Exception, 'Unknown variogram model: %s'%self.varmodel
         return F
-  
-        
-        
@@ -3,6 +3,7 @@ Extensions to shapely geometry library
 """
 
 from shapely.geometry import LineString, Point
+from scipy.spatial import cKDTree
 import numpy as np
 
 class MyLine(LineString):
@@ -61,3 +62,121 @@ class MyLine(LineString):
             range(npoints)]
 
 
+def perpendicular_transects(x, y, dist, mag, npoints, dx=0.001):
+    """
+    Vectorized equivalent of
+        MyLine(xy).perpline(dist[ii],mag).multipoint(npoints)
+    for all of the normalized distances in dist along the line x, y
+
+    Returns the transect coordinates xt, yt [len(dist), npoints], ordered
+    from the right to the left hand side of the line
+    """
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    dist = np.atleast_1d(np.asarray(dist, dtype=np.float64))
+
+    # Normalized distance of each vertex along the line
+    s = np.zeros(x.shape)
+    s[1:] = np.cumsum(np.hypot(np.diff(x), np.diff(y)))
+    s /= s[-1]
+
+    def _point(d):
+        return np.interp(d, s, x), np.interp(d, s, y)
+
+    # Unit normal (see MyLine.unitnormal)
+    atend = dist+dx > 1.
+    x1, y1 = _point(np.where(atend, dist-dx, dist))
+    x2, y2 = _point(np.where(atend, dist, dist+dx))
+    dxp = x2 - x1
+    dyp = y2 - y1
+    norm = np.hypot(dxp, dyp)
+    nx = dyp/norm
+    ny = -dxp/norm
+
+    # End points on the right and left of the line
+    x0, y0 = _point(dist)
+    xr, yr = x0 + nx*mag, y0 + ny*mag
+    xl, yl = x0 - nx*mag, y0 - ny*mag
+
+    frac = np.linspace(0, 1, npoints)[np.newaxis,:]
+    xt = xr[:,np.newaxis] + frac*(xl-xr)[:,np.newaxis]
+    yt = yr[:,np.newaxis] + frac*(yl-yr)[:,np.newaxis]
+
+    return xt, yt
+
+def polyline_distance(x, y, lines, maxdist):
+    """
+    Distance from the points x, y to each polyline, for all of the
+    point/line pairs closer than maxdist
+
+    Vectorized equivalent of LineString(lines[n]).distance(Point(x[i], y[i])).
+    The line segments are split into pieces no longer than maxdist and a
+    KD-tree of the points limits the candidates to those within 1.5*maxdist
+    of each piece's mid-point.
+
+    Inputs:
+        x, y - point coordinates [Np]
+        lines - list of polyline vertex arrays [n, 2]
+        maxdist - search distance
+
+    Returns:
+        ipt, iline, dist - point index, line index and distance of each pair
+    """
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    if len(lines) == 0 or x.shape[0] == 0:
+        return np.zeros((0,), np.int64), np.zeros((0,), np.int64), np.zeros((0,))
+
+    # Segment end points and line number
+    xa, ya, xb, yb, segline = [], [], [], [], []
+    for nn, ll in enumerate(lines):
+        ll = np.asarray(ll, dtype=np.float64)
+        if ll.shape[0] == 1:
+            ll = np.vstack((ll, ll))
+        xa.append(ll[:-1,0])
+        ya.append(ll[:-1,1])
+        xb.append(ll[1:,0])
+        yb.append(ll[1:,1])
+        segline.append(nn*np.ones((ll.shape[0]-1,), np.int64))
+    xa, ya, xb, yb, segline = [np.concatenate(vv) for vv in [xa, ya, xb, yb, segline]]
+
+    # Split the segments into pieces no longer than maxdist
+    nsub = np.maximum(np.ceil(np.hypot(xb-xa, yb-ya)/maxdist), 1).astype(np.int64)
+    seg = np.repeat(np.arange(nsub.shape[0]), nsub)
+    k = np.arange(seg.shape[0]) - (np.cumsum(nsub)-nsub)[seg]
+    f0 = k/nsub[seg].astype(np.float64)
+    f1 = (k+1)/nsub[seg].astype(np.float64)
+    dx = xb[seg]-xa[seg]
+    dy = yb[seg]-ya[seg]
+    xa, ya, xb, yb = xa[seg]+f0*dx, ya[seg]+f0*dy, xa[seg]+f1*dx, ya[seg]+f1*dy
+    segline = segline[seg]
+
+    # Candidate points of each piece
+    kd = cKDTree(np.column_stack((x, y)))
+    near = kd.query_ball_point(np.column_stack((0.5*(xa+xb), 0.5*(ya+yb))), 1.5*maxdist)
+    count = np.array([len(nn) for nn in near], dtype=np.int64)
+    if count.sum() == 0:
+        return np.zeros((0,), np.int64), np.zeros((0,), np.int64), np.zeros((0,))
+    ipt = np.concatenate([nn for nn in near if len(nn) > 0]).astype(np.int64)
+    iseg = np.repeat(np.arange(count.shape[0]), count)
+
+    # Distance to the closest point on each piece
+    dx = xb[iseg]-xa[iseg]
+    dy = yb[iseg]-ya[iseg]
+    L2 = dx*dx + dy*dy
+    t = (x[ipt]-xa[iseg])*dx + (y[ipt]-ya[iseg])*dy
+    t = np.clip(np.where(L2 > 0, t/np.where(L2 > 0, L2, 1.), 0.), 0., 1.)
+    dist = np.hypot(x[ipt]-xa[iseg]-t*dx, y[ipt]-ya[iseg]-t*dy)
+
+    # Minimum over the pieces of each point/line pair
+    nlines = len(lines)
+    key = ipt*nlines + segline[iseg]
+    order = np.argsort(key, kind='mergesort')
+    key = key[order]
+    start = np.flatnonzero(np.r_[True, key[1:] != key[:-1]])
+    dist = np.minimum.reduceat(dist[order], start)
+    key = key[start]
+
+    ind = dist < maxdist
+
+    return key[ind]//nlines, key[ind]%nlines, dist[ind]
@@ -0,0 +1,57 @@
+"""
+Process pool helper for running a method of an object over many chunks
+
+parallel_map calls obj.method(*args) for each tuple in a list and returns
+the results in order. The workers get a copy of obj when the pool forks,
+so large read-only attributes (e.g. interpolation weights) are not sent to
+them with each call.
+
+Example:
+---
+    from soda.utils.parallel import parallel_map
+
+    for out in parallel_map(self, 'interp_chunk', args, numprocs=4):
+        ...
+"""
+
+from multiprocessing import Pool
+from collections import deque
+
+# Object shared with the pool workers (inherited when the pool forks)
+_pool_obj = None
+
+def _pool_call(args):
+    method, fargs = args
+    return getattr(_pool_obj, method)(*fargs)
+
+def parallel_map(obj, method, arglist, numprocs=1):
+    """
+    Iterator returning obj.method(*args) for each tuple in arglist, in order
+
+    With numprocs > 1 the calls are made by a pool of worker processes that
+    each get a copy of obj (and open their own files). At most numprocs
+    calls are in flight so finished results never pile up if the consumer
+    is slower than the workers.
+    """
+    global _pool_obj
+
+    if numprocs <= 1 or len(arglist) <= 1:
+        for args in arglist:
+            yield getattr(obj, method)(*args)
+        return
+
+    _pool_obj = obj
+    numprocs = min(numprocs, len(arglist))
+    pool = Pool(numprocs)
+    try:
+        pending = deque()
+        for args in arglist:
+            if len(pending) >= numprocs:
+                yield pending.popleft().get()
+            pending.append(pool.apply_async(_pool_call, ((method, args),)))
+        while len(pending) > 0:
+            yield pending.popleft().get()
+    finally:
+        pool.close()
+        pool.join()
+        _pool_obj = None
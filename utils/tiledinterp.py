@@ -0,0 +1,319 @@
+"""
+Out-of-core interpolation of very large scattered xyz datasets
+
+The input points are sorted once into a spatially binned index on disk
+(build_point_index). TiledInterp then splits the output points (or grid)
+into square tiles and, for each tile, only reads the input points within a
+halo of the tile from the index before running interpXYZ on it. Tiles are
+processed by a pool of workers and written straight into the output array,
+a memory-mapped .npy file or a netcdf variable.
+
+Example:
+---
+    from soda.utils.tiledinterp import build_point_index, array_chunks, TiledInterp
+
+    build_point_index('soundings_index', array_chunks(XY, Z), binsize=500.)
+
+    F = TiledInterp('soundings_index', method='idw', NNear=6, maxdist=200.,\
+        tilesize=5000., numprocs=8)
+    dv = F(xy)
+    F.grid(x, y, outfile='dem.npy')
+"""
+
+import os
+import tempfile
+import numpy as np
+from netCDF4 import Dataset
+
+from soda.utils.interpXYZ import interpXYZ
+from soda.utils.parallel import parallel_map
+
+def array_chunks(XY, Z, chunksize=1000000):
+    """
+    Iterator over blocks of (XY, Z) from in-memory arrays
+    """
+    for i0 in range(0, Z.shape[0], chunksize):
+        yield XY[i0:i0+chunksize,:], Z[i0:i0+chunksize]
+
+def build_point_index(indexdir, chunks, binsize, dtype=np.float64):
+    """
+    Sort scattered points into square bins of size binsize and store them
+    in indexdir
+
+    Inputs:
+        indexdir - output folder
+        chunks - iterable of (XY [n,2], Z [n]) blocks, e.g. array_chunks
+        binsize - bin size in the coordinate units
+        dtype - data type used to store Z (the coordinates are float64)
+
+    The points are streamed to disk and sorted with a counting sort so
+    only one block is held in memory at a time.
+
+    Returns a PointIndex object
+    """
+    if not os.path.isdir(indexdir):
+        os.makedirs(indexdir)
+
+    # Pass 1: copy the (unsorted) points to a scratch file
+    tmpfile = tempfile.NamedTemporaryFile(dir=indexdir, suffix='.bin', delete=False)
+    npts = 0
+    bbox = [np.inf, -np.inf, np.inf, -np.inf]
+    for XY, Z in chunks:
+        xyz = np.empty((Z.shape[0], 3), np.float64)
+        xyz[:,0:2] = XY
+        xyz[:,2] = np.ravel(Z)
+        xyz = xyz[np.isfinite(xyz[:,2]),:]
+        if xyz.shape[0] == 0:
+            continue
+        bbox = [min(bbox[0], xyz[:,0].min()), max(bbox[1], xyz[:,0].max()),\
+            min(bbox[2], xyz[:,1].min()), max(bbox[3], xyz[:,1].max())]
+        tmpfile.write(xyz.tostring())
+        npts += xyz.shape[0]
+    tmpfile.close()
+
+    if npts == 0:
+        os.remove(tmpfile.name)
+        raise Exception('no valid points to index')
+
+    nbx = int(np.floor((bbox[1]-bbox[0])/binsize)) + 1
+    nby = int(np.floor((bbox[3]-bbox[2])/binsize)) + 1
+
+    raw = np.memmap(tmpfile.name, dtype=np.float64, mode='r', shape=(npts,3))
+    blocksize = 1000000
+
+    def _bins(xyz):
+        ii = ((xyz[:,0]-bbox[0])/binsize).astype(np.int64)
+        jj = ((xyz[:,1]-bbox[2])/binsize).astype(np.int64)
+        return np.minimum(jj, nby-1)*nbx + np.minimum(ii, nbx-1)
+
+    # Pass 2: count the points in each bin
+    counts = np.zeros((nbx*nby,), np.int64)
+    for i0 in range(0, npts, blocksize):
+        counts += np.bincount(_bins(raw[i0:i0+blocksize,:]), minlength=nbx*nby)
+    offsets = np.zeros((nbx*nby+1,), np.int64)
+    offsets[1:] = np.cumsum(counts)
+
+    # Pass 3: scatter each block into its bins
+    out = {}
+    for vv, dt in [('x',np.float64), ('y',np.float64), ('z',dtype)]:
+        out[vv] = np.lib.format.open_memmap(os.path.join(indexdir, vv+'.npy'),\
+            mode='w+', dtype=dt, shape=(npts,))
+    cursor = offsets[:-1].copy()
+    for i0 in range(0, npts, blocksize):
+        xyz = np.array(raw[i0:i0+blocksize,:])
+        bins = _bins(xyz)
+        order = np.argsort(bins, kind='mergesort')
+        bins = bins[order]
+        # Position of each point within its bin for this block
+        first = np.searchsorted(bins, bins)
+        pos = cursor[bins] + np.arange(bins.shape[0]) - first
+        for kk, vv in enumerate(['x','y','z']):
+            out[vv][pos] = xyz[order,kk]
+        cursor += np.bincount(bins, minlength=nbx*nby)
+
+    for vv in out.keys():
+        out[vv].flush()
+    del out, raw
+    os.remove(tmpfile.name)
+
+    np.save(os.path.join(indexdir, 'offsets.npy'), offsets)
+    np.savez(os.path.join(indexdir, 'meta.npz'), bbox=bbox, binsize=binsize,\
+        nbx=nbx, nby=nby, npts=npts)
+
+    return PointIndex(indexdir)
+
+class PointIndex(object):
+    """
+    Spatially binned point index written by build_point_index
+
+    The sorted coordinates are memory-mapped so only the bins touched by a
+    query are read from disk.
+    """
+    def __init__(self, indexdir):
+        self.indexdir = indexdir
+
+        meta = np.load(os.path.join(indexdir, 'meta.npz'))
+        self.bbox = meta['bbox']
+        self.binsize = float(meta['binsize'])
+        self.nbx = int(meta['nbx'])
+        self.nby = int(meta['nby'])
+        self.npts = int(meta['npts'])
+        meta.close()
+
+        self.offsets = np.load(os.path.join(indexdir, 'offsets.npy'))
+        self.x = np.load(os.path.join(indexdir, 'x.npy'), mmap_mode='r')
+        self.y = np.load(os.path.join(indexdir, 'y.npy'), mmap_mode='r')
+        self.z = np.load(os.path.join(indexdir, 'z.npy'), mmap_mode='r')
+
+    def query(self, bbox):
+        """
+        Returns XY [n,2] and Z [n] of the points inside bbox
+        [xmin, xmax, ymin, ymax]
+        """
+        i0 = int(np.floor((bbox[0]-self.bbox[0])/self.binsize))
+        i1 = int(np.floor((bbox[1]-self.bbox[0])/self.binsize))
+        j0 = int(np.floor((bbox[2]-self.bbox[2])/self.binsize))
+        j1 = int(np.floor((bbox[3]-self.bbox[2])/self.binsize))
+        i0, i1 = max(i0, 0), min(i1, self.nbx-1)
+        j0, j1 = max(j0, 0), min(j1, self.nby-1)
+        if i1 < i0 or j1 < j0:
+            return np.zeros((0,2)), np.zeros((0,))
+
+        # Each row of bins is contiguous on disk
+        rows = []
+        for jj in range(j0, j1+1):
+            rows.append(slice(self.offsets[jj*self.nbx+i0],\
+                self.offsets[jj*self.nbx+i1+1]))
+
+        x = np.concatenate([self.x[rr] for rr in rows])
+        y = np.concatenate([self.y[rr] for rr in rows])
+        z = np.concatenate([self.z[rr] for rr in rows])
+
+        ind = (x>=bbox[0]) & (x<=bbox[1]) & (y>=bbox[2]) & (y<=bbox[3])
+
+        return np.vstack((x[ind], y[ind])).T, z[ind]
+
+class TiledInterp(object):
+    """
+    Tiled, parallel interpolation from a PointIndex
+
+    Each output tile uses the input points within 'halo' of the tile
+    (defaults to maxdist, which then has to be finite). Output points with
+    no input points nearby are set to NaN. The result is identical to
+    interpXYZ on the whole dataset for 'nn', 'idw' and 'kriging' as long
+    as maxdist <= halo. 'linear' can differ where the triangles are larger
+    than the halo.
+
+    Other keyword arguments (method, NNear, p, ...) are passed to interpXYZ.
+    """
+    tilesize = 5000. # Output tile size in coordinate units
+    halo = None # Defaults to maxdist
+    numprocs = 1 # Number of worker processes
+    ncvarname = 'topo'
+
+    def __init__(self, index, **kwargs):
+        self.interpkw = {}
+        for kk, vv in kwargs.items():
+            if hasattr(TiledInterp, kk):
+                setattr(self, kk, vv)
+            else:
+                self.interpkw[kk] = vv
+
+        if isinstance(index, basestring):
+            index = PointIndex(index)
+        self.index = index
+
+        if self.halo is None:
+            self.halo = self.interpkw.get('maxdist', interpXYZ.maxdist)
+        if not np.isfinite(self.halo):
+            raise Exception('set a finite halo (or maxdist) for tiled interpolation')
+
+    def __call__(self, XYout, outfile=None):
+        """
+        Interpolate onto the scattered points XYout [N, 2]
+
+        Returns Z [N] (a memory-mapped array if outfile is a .npy file)
+        """
+        N = XYout.shape[0]
+        Z = self._create_output(outfile, (N,))
+
+        # Group the output points by tile
+        xmin, ymin = XYout[:,0].min(), XYout[:,1].min()
+        ti = ((XYout[:,0]-xmin)/self.tilesize).astype(np.int64)
+        tj = ((XYout[:,1]-ymin)/self.tilesize).astype(np.int64)
+        tile = tj*(ti.max()+1) + ti
+        order = np.argsort(tile, kind='mergesort')
+        bounds = np.flatnonzero(np.diff(tile[order])) + 1
+        groups = np.split(order, bounds)
+
+        args = [(XYout[gg,:],) for gg in groups]
+        for gg, zz in zip(groups, parallel_map(self, '_interp_points', args, self.numprocs)):
+            Z[gg] = zz
+
+        return self._close_output(Z)
+
+    def grid(self, x, y, outfile=None):
+        """
+        Interpolate onto the regular grid with coordinate vectors x, y
+
+        Returns Z [ny, nx] (memory-mapped for .npy files). With a .nc
+        outfile the grid is written to the variable ncvarname.
+        """
+        nx, ny = x.shape[0], y.shape[0]
+        Z = self._create_output(outfile, (ny, nx), x=x, y=y)
+
+        dx = np.abs(np.median(np.diff(x))) if nx > 1 else self.tilesize
+        dy = np.abs(np.median(np.diff(y))) if ny > 1 else self.tilesize
+        ntx = max(int(self.tilesize/dx), 1)
+        nty = max(int(self.tilesize/dy), 1)
+
+        blocks = []
+        for j0 in range(0, ny, nty):
+            for i0 in range(0, nx, ntx):
+                blocks.append((slice(j0, j0+nty), slice(i0, i0+ntx)))
+
+        args = [(x[ii], y[jj]) for jj, ii in blocks]
+        for bb, zz in zip(blocks, parallel_map(self, '_interp_block', args, self.numprocs)):
+            Z[bb] = zz
+
+        return self._close_output(Z)
+
+    def _interp_points(self, XYout):
+        """
+        Interpolate one tile of scattered output points
+        """
+        bbox = [XYout[:,0].min()-self.halo, XYout[:,0].max()+self.halo,\
+            XYout[:,1].min()-self.halo, XYout[:,1].max()+self.halo]
+        XY, Zin = self.index.query(bbox)
+
+        if XY.shape[0] == 0:
+            return np.nan*np.ones((XYout.shape[0],))
+
+        NNear = min(self.interpkw.get('NNear', interpXYZ.NNear), XY.shape[0])
+        kwargs = dict(self.interpkw, NNear=NNear)
+        if kwargs.get('method', interpXYZ.method) == 'linear' and XY.shape[0] < 3:
+            return np.nan*np.ones((XYout.shape[0],))
+
+        F = interpXYZ(XY, XYout, **kwargs)
+        return F(Zin)
+
+    def _interp_block(self, x, y):
+        """
+        Interpolate one block of a regular grid
+        """
+        X, Y = np.meshgrid(x, y)
+        Z = self._interp_points(np.vstack((X.ravel(), Y.ravel())).T)
+
+        return Z.reshape(X.shape)
+
+    def _create_output(self, outfile, shape, x=None, y=None):
+        self._nc = None
+        if outfile is None:
+            return np.zeros(shape)
+        elif outfile[-4:] == '.npy':
+            return np.lib.format.open_memmap(outfile, mode='w+',\
+                dtype=np.float64, shape=shape)
+        elif outfile[-3:] == '.nc':
+            self._nc = Dataset(outfile, 'w', format='NETCDF4')
+            if len(shape) == 2:
+                dims = ('y', 'x')
+                for dd, vv in zip(dims, [y, x]):
+                    self._nc.createDimension(dd, vv.shape[0])
+                    self._nc.createVariable(dd, 'f8', (dd,))[:] = vv
+            else:
+                dims = ('Np',)
+                self._nc.createDimension('Np', shape[0])
+            return self._nc.createVariable(self.ncvarname, 'f8', dims,\
+                zlib=True, fill_value=np.nan)
+        else:
+            raise Exception('unknown output file type: %s'%outfile)
+
+    def _close_output(self, Z):
+        if self._nc is not None:
+            self._nc.close()
+            self._nc = None
+            return None
+        elif isinstance(Z, np.memmap):
+            Z.flush()
+
+        return Z
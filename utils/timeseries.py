@@ -11,9 +11,11 @@ import numpy as np
 import matplotlib.pyplot as plt
 from matplotlib import mlab
 from matplotlib.lines import Line2D
-from scipy import signal, interpolate
+from scipy import signal, interpolate, linalg
 from datetime import datetime, timedelta
 import operator
+import hashlib
+from collections import OrderedDict
 import xray
 
 import othertime
@@ -266,14 +268,23 @@ class timeseries(object):
         else:
             frq,frqnames = getTideFreq(Fin=frqnames)
             
-        # Call the uspectra method
-        U = uspectra(self.tsec,self.y,frq=frq,method='lsqfast')
-        amp,phs = U.phsamp(phsbase=basetime)
-        return amp, phs, frq, frqnames, U.invfft()   
-        #amp, phs, mean = \
-        #    harmonic_fit(self.tsec,self.y,frq,phsbase=basetime,axis=axis)
-        #
-        #return amp, phs, frq, frqnames,# U.invfft()   
+        # Fit all of the series in one go (same convention as uspectra)
+        t0 = self.tsec - self.tsec[0]
+        y = self.y.reshape((-1,self.y.shape[-1])).T
+        b = harmonic_lstsq(t0,y,frq)
+        C = (b[1::2,:] + 1j*b[2::2,:]).T
+
+        amp = np.abs(C)
+        phs = np.angle(C)+np.pi # [0, 2*pi]
+        if not basetime == None:
+            phs = np.mod(phs+phase_offset(frq,self.t[0],basetime),2*np.pi)
+
+        # Fitted time series (without the mean)
+        yfit = harmonic_design(t0,frq)[:,1:].dot(b[1:,:]).T
+
+        sz = self.y.shape[:-1]+(len(frq),)
+        return amp.reshape(sz), phs.reshape(sz), frq, frqnames,\
+            yfit.reshape(self.y.shape)
         
     def running_harmonic(self,omega,windowlength=3*86400.0,overlap=12*3600.0, plot=True):
         """
@@ -284,35 +295,45 @@ class timeseries(object):
         """
         
         # Make sure that omega is a list
-        try:
-            len(omega)
-        except:
-            omega=[omega]
+        omega = np.atleast_1d(np.asarray(omega,dtype=np.float64))
         
         pt1,pt2 = window_index_time(self.t,windowlength,overlap)
+        pt1 = np.asarray(pt1,dtype=np.int64)
+        pt2 = np.asarray(pt2,dtype=np.int64)
         npt = len(pt1)
-        tmid = []
-        amp = np.zeros((npt,))
-        phs = np.zeros((npt,))
+
+        # Group the windows sharing a time base (all full length windows
+        # of a regular series) so each group is fitted in one solve
+        groups = {}
+        for ii in range(npt):
+            t0 = self.tsec[pt1[ii]:pt2[ii]] - self.tsec[pt1[ii]]
+            key = hashlib.md5(np.ascontiguousarray(t0).tostring()).hexdigest()
+            groups.setdefault(key,[]).append(ii)
+
+        C = np.zeros((npt,omega.shape[0]),dtype=np.complex128)
         ymean = np.zeros((npt,))
-        ii=-1
-        for t1,t2 in zip(pt1,pt2):
-            ii+=1
-            # Perform the harmonic fit on the segment
-            U = uspectra(self.t[t1:t2],self.y[t1:t2],frq=omega,method='lsqfast')
-            # Reference the phase to the start of the time series
-            amp[ii],phs[ii] = U.phsamp(phsbase = self.t[0])
-            
-            # Return the mid time point
-            ind = np.floor(t1 + (t2-t1)/2)
-            tmid.append(self.t[ind])
-            
-            # Return the fitted time series
-            ymean[ii] = self.y[t1:t2].mean()
-            #yout[t1:t2] += ymean + U.invfft()
+        for ind in groups.values():
+            ind = np.array(ind)
+            nt = pt2[ind[0]] - pt1[ind[0]]
+            t0 = self.tsec[pt1[ind[0]]:pt2[ind[0]]] - self.tsec[pt1[ind[0]]]
 
-            
-        tmid = np.asarray(tmid)
+            # Window segments as the columns of one array [nt, nwindows]
+            y = self.y[pt1[ind][np.newaxis,:] + np.arange(nt)[:,np.newaxis]]
+            b = harmonic_lstsq(t0,y,omega)
+            C[ind,:] = (b[1::2,:] + 1j*b[2::2,:]).T
+            ymean[ind] = np.ma.mean(y,axis=0)
+
+        # Reference the phase to the start of the time series
+        amp = np.abs(C)
+        phs = np.angle(C) + np.pi
+        dt = self.tsec[pt1] - self.tsec[0]
+        phs = np.mod(phs + np.mod(dt[:,np.newaxis]*omega,2*np.pi),2*np.pi)
+        if omega.shape[0]==1:
+            amp = amp[:,0]
+            phs = phs[:,0]
+
+        # Return the mid time point
+        tmid = np.asarray([self.t[t1+(t2-t1)//2] for t1,t2 in zip(pt1,pt2)])
         
 
         
@@ -334,61 +355,31 @@ class timeseries(object):
             
     def running_mean(self,windowlength=3*86400.0):
         """
-        Running mean of the time series
+        Running mean of the time series (ignoring masked values)
         
         windowlength - length of each time window [seconds]
         """
-        mask = self.y.mask.copy()
-        self.y[self.y.mask]=0.
-        self.y.mask=mask
-        
-        windowsize = np.floor(windowlength/self.dt)
-        ytmp = self.y.copy()
-        ytmp = self._window_matrix(ytmp,windowsize)
-        
-        weights = 1./windowsize * np.ones((windowsize,))
-        ytmp2 = np.sum(ytmp*weights,axis=-1)
-        
-        # This result needs to be normalized to account for missing data,
-        # this is the same as calculating different weights for each section
-        ntmp= np.ones_like(self.y)
-        ntmp[mask] = 0.
-        norm = self._window_matrix(ntmp,windowsize)
-        #norm*= weights
-        norm = norm.sum(axis=-1)
-        norm /= windowsize
-        
-        ytmp2/=norm
+        windowsize = int(np.floor(windowlength/self.dt))
+        ytmp = rolling_stat(self.y,windowsize,stat='mean')
                 
-        return self._update_windowed_data(ytmp2,windowsize)
+        return self._update_windowed_data(ytmp,windowsize)
 
     def running_rms(self,windowlength=3*86400.0):
         """
-        Running RMS of the time series
+        Running RMS of the time series (ignoring masked values)
 
         windowlength - length of each time window [seconds]
         """
-        mask = self.y.mask.copy()
-        self.y[self.y.mask]=0.
-        self.y.mask=mask
-        
-        windowsize = np.floor(windowlength/self.dt)
-        ytmp = self.y.copy()
-        ytmp = self._window_matrix(ytmp,windowsize)
-        ytmp2 = np.sum(ytmp*ytmp,axis=-1)
+        windowsize = int(np.floor(windowlength/self.dt))
+        ytmp = rolling_stat(self.y,windowsize,stat='rms')
 
-        ntmp= np.ones_like(self.y)
-        ntmp[mask] = 0.
-        N = self._window_matrix(ntmp,windowsize)
-        N = N.sum(axis=-1)
-
-        return self._update_windowed_data(np.sqrt( 1./N * ytmp2),windowsize)
+        return self._update_windowed_data(ytmp,windowsize)
 
     def despike(self,nstd=4.,windowlength=3*86400.0,overlap=12*3600.0,\
         upper=np.inf,lower=-np.inf,maxdiff=np.inf,fillval=0.):
         """
-        Despike time series by replacing any values greater than nstd*std.dev with the
-        median of a running window. 
+        Despike time series by masking any values more than nstd*std.dev
+        from the mean of a running window. 
         
         nstd - number of standard deviations outside to replace        
         windowlength - length of each time window [seconds]
@@ -422,21 +413,17 @@ class timeseries(object):
         
         nbad += np.sum(ind)
         
-        # Now calculate the moving median and standard deviation
-        windowsize = np.floor(windowlength/self.dt)
-        ytmp = self.y.copy()
-        ytmp = self._window_matrix(ytmp,windowsize)
-        
-        ytmp2 = np.mean(ytmp,axis=-1)
-        ymean = self._update_windowed_data(ytmp2,windowsize)
-        
-        #ytmp2= np.std(ytmp,axis=-1)
-        ytmp2 = np.apply_along_axis(np.std,-1,ytmp2)
-        ystd = self._update_windowed_data(ytmp2,windowsize)
+        # Now calculate the moving mean and standard deviation
+        windowsize = int(np.floor(windowlength/self.dt))
+        ymean = self._update_windowed_data(\
+            rolling_stat(self.y,windowsize,stat='mean'),windowsize)
+        ystd = self._update_windowed_data(\
+            rolling_stat(self.y,windowsize,stat='std'),windowsize)
         
         # Mask values outsize of the
         ind = operator.or_(self.y >= ymean + nstd*ystd,\
                 self.y <= ymean - nstd*ystd)
+        ind = np.ma.filled(ind,False)
         
         #self.y[ind] = ymedian[ind]
         self.y.mask[ind] = True
@@ -596,7 +583,7 @@ class timeseries(object):
         that is the same size as the original time series
         """
         y = np.zeros_like(self.y)
-        indent = (windowsize-np.mod(windowsize,2))/2
+        indent = int(windowsize-np.mod(windowsize,2))//2
         
         if np.mod(windowsize,2)==1:
             y[...,indent:-indent]=ytmp
@@ -889,6 +876,124 @@ class ModVsObs(object):
         
         return Pyy, frq
 
+# Cholesky factors of the harmonic normal matrices (small, bounded LRU)
+_harmonic_factors = OrderedDict()
+_harmonic_maxfactors = 64
+
+def harmonic_design(t,frq):
+    """
+    Harmonic least-squares design matrix [Nt, 2*Nfrq+1]
+
+    The columns are [1, cos(frq[0]*t), sin(frq[0]*t), cos(frq[1]*t), ...]
+    """
+    t = np.asarray(t,dtype=np.float64)
+    frq = np.atleast_1d(np.asarray(frq,dtype=np.float64))
+
+    A = np.ones((t.shape[0],2*frq.shape[0]+1))
+    ft = t[:,np.newaxis]*frq[np.newaxis,:]
+    A[:,1::2] = np.cos(ft)
+    A[:,2::2] = np.sin(ft)
+
+    return A
+
+def harmonic_factor(t,frq,A=None):
+    """
+    Cholesky factor of the normal matrix A^T A of the harmonic design matrix
+
+    Only the small [2*Nfrq+1, 2*Nfrq+1] factor is cached (on the time base
+    and frequencies, least recently used first out) so that repeated fits,
+    e.g. each layer of a model output, only factorise once.
+
+    Returns None if A^T A is (nearly) singular.
+    """
+    t = np.ascontiguousarray(t,dtype=np.float64)
+    frq = np.ascontiguousarray(np.atleast_1d(frq),dtype=np.float64)
+    key = hashlib.md5(t.tostring()+frq.tostring()).hexdigest()
+
+    if _harmonic_factors.has_key(key):
+        factor = _harmonic_factors.pop(key)
+    else:
+        if A is None:
+            A = harmonic_design(t,frq)
+        factor = _normal_factor(A)
+        if len(_harmonic_factors) >= _harmonic_maxfactors:
+            _harmonic_factors.popitem(last=False)
+    _harmonic_factors[key] = factor
+
+    return factor
+
+def _normal_factor(A):
+    """
+    Cholesky factor of A^T A (None if it is badly conditioned)
+    """
+    AtA = A.T.dot(A)
+    if np.linalg.cond(AtA) > 1e8:
+        return None
+    try:
+        return linalg.cho_factor(AtA)
+    except np.linalg.LinAlgError:
+        return None
+
+def _normal_solve(A,X,factor):
+    """
+    Least-squares solution of A b = X for all of the columns of X at once
+    """
+    if factor is None:
+        return np.linalg.lstsq(A,X,rcond=-1)[0]
+
+    return linalg.cho_solve(factor,A.T.dot(X))
+
+def harmonic_lstsq(t,X,frq,mask=None):
+    """
+    Least-squares harmonic fit of each column of X
+
+    Inputs:
+        t - vector [Nt]
+        X - vector [Nt] or array [Nt, M] (masked or NaN values are gaps)
+        frq - vector [Nfrq]
+        mask - optional array [Nt, M] of additional gaps (True = missing)
+
+    Returns:
+        b [2*Nfrq+1, M] - the mean, cos and sin coefficients of each column
+        (NaN where a column has fewer points than coefficients)
+
+    Columns without gaps are solved together from the normal equations with
+    the cached Cholesky factor (see harmonic_factor). Gappy columns are
+    grouped by their gap pattern and each group is solved with the rows of
+    the design matrix that are present.
+    """
+    X = np.ma.masked_invalid(X)
+    if X.ndim == 1:
+        X = X.reshape((-1,1))
+    miss = np.ma.getmaskarray(X)
+    if mask is not None:
+        miss = miss | np.reshape(mask,X.shape)
+    X = np.ma.filled(X,0.)
+
+    npar = 2*np.atleast_1d(frq).shape[0]+1
+    b = np.nan*np.ones((npar,X.shape[1]))
+
+    A = harmonic_design(t,frq)
+    gappy = miss.any(axis=0)
+    if not gappy.all():
+        full = ~gappy
+        b[:,full] = _normal_solve(A,X[:,full],harmonic_factor(t,frq,A=A))
+
+    if gappy.any():
+        cols = np.flatnonzero(gappy)
+        pattern = np.ascontiguousarray(np.packbits(miss[:,cols].T,axis=1))
+        pattern = pattern.view(np.dtype((np.void,pattern.shape[1]))).ravel()
+        pattern, group = np.unique(pattern,return_inverse=True)
+        for gg in range(pattern.shape[0]):
+            cc = cols[group==gg]
+            good = ~miss[:,cc[0]]
+            if good.sum() < npar:
+                continue
+            Ag = A[good,:]
+            b[:,cc] = _normal_solve(Ag,X[good][:,cc],_normal_factor(Ag))
+
+    return b
+
 def harmonic_fit(t,X,frq,mask=None,axis=0,phsbase=None):
     """
     Least-squares harmonic fit on an array, X, with frequencies, frq. 
@@ -900,6 +1005,9 @@ def harmonic_fit(t,X,frq,mask=None,axis=0,phsbase=None):
     phsbase - phase offset
     
     where, dimension with Nt should correspond to axis = axis.
+
+    Only columns where mask is True are fitted (the others are NaN). Masked
+    or NaN values are treated as gaps (see harmonic_lstsq).
     """
 
     t = np.asarray(t)
@@ -914,52 +1022,21 @@ def harmonic_fit(t,X,frq,mask=None,axis=0,phsbase=None):
     
     X = np.reshape(X,(sz[0],lenX))
     
-    if not mask == None:
-        mask = np.reshape(mask,(lenX,))
+    if mask is not None:
+        mask = np.reshape(mask,(lenX,)).astype(bool)
     else:
-        mask = np.ones((lenX,))
+        mask = np.ones((lenX,),dtype=bool)
     
     frq = np.array(frq)
     Nfrq = frq.shape[0]
     
-
-    
-    def buildA(t,frq):
-        """
-        Construct matrix A
-        """
-        nt=t.shape[0]
-        nf=frq.shape[0]
-        nff=nf*2+1
-        A=np.ones((nt,nff))
-        for ff in range(0,nf):
-            A[:,ff*2+1]=np.cos(frq[ff]*t)
-            A[:,ff*2+2]=np.sin(frq[ff]*t)
-            
-        return A
-    
-    def lstsqnumpy(A,y):    
-        """    
-        Solve the least square problem
-        
-        Return:
-            the complex amplitude 
-            the mean
-        """
-        N=A.shape[1]
-        b = np.linalg.lstsq(A,y)
-        A = b[0][1::2]
-        B = b[0][2::2]
-        
-        return A+1j*B, b[0][0::N]
-    
-    def phsamp(C):
-        return np.abs(C), np.angle(C)
-        
-    # Least-squares matrix approach
-    A = buildA(t,frq)
-    C, C0 = lstsqnumpy(A,X) # This works on all columns of X!!
-    Amp, Phs= phsamp(C)
+    # Least-squares matrix approach (all columns of X in one solve)
+    b = np.nan*np.ones((2*Nfrq+1,lenX))
+    if mask.any():
+        b[:,mask] = harmonic_lstsq(t,X[:,mask],frq)
+    C = b[1::2,:] + 1j*b[2::2,:]
+    C0 = b[0,:]
+    Amp, Phs = np.abs(C), np.angle(C)
 
     # Reference the phase to some time
     if not phsbase == None:
@@ -968,16 +1045,6 @@ def harmonic_fit(t,X,frq,mask=None,axis=0,phsbase=None):
 	phsoff = np.repeat(phsoff.reshape((phsoff.shape[0],1)),lenX,axis=1)
 	phs = np.mod(Phs+phsoff,2*np.pi)
     
-    # Non-vectorized method (~20x slower)
-#    Amp = np.zeros((Nfrq,lenX))
-#    Phs = np.zeros((Nfrq,lenX))
-#    for ii in range(0,lenX):    
-#        if mask[ii]==True: 
-#            C = lstsqnumpy(A,X[:,ii])
-#            # Calculate the phase and amplitude
-#            am, ph= phsamp(C)
-#            Amp[:,ii] = am; Phs[:,ii] = ph
-            
     
     # reshape the array
     Amp = np.reshape(Amp,(Nfrq,)+sz[1:])
@@ -1304,6 +1371,93 @@ def monthlyhist(t,y,ylim=0.1,xlabel='',ylabel='',title='',**kwargs):
         
     return fig
     
+def rolling_stat(y,windowsize,stat='mean',minpoints=1):
+    """
+    Statistic of every window of windowsize points along the last axis of y,
+    ignoring masked and NaN values
+
+    Inputs:
+        y - (masked) array [..., N]
+        windowsize - number of points in each window
+        stat - 'mean', 'rms', 'var', 'std' (population), 'min', 'max',
+            'median' or 'count'
+        minpoints - windows with fewer valid points are masked
+
+    Returns:
+        masked array [..., N-windowsize+1] (element k is the window starting
+        at point k)
+
+    The mean, rms, var and std come from cumulative sums and min and max
+    from a block-wise running maximum (van Herk/Gil-Werman), all O(N). The
+    median uses the pandas rolling median, O(N log(windowsize)).
+    """
+    windowsize = int(windowsize)
+    shape = np.shape(y)
+    N = shape[-1]
+    if windowsize < 1 or windowsize > N:
+        raise Exception, 'windowsize must be between 1 and %d'%N
+    nw = N - windowsize + 1
+
+    data = np.ma.filled(np.ma.masked_invalid(y).astype(np.float64),np.nan)
+    data = data.reshape((-1,N))
+    valid = ~np.isnan(data)
+
+    def _window_sum(x):
+        # Sum over each window from a cumulative sum
+        cs = np.zeros((x.shape[0],N+1))
+        np.cumsum(x,axis=-1,out=cs[:,1:])
+        return cs[:,windowsize:] - cs[:,:nw]
+
+    count = np.round(_window_sum(valid.astype(np.float64)))
+
+    if stat == 'count':
+        out = count.copy()
+
+    elif stat in ['mean','rms','var','std']:
+        # Remove the series mean to limit round-off in the sums
+        offset = np.where(valid,data,0.).sum(axis=-1)/np.maximum(valid.sum(axis=-1),1)
+        offset = offset[:,np.newaxis]
+        if stat == 'rms':
+            offset[:] = 0.
+        x = np.where(valid,data-offset,0.)
+        with np.errstate(invalid='ignore',divide='ignore'):
+            s1 = _window_sum(x)/count
+            if stat == 'mean':
+                out = s1 + offset
+            else:
+                s2 = _window_sum(x*x)/count
+                if stat == 'rms':
+                    out = np.sqrt(s2)
+                else:
+                    out = np.maximum(s2 - s1*s1,0.)
+                    if stat == 'std':
+                        out = np.sqrt(out)
+
+    elif stat in ['min','max']:
+        fill = np.inf if stat == 'min' else -np.inf
+        func = np.minimum if stat == 'min' else np.maximum
+        nb = int(np.ceil(N/float(windowsize)))
+        x = fill*np.ones((data.shape[0],nb*windowsize))
+        x[:,:N] = np.where(valid,data,fill)
+        x = x.reshape((data.shape[0],nb,windowsize))
+        # Running extreme from the start and from the end of each block
+        prefix = func.accumulate(x,axis=-1).reshape((data.shape[0],-1))
+        suffix = func.accumulate(x[...,::-1],axis=-1)[...,::-1].reshape((data.shape[0],-1))
+        out = func(suffix[:,:nw],prefix[:,windowsize-1:windowsize-1+nw])
+
+    elif stat == 'median':
+        import pandas as pd
+        out = pd.DataFrame(data.T).rolling(windowsize,min_periods=1).median().values.T
+        out = out[:,windowsize-1:]
+
+    else:
+        raise Exception, 'unknown statistic: %s'%stat
+
+    out = out.reshape(shape[:-1]+(nw,))
+    mask = (count < max(minpoints,1)).reshape(shape[:-1]+(nw,))
+
+    return np.ma.MaskedArray(out,mask=mask)
+
 def window_index(serieslength,windowsize,overlap):
     """
     Determines the indices for start and end points of a time series window